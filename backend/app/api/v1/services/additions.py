@@ -32,29 +32,7 @@ class AdicionResponse(AdicionBase):
 # Router para los endpoints de adiciones
 router_additions = APIRouter()
 
-# Crear tabla de adiciones si no existe
-def create_additions_table():
-    """
-    Crear la tabla de adiciones si no existe
-    """
-    additions_table = """
-    CREATE TABLE IF NOT EXISTS adiciones (
-        id INT AUTO_INCREMENT PRIMARY KEY,
-        nombre VARCHAR(100) NOT NULL,
-        tipo VARCHAR(50) NOT NULL,
-        precio DECIMAL(10, 2) NOT NULL,
-        stock INT NOT NULL DEFAULT 0,
-        minimo INT NOT NULL DEFAULT 0,
-        estado VARCHAR(20) NOT NULL DEFAULT 'bien',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-    )
-    """
-    execute_query(additions_table)
-    print("Tabla de adiciones verificada/creada exitosamente")
-
-# Crear la tabla al importar el módulo
-create_additions_table()
+# La tabla de adiciones se crea con el esquema base (database/db.py) al arrancar la aplicación
 
 @router_additions.post("/", response_model=AdicionResponse)
 async def create_addition(adicion: AdicionCreate):
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException, Depends, status, Request, APIRouter
 from typing import List, Optional
 from api.v1.auth_service.login import get_current_active_user
-from database.db import  execute_query
+from database.async_db import execute_query, insert
+from models.catalog import product_catalog
 # Crear rutas para categorías
 router_categories = APIRouter()
 
@@ -31,7 +32,7 @@ async def create_category(
     
     # Verificar si ya existe una categoría con ese nombre
     check_query = "SELECT id FROM categories WHERE nombre_categoria = %s"
-    existing_category = execute_query(check_query, (name,), fetch_one=True)
+    existing_category = await execute_query(check_query, (name,), fetch_one=True)
     
     if existing_category:
         raise HTTPException(
@@ -45,14 +46,9 @@ async def create_category(
     """
     
     try:
-        result = execute_query(query, (name,))
+        category_id = await insert(query, (name,))
         
-        if result:
-            # Obtener el ID de la categoría recién creada
-            id_query = "SELECT LAST_INSERT_ID() as id"
-            id_result = execute_query(id_query, fetch_one=True)
-            category_id = id_result['id'] if id_result else None
-            
+        if category_id:
             return {"id": category_id, "message": "Categoría creada exitosamente"}
         else:
             raise HTTPException(
@@ -73,7 +69,7 @@ async def get_categories():
     ORDER BY nombre_categoria
     """
     
-    categories = execute_query(query, fetch_all=True) or []
+    categories = await execute_query(query, fetch_all=True) or []
     return categories
 
 @router_categories.get("/{category_id}", response_model=dict)
@@ -81,7 +77,7 @@ async def get_category(category_id: int):
     """Obtener una categoría por su ID"""
     query = "SELECT * FROM categories WHERE id = %s"
     
-    category = execute_query(query, (category_id,), fetch_one=True)
+    category = await execute_query(query, (category_id,), fetch_one=True)
     
     if not category:
         raise HTTPException(
@@ -117,7 +113,7 @@ async def update_category(
     
     # Verificar que la categoría existe
     check_query = "SELECT id FROM categories WHERE id = %s"
-    existing_category = execute_query(check_query, (category_id,), fetch_one=True)
+    existing_category = await execute_query(check_query, (category_id,), fetch_one=True)
     
     if not existing_category:
         raise HTTPException(
@@ -127,7 +123,7 @@ async def update_category(
     
     # Verificar si ya existe otra categoría con ese nombre
     check_name_query = "SELECT id FROM categories WHERE nombre_categoria = %s AND id != %s"
-    duplicate_category = execute_query(check_name_query, (name, category_id), fetch_one=True)
+    duplicate_category = await execute_query(check_name_query, (name, category_id), fetch_one=True)
     
     if duplicate_category:
         raise HTTPException(
@@ -143,11 +139,13 @@ async def update_category(
     """
     
     try:
-        execute_query(update_query, (name, category_id))
+        await execute_query(update_query, (name, category_id))
+        # El catálogo de productos guarda el nombre de la categoría
+        await product_catalog.invalidate_async()
         
         # Obtener la categoría actualizada
         get_query = "SELECT * FROM categories WHERE id = %s"
-        updated_category = execute_query(get_query, (category_id,), fetch_one=True)
+        updated_category = await execute_query(get_query, (category_id,), fetch_one=True)
         
         return updated_category
     except Exception as e:
@@ -164,7 +162,7 @@ async def delete_category(
     """Eliminar una categoría"""
     # Verificar que la categoría existe
     check_query = "SELECT id FROM categories WHERE id = %s"
-    existing_category = execute_query(check_query, (category_id,), fetch_one=True)
+    existing_category = await execute_query(check_query, (category_id,), fetch_one=True)
     
     if not existing_category:
         raise HTTPException(
@@ -174,18 +172,19 @@ async def delete_category(
     
     # Verificar si hay productos usando esta categoría
     check_products_query = "SELECT COUNT(*) as count FROM products WHERE category_id = %s"
-    products_count = execute_query(check_products_query, (category_id,), fetch_one=True)
+    products_count = await execute_query(check_products_query, (category_id,), fetch_one=True)
     
     if products_count and products_count['count'] > 0:
         # Si hay productos, actualizar su category_id a NULL
         update_products_query = "UPDATE products SET category_id = NULL WHERE category_id = %s"
-        execute_query(update_products_query, (category_id,))
+        await execute_query(update_products_query, (category_id,))
     
     # Eliminar la categoría
     delete_query = "DELETE FROM categories WHERE id = %s"
     
     try:
-        execute_query(delete_query, (category_id,))
+        await execute_query(delete_query, (category_id,))
+        await product_catalog.invalidate_async()
         return None
     except Exception as e:
         raise HTTPException(
@@ -26,26 +26,7 @@ class DomiciliaryResponse(DomiciliaryBase):
 # Router para los endpoints de domiciliarios
 router_domiciliary = APIRouter()
 
-# Crear tabla de domiciliarios si no existe
-def create_domiciliary_table():
-    """
-    Crear la tabla de domiciliarios si no existe
-    """
-    domiciliary_table = """
-    CREATE TABLE IF NOT EXISTS domiciliarios (
-        id INT AUTO_INCREMENT PRIMARY KEY,
-        nombre VARCHAR(100) NOT NULL,
-        telefono VARCHAR(20) NOT NULL,
-        tarifa DECIMAL(10, 2) NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-    )
-    """
-    execute_query(domiciliary_table)
-    print("Tabla de domiciliarios verificada/creada exitosamente")
-
-# Crear la tabla al importar el módulo
-create_domiciliary_table()
+# La tabla de domiciliarios se crea con el esquema base (database/db.py) al arrancar la aplicación
 
 @router_domiciliary.post("/", response_model=DomiciliaryResponse)
 async def create_domiciliary(domiciliary: DomiciliaryCreate):
@@ -1,15 +1,51 @@
 from fastapi import APIRouter, HTTPException, Query, Path
-from typing import  List, Dict
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import  List, Dict, Iterator
 from datetime import datetime, date
-from database.db  import execute_query
+from database.db  import stream_query
+import itertools
+import json
 
 router_extracts = APIRouter()
 
+# Columnas de las filas del extracto, en el mismo orden que el SELECT
+EXTRACT_COLUMNS = (
+    'invoice_number', 'invoice_date', 'invoice_time', 'cliente', 'vendedor',
+    'product_name', 'product_variant', 'quantity', 'unit_price', 'subtotal',
+    'subtotal_products', 'total_amount', 'payment_method', 'created_at'
+)
+
 class ExtractService:
     """Servicio para generar extractos de compras y ventas"""
     
     @staticmethod
-    def get_monthly_purchase_extract(year: int, month: int) -> List[Dict]:
+    def _format_extract_row(row: tuple) -> tuple:
+        """Formatear una fila del extracto (tupla en el orden de EXTRACT_COLUMNS) para la respuesta JSON"""
+        (invoice_number, invoice_date, invoice_time, cliente, vendedor, product_name, product_variant,
+         quantity, unit_price, subtotal, subtotal_products, total_amount, payment_method, created_at) = row
+        
+        return (
+            invoice_number,
+            # Formatear las fechas y horas para mejor legibilidad
+            invoice_date.strftime('%d/%m/%Y') if invoice_date else invoice_date,
+            str(invoice_time) if invoice_time else invoice_time,
+            cliente,
+            vendedor,
+            product_name,
+            product_variant,
+            # Asegurar que los valores numéricos sean float para JSON
+            float(quantity),
+            float(unit_price),
+            float(subtotal),
+            float(subtotal_products),
+            float(total_amount),
+            payment_method,
+            created_at.strftime('%d/%m/%Y %H:%M:%S') if created_at else created_at
+        )
+    
+    @staticmethod
+    def stream_monthly_purchase_extract(year: int, month: int) -> Iterator[tuple]:
         """
         Obtiene un extracto detallado de compras por mes y año
         
@@ -18,7 +54,7 @@ class ExtractService:
             month: Mes del extracto (1-12)
             
         Returns:
-            Lista con todas las compras y sus detalles
+            Generador de tuplas (en el orden de EXTRACT_COLUMNS) con todas las compras y sus detalles
         """
         try:
             query = """
@@ -40,36 +76,33 @@ class ExtractService:
             FROM purchases p
             JOIN purchase_details pd ON p.id = pd.purchase_id
             LEFT JOIN users u ON p.seller_username = u.username
-            WHERE YEAR(p.invoice_date) = %s
-              AND MONTH(p.invoice_date) = %s
+            WHERE p.invoice_date >= %s
+              AND p.invoice_date < %s
             ORDER BY p.invoice_date, p.invoice_time
             """
             
-            results = execute_query(query, (year, month), fetch_all=True)
+            # Rango [primer día del mes, primer día del mes siguiente) para que
+            # la consulta pueda usar el índice de invoice_date
+            month_start = date(year, month, 1)
+            next_month = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
             
-            # Formatear las fechas y horas para mejor legibilidad
-            for row in results:
-                if row['invoice_date']:
-                    row['invoice_date'] = row['invoice_date'].strftime('%d/%m/%Y')
-                if row['invoice_time']:
-                    row['invoice_time'] = str(row['invoice_time'])
-                if row['created_at']:
-                    row['created_at'] = row['created_at'].strftime('%d/%m/%Y %H:%M:%S')
-                
-                # Asegurar que los valores numéricos sean float para JSON
-                row['quantity'] = float(row['quantity'])
-                row['unit_price'] = float(row['unit_price'])
-                row['subtotal'] = float(row['subtotal'])
-                row['subtotal_products'] = float(row['subtotal_products'])
-                row['total_amount'] = float(row['total_amount'])
-            
-            return results
+            # El cursor del servidor entrega las filas por lotes como tuplas; cada
+            # fila se formatea y se entrega sin acumular el extracto completo
+            for row in stream_query(query, (month_start, next_month), compact=True):
+                yield ExtractService._format_extract_row(row)
         except Exception as e:
             print(f"Error al obtener extracto mensual: {str(e)}")
             raise
     
     @staticmethod
-    def get_daily_purchase_extract(target_date: date) -> List[Dict]:
+    def get_monthly_purchase_extract(year: int, month: int) -> List[Dict]:
+        """
+        Obtiene un extracto detallado de compras por mes y año (como lista completa)
+        """
+        return [dict(zip(EXTRACT_COLUMNS, row)) for row in ExtractService.stream_monthly_purchase_extract(year, month)]
+    
+    @staticmethod
+    def stream_daily_purchase_extract(target_date: date) -> Iterator[tuple]:
         """
         Obtiene un extracto detallado de compras para una fecha específica
         
@@ -77,7 +110,7 @@ class ExtractService:
             target_date: Fecha del extracto
             
         Returns:
-            Lista con todas las compras y sus detalles para ese día
+            Generador de tuplas (en el orden de EXTRACT_COLUMNS) con todas las compras y sus detalles para ese día
         """
         try:
             query = """
@@ -103,31 +136,23 @@ class ExtractService:
             ORDER BY p.invoice_time
             """
             
-            results = execute_query(query, (target_date,), fetch_all=True)
-            
-            # Formatear las fechas y horas para mejor legibilidad
-            for row in results:
-                if row['invoice_date']:
-                    row['invoice_date'] = row['invoice_date'].strftime('%d/%m/%Y')
-                if row['invoice_time']:
-                    row['invoice_time'] = str(row['invoice_time'])
-                if row['created_at']:
-                    row['created_at'] = row['created_at'].strftime('%d/%m/%Y %H:%M:%S')
-                
-                # Asegurar que los valores numéricos sean float para JSON
-                row['quantity'] = float(row['quantity'])
-                row['unit_price'] = float(row['unit_price'])
-                row['subtotal'] = float(row['subtotal'])
-                row['subtotal_products'] = float(row['subtotal_products'])
-                row['total_amount'] = float(row['total_amount'])
-            
-            return results
+            # El cursor del servidor entrega las filas por lotes como tuplas; cada
+            # fila se formatea y se entrega sin acumular el extracto completo
+            for row in stream_query(query, (target_date,), compact=True):
+                yield ExtractService._format_extract_row(row)
         except Exception as e:
             print(f"Error al obtener extracto diario: {str(e)}")
             raise
     
     @staticmethod
-    def get_date_range_purchase_extract(start_date: date, end_date: date) -> List[Dict]:
+    def get_daily_purchase_extract(target_date: date) -> List[Dict]:
+        """
+        Obtiene un extracto detallado de compras para una fecha específica (como lista completa)
+        """
+        return [dict(zip(EXTRACT_COLUMNS, row)) for row in ExtractService.stream_daily_purchase_extract(target_date)]
+    
+    @staticmethod
+    def stream_date_range_purchase_extract(start_date: date, end_date: date) -> Iterator[tuple]:
         """
         Obtiene un extracto detallado de compras para un rango de fechas
         
@@ -136,7 +161,7 @@ class ExtractService:
             end_date: Fecha final
             
         Returns:
-            Lista con todas las compras y sus detalles en ese rango
+            Generador de tuplas (en el orden de EXTRACT_COLUMNS) con todas las compras y sus detalles en ese rango
         """
         try:
             query = """
@@ -162,34 +187,65 @@ class ExtractService:
             ORDER BY p.invoice_date, p.invoice_time
             """
             
-            results = execute_query(query, (start_date, end_date), fetch_all=True)
-            
-            # Formatear las fechas y horas para mejor legibilidad
-            for row in results:
-                if row['invoice_date']:
-                    row['invoice_date'] = row['invoice_date'].strftime('%d/%m/%Y')
-                if row['invoice_time']:
-                    row['invoice_time'] = str(row['invoice_time'])
-                if row['created_at']:
-                    row['created_at'] = row['created_at'].strftime('%d/%m/%Y %H:%M:%S')
-                
-                # Asegurar que los valores numéricos sean float para JSON
-                row['quantity'] = float(row['quantity'])
-                row['unit_price'] = float(row['unit_price'])
-                row['subtotal'] = float(row['subtotal'])
-                row['subtotal_products'] = float(row['subtotal_products'])
-                row['total_amount'] = float(row['total_amount'])
-            
-            return results
+            # El cursor del servidor entrega las filas por lotes como tuplas; cada
+            # fila se formatea y se entrega sin acumular el extracto completo
+            for row in stream_query(query, (start_date, end_date), compact=True):
+                yield ExtractService._format_extract_row(row)
         except Exception as e:
             print(f"Error al obtener extracto por rango de fechas: {str(e)}")
             raise
+    
+    @staticmethod
+    def get_date_range_purchase_extract(start_date: date, end_date: date) -> List[Dict]:
+        """
+        Obtiene un extracto detallado de compras para un rango de fechas (como lista completa)
+        """
+        return [dict(zip(EXTRACT_COLUMNS, row)) for row in ExtractService.stream_date_range_purchase_extract(start_date, end_date)]
+
+# Filas que se acumulan antes de enviar un fragmento de la respuesta
+EXTRACT_CHUNK_ROWS = 500
+
+async def _stream_extract_response(header: Dict, rows: Iterator[tuple], compact: bool = False) -> StreamingResponse:
+    """
+    Construir una respuesta JSON que se envía a medida que se leen las filas.
+
+    El documento tiene la misma forma que antes ({...header, "data": [...],
+    "total_records": N}); total_records va al final porque solo se conoce
+    al terminar de recorrer el resultado. Con compact=True se añade
+    "columns" y cada elemento de "data" es un arreglo de valores en ese
+    orden, serializado directamente desde la tupla.
+    """
+    # Leer la primera fila antes de empezar a responder para que los errores de
+    # conexión o de consulta todavía se puedan devolver como un 500
+    first_row = await run_in_threadpool(next, rows, None)
+    all_rows = itertools.chain([first_row], rows) if first_row is not None else iter(())
+    
+    def generate():
+        prefix = "".join(f"{json.dumps(key)}: {json.dumps(value)}, " for key, value in header.items())
+        if compact:
+            prefix += f'"columns": {json.dumps(EXTRACT_COLUMNS)}, '
+        yield "{" + prefix + '"data": ['
+        total_records = 0
+        chunk = []
+        for row in all_rows:
+            chunk.append(json.dumps(row if compact else dict(zip(EXTRACT_COLUMNS, row)), default=str))
+            total_records += 1
+            if len(chunk) >= EXTRACT_CHUNK_ROWS:
+                yield ("," if total_records > len(chunk) else "") + ",".join(chunk)
+                chunk = []
+        if chunk:
+            yield ("," if total_records > len(chunk) else "") + ",".join(chunk)
+        yield f'], "total_records": {total_records}}}'
+    
+    # StreamingResponse recorre los generadores síncronos en el threadpool
+    return StreamingResponse(generate(), media_type="application/json")
 
 # Endpoints para extractos
 @router_extracts.get("/monthly/{year}/{month}")
 async def get_monthly_extract(
     year: int = Path(..., description="Año del extracto"),
-    month: int = Path(..., description="Mes del extracto (1-12)")
+    month: int = Path(..., description="Mes del extracto (1-12)"),
+    row_format: str = Query("json", alias="format", regex="^(json|compact)$", description="'compact': filas como arreglos más 'columns'")
 ):
     """
     Obtiene un extracto detallado de compras por mes y año
@@ -201,18 +257,16 @@ async def get_monthly_extract(
                 detail="El mes debe estar entre 1 y 12"
             )
             
-        extract_data = ExtractService.get_monthly_purchase_extract(year, month)
+        extract_data = ExtractService.stream_monthly_purchase_extract(year, month)
         
         # Obtener nombre del mes
         month_name = datetime(year, month, 1).strftime('%B').capitalize()
         
-        return {
+        return await _stream_extract_response({
             "year": year,
             "month": month,
-            "month_name": month_name,
-            "total_records": len(extract_data),
-            "data": extract_data
-        }
+            "month_name": month_name
+        }, extract_data, compact=row_format == "compact")
     except HTTPException:
         raise
     except Exception as e:
@@ -223,19 +277,18 @@ async def get_monthly_extract(
 
 @router_extracts.get("/daily/{date}")
 async def get_daily_extract(
-    date: date = Path(..., description="Fecha del extracto (YYYY-MM-DD)")
+    date: date = Path(..., description="Fecha del extracto (YYYY-MM-DD)"),
+    row_format: str = Query("json", alias="format", regex="^(json|compact)$", description="'compact': filas como arreglos más 'columns'")
 ):
     """
     Obtiene un extracto detallado de compras para una fecha específica
     """
     try:
-        extract_data = ExtractService.get_daily_purchase_extract(date)
+        extract_data = ExtractService.stream_daily_purchase_extract(date)
         
-        return {
-            "date": date.strftime('%d/%m/%Y'),
-            "total_records": len(extract_data),
-            "data": extract_data
-        }
+        return await _stream_extract_response({
+            "date": date.strftime('%d/%m/%Y')
+        }, extract_data, compact=row_format == "compact")
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -245,7 +298,8 @@ async def get_daily_extract(
 @router_extracts.get("/range")
 async def get_date_range_extract(
     start_date: date = Query(..., description="Fecha inicial (YYYY-MM-DD)"),
-    end_date: date = Query(..., description="Fecha final (YYYY-MM-DD)")
+    end_date: date = Query(..., description="Fecha final (YYYY-MM-DD)"),
+    row_format: str = Query("json", alias="format", regex="^(json|compact)$", description="'compact': filas como arreglos más 'columns'")
 ):
     """
     Obtiene un extracto detallado de compras para un rango de fechas
@@ -257,14 +311,12 @@ async def get_date_range_extract(
                 detail="La fecha inicial debe ser anterior o igual a la fecha final"
             )
             
-        extract_data = ExtractService.get_date_range_purchase_extract(start_date, end_date)
+        extract_data = ExtractService.stream_date_range_purchase_extract(start_date, end_date)
         
-        return {
+        return await _stream_extract_response({
             "start_date": start_date.strftime('%d/%m/%Y'),
-            "end_date": end_date.strftime('%d/%m/%Y'),
-            "total_records": len(extract_data),
-            "data": extract_data
-        }
+            "end_date": end_date.strftime('%d/%m/%Y')
+        }, extract_data, compact=row_format == "compact")
     except HTTPException:
         raise
     except Exception as e:
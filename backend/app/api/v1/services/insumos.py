@@ -135,7 +135,7 @@ async def create_insumo(
 @router_insumos.get("/{insumo_id}")
 async def get_insumo(insumo_id: int):
     """Obtener un insumo por su ID"""
-    insumo = InsumoService.get_insumo_by_id(insumo_id)
+    insumo = await InsumoService.get_insumo_by_id_async(insumo_id)
     
     if not insumo:
         raise HTTPException(
@@ -153,7 +153,7 @@ async def get_insumos(
     low_stock_only: bool = False
 ):
     """Obtener lista de insumos con filtros"""
-    insumos = InsumoService.get_insumos(
+    insumos = await InsumoService.get_insumos_async(
         search=search,
         low_stock_only=low_stock_only
     )
@@ -0,0 +1,174 @@
+from fastapi import APIRouter, HTTPException, Depends, Query
+from database.db import get_pool_stats, get_retry_stats
+from database.async_db import get_async_pool_stats
+from database.instrumentation import get_query_stats, get_endpoint_stats, get_slow_queries, reset_query_stats, SLOW_QUERY_MS
+from api.v1.crud_users.router_users import get_current_superuser
+from database.idempotency import get_idempotency_stats
+from logging_config import get_logging_stats
+from models.catalog import product_catalog, recipe_cache
+from models.consumption_queue import consumption_worker, get_pending_consumption_stats
+from models.insumo_ledger import get_ledger_stats, ledger_checkpointer
+from models.stock_engine import stock_engine
+from models.stock_stream import stock_broadcaster
+from starlette.concurrency import run_in_threadpool
+
+# Router para los endpoints de monitoreo
+router_monitoring = APIRouter()
+
+@router_monitoring.get("/db/pool")
+async def get_db_pool_stats():
+    """
+    Obtiene las estadísticas del pool de conexiones a la base de datos.
+
+    Incluye:
+    - Conexiones en uso y libres
+    - Solicitudes esperando una conexión
+    - Tiempo de espera promedio y máximo
+    - Conexiones recicladas y verificaciones fallidas
+    - Transacciones reintentadas por deadlock o timeout de bloqueo
+    """
+    try:
+        return {
+            **get_pool_stats(),
+            'async_pool': get_async_pool_stats(),
+            'transaction_retries': get_retry_stats()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener estadísticas del pool: {str(e)}"
+        )
+
+@router_monitoring.get("/db/queries")
+async def get_db_query_stats(
+    limit: int = Query(50, ge=1, le=500, description="Máximo de consultas a devolver"),
+    order_by: str = Query("total_time", regex="^(total_time|count|p95|max)$", description="Criterio de orden"),
+    current_user: dict = Depends(get_current_superuser)
+):
+    """
+    Obtiene las estadísticas de las consultas SQL agrupadas por huella (solo superusuarios).
+
+    Incluye:
+    - Por consulta normalizada: ejecuciones, filas, tiempo total y percentiles p50/p95/p99
+    - Por endpoint: peticiones, consultas por petición (promedio y máximo) y tiempo en base de datos
+    """
+    try:
+        return {
+            'queries': get_query_stats(limit, order_by),
+            'endpoints': get_endpoint_stats()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener estadísticas de consultas: {str(e)}"
+        )
+
+@router_monitoring.get("/db/slow-queries")
+async def get_db_slow_queries(
+    limit: int = Query(50, ge=1, le=500, description="Máximo de consultas a devolver"),
+    current_user: dict = Depends(get_current_superuser)
+):
+    """
+    Obtiene las consultas más recientes que superaron el umbral DB_SLOW_QUERY_MS (solo superusuarios)
+    """
+    try:
+        return {
+            'threshold_ms': SLOW_QUERY_MS,
+            'slow_queries': get_slow_queries(limit)
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener consultas lentas: {str(e)}"
+        )
+
+@router_monitoring.delete("/db/queries")
+async def reset_db_query_stats(current_user: dict = Depends(get_current_superuser)):
+    """
+    Reinicia las estadísticas de consultas y el registro de consultas lentas (solo superusuarios)
+    """
+    reset_query_stats()
+    return {"message": "Estadísticas de consultas reiniciadas"}
+
+@router_monitoring.get("/logging")
+async def get_logging_queue_stats():
+    """
+    Obtiene el estado de la cola del logging: registros pendientes de escribir
+    y registros descartados porque la cola estaba llena (LOG_QUEUE_SIZE).
+    """
+    return get_logging_stats()
+
+@router_monitoring.get("/cache")
+async def get_cache_stats():
+    """
+    Obtiene el estado de las cachés en memoria del proceso: versión cargada,
+    número de elementos, aciertos/fallos y recargas, y el tamaño de la matriz
+    de recetas del motor de stock.
+    """
+    return {
+        'caches': [product_catalog.stats(), recipe_cache.stats()],
+        'stock_engine': stock_engine.stats()
+    }
+
+@router_monitoring.get("/idempotency")
+async def get_idempotency_counters():
+    """
+    Obtiene los contadores de las peticiones idempotentes del proceso: operaciones
+    ejecutadas, respuestas repetidas a reintentos, esperas a una petición en curso,
+    claves reutilizadas con otro cuerpo y esperas agotadas.
+    """
+    return get_idempotency_stats()
+
+@router_monitoring.get("/consumption-queue")
+async def get_consumption_queue_stats():
+    """
+    Obtiene el estado del descuento diferido de insumos (INSUMO_WRITE_BEHIND):
+    filas e insumos pendientes, antigüedad de la fila más antigua y contadores del hilo.
+    """
+    try:
+        pending = await run_in_threadpool(get_pending_consumption_stats)
+        if pending is None:
+            raise Exception("No se pudo leer la cola de consumos pendientes")
+        return {
+            **pending,
+            'worker': consumption_worker.stats()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener la cola de consumos: {str(e)}"
+        )
+
+@router_monitoring.get("/insumo-ledger")
+async def get_insumo_ledger_stats():
+    """
+    Obtiene el estado del libro de movimientos de insumos: movimientos anotados,
+    último punto de control, movimientos que se suman desde él y contadores del hilo.
+    """
+    try:
+        ledger = await run_in_threadpool(get_ledger_stats)
+        if ledger is None:
+            raise Exception("No se pudo leer el libro de movimientos")
+        return {
+            **ledger,
+            'checkpointer': ledger_checkpointer.stats()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener el libro de movimientos: {str(e)}"
+        )
+
+@router_monitoring.get("/stock-stream")
+async def get_stock_stream_stats():
+    """
+    Obtiene el estado del stream de cambios de stock: terminales conectadas,
+    secuencia actual, eventos guardados para reanudar y contadores del hilo.
+    """
+    try:
+        return stock_broadcaster.stats()
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener el stream de stock: {str(e)}"
+        )
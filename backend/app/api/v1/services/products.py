@@ -3,9 +3,11 @@ from typing import  Optional
 from api.v1.auth_service.login import get_current_active_user
 from database.db import execute_query
 from models.product_service import ProductService
+from models.catalog import product_catalog, recipe_cache
+from models.product_availability import refresh_product_availability
 from schemas import schemas
 import pymysql
-from database.db import get_db_connection
+from database.db import get_db_connection, bulk_insert
 
 # Crear rutas para productos
 router_products = APIRouter()
@@ -107,22 +109,16 @@ async def create_product(
                     detail="Error al crear el producto: no se pudo obtener el ID"
                 )
             
-            # Insertar los ingredientes de la receta
-            inserted_count = 0
-            for ingredient in ingredients:
-                insumo_id = ingredient.get('insumo_id')
-                cantidad = ingredient.get('cantidad')
-                
-                if not insumo_id or not cantidad:
-                    continue
-                
-                recipe_query = """
-                INSERT INTO product_recipes (product_id, insumo_id, cantidad)
-                VALUES (%s, %s, %s)
-                """
-                
-                cursor.execute(recipe_query, (product_id, insumo_id, cantidad))
-                inserted_count += 1
+            # Insertar los ingredientes de la receta en un solo INSERT
+            recipe_rows = [
+                (product_id, ingredient.get('insumo_id'), ingredient.get('cantidad'))
+                for ingredient in ingredients
+                if ingredient.get('insumo_id') and ingredient.get('cantidad')
+            ]
+            inserted_ids = bulk_insert(
+                'product_recipes', ['product_id', 'insumo_id', 'cantidad'], recipe_rows, cursor=cursor
+            )
+            inserted_count = len(inserted_ids)
             
             # Verificar que se insertaron todos los ingredientes
             if inserted_count != len(ingredients):
@@ -134,6 +130,9 @@ async def create_product(
             
             # Confirmar la transacción
             connection.commit()
+            product_catalog.invalidate()
+            recipe_cache.invalidate()
+            refresh_product_availability(product_ids=[product_id])
             
             # Retornar el producto creado con su ID
             return {
@@ -169,7 +168,7 @@ async def create_product(
 @router_products.get("/{product_id}")
 async def get_product(product_id: int):
     """Obtener un producto por su ID"""
-    product = ProductService.get_product_by_id(product_id)
+    product = await ProductService.get_product_by_id_async(product_id)
     
     if not product:
         raise HTTPException(
@@ -188,7 +187,7 @@ async def get_products(
     offset: int = 0
 ):
     """Obtener lista de productos con filtros"""
-    products = ProductService.get_products(
+    products = await ProductService.get_products_async(
         category_id=category_id,
         search=search,
         low_stock_only=low_stock_only,
@@ -299,22 +298,16 @@ async def update_product(
             delete_query = "DELETE FROM product_recipes WHERE product_id = %s"
             cursor.execute(delete_query, (product_id,))
             
-            # Insertar los nuevos ingredientes de la receta
-            inserted_count = 0
-            for ingredient in ingredients:
-                insumo_id = ingredient.get('insumo_id')
-                cantidad = ingredient.get('cantidad')
-                
-                if not insumo_id or not cantidad:
-                    continue
-                
-                recipe_query = """
-                INSERT INTO product_recipes (product_id, insumo_id, cantidad)
-                VALUES (%s, %s, %s)
-                """
-                
-                cursor.execute(recipe_query, (product_id, insumo_id, cantidad))
-                inserted_count += 1
+            # Insertar los nuevos ingredientes de la receta en un solo INSERT
+            recipe_rows = [
+                (product_id, ingredient.get('insumo_id'), ingredient.get('cantidad'))
+                for ingredient in ingredients
+                if ingredient.get('insumo_id') and ingredient.get('cantidad')
+            ]
+            inserted_ids = bulk_insert(
+                'product_recipes', ['product_id', 'insumo_id', 'cantidad'], recipe_rows, cursor=cursor
+            )
+            inserted_count = len(inserted_ids)
             
             # Verificar que se insertaron todos los ingredientes
             if inserted_count != len(ingredients):
@@ -326,6 +319,9 @@ async def update_product(
             
             # Confirmar la transacción
             connection.commit()
+            product_catalog.invalidate()
+            recipe_cache.invalidate()
+            refresh_product_availability(product_ids=[product_id])
             
             # Retornar el producto actualizado
             return {
@@ -1,224 +1,568 @@
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional
 from datetime import datetime, date, time, timedelta
 from decimal import Decimal
-from database.db  import execute_query, execute_insert_and_get_id, get_db_connection
+from database.db  import execute_query, execute_insert_and_get_id, get_db_connection, bulk_insert, transaction, run_transaction_with_retry
+from models.catalog import product_catalog, recipe_cache
+from models.consumption_queue import INSUMO_WRITE_BEHIND
+from models.insumo_ledger import (
+    MOVEMENT_CANCELLATION, MOVEMENT_SALE, consumption_between, consumption_movements, record_movements
+)
+from models.product_availability import refresh_product_availability
+from models.stock_engine import stock_engine
 import pymysql
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Modo reserva: bloquear (SELECT ... FOR UPDATE) los insumos de la venta antes de
+# comprobar su disponibilidad, para que dos ventas simultáneas no vendan el mismo
+# insumo. Con 'false' la comprobación es una lectura sin bloqueo (comportamiento anterior).
+INSUMO_RESERVATION = os.getenv('INSUMO_RESERVATION', 'true').lower() == 'true'
+
+# Columnas de purchases y purchase_details en el orden de _purchase_row y _detail_rows
+PURCHASE_COLUMNS = [
+    'invoice_number', 'invoice_date', 'invoice_time', 'client_name',
+    'seller_username', 'client_phone', 'has_delivery',
+    'delivery_address', 'delivery_person', 'delivery_fee',
+    'subtotal_products', 'total_amount', 'amount_paid',
+    'change_returned', 'payment_method', 'payment_reference'
+]
+PURCHASE_DETAIL_COLUMNS = [
+    'purchase_id', 'product_id', 'category_id', 'product_name', 'product_variant',
+    'quantity', 'unit_price', 'subtotal'
+]
+
+# Compras por transacción en la carga masiva (create_purchases_bulk)
+BULK_BATCH_SIZE = int(os.getenv('PURCHASE_BULK_BATCH_SIZE', 50))
 
 class PurchaseService:
     """Servicio para gestionar las compras/facturas del sistema"""
     
     @staticmethod
-    def create_purchase(purchase_data: Dict) -> Dict:
+    def create_purchase(purchase_data: Dict, reserve: Optional[bool] = None) -> Dict:
         """
         Crea una nueva compra/factura con todos sus detalles
         
+        Si la transacción se aborta por un deadlock o un timeout de bloqueo se
+        reintenta completa (ver run_transaction_with_retry).
+        
         Args:
             purchase_data: Diccionario con todos los datos de la compra
+            reserve: Bloquear los insumos antes de validarlos (por defecto INSUMO_RESERVATION)
             
         Returns:
             Dict con la información de la compra creada
         """
-        connection = get_db_connection()
-        if not connection:
-            raise Exception("No se pudo establecer conexión con la base de datos")
-        
-        cursor = None
-        try:
+        if reserve is None:
+            reserve = INSUMO_RESERVATION
+        return run_transaction_with_retry(lambda: PurchaseService._create_purchase(purchase_data, reserve))
+    
+    @staticmethod
+    def _create_purchase(purchase_data: Dict, reserve: bool) -> Dict:
+        """Un intento de create_purchase en su propia transacción"""
+        with transaction() as connection:
             cursor = connection.cursor(pymysql.cursors.DictCursor)
-            
-            # PRIMERO: Validar disponibilidad de insumos para todos los productos
-            if 'products' in purchase_data and purchase_data['products']:
-                print(f"Validando disponibilidad de insumos para {len(purchase_data['products'])} productos...")
-                validation_result = PurchaseService._validate_insumos_availability(
-                    cursor, 
-                    purchase_data['products']
-                )
+            try:
+                # Resolver todos los productos de la compra en una sola consulta;
+                # el mapa se reutiliza en la validación y en la actualización de insumos
+                resolved_products = {}
                 
-                if not validation_result['is_valid']:
-                    error_messages = []
-                    for error in validation_result['errors']:
-                        error_messages.append(
-                            f"Producto '{error['product_name']}': Falta {error['insumo_name']} "
-                            f"(necesario: {error['required']:.2f} {error['unit']}, "
-                            f"disponible: {error['available']:.2f} {error['unit']})"
-                        )
-                    
-                    error_text = "No hay suficientes insumos para completar la venta:\n" + "\n".join(error_messages)
-                    print(f"ERROR DE VALIDACIÓN: {error_text}")
-                    raise ValueError(error_text)
+                # PRIMERO: Validar disponibilidad de insumos para todos los productos
+                if 'products' in purchase_data and purchase_data['products']:
+                    resolved_products = PurchaseService._resolve_products(purchase_data['products'])
+                    logger.debug("Validando disponibilidad de insumos para %s productos", len(purchase_data['products']))
+                    # En modo reserva los insumos quedan bloqueados hasta el commit, así
+                    # que la comprobación y el descuento ven las mismas cantidades
+                    validation_result = PurchaseService._validate_insumos_availability(
+                        cursor, 
+                        purchase_data['products'],
+                        resolved_products,
+                        lock=reserve
+                    )
+                
+                    if not validation_result['is_valid']:
+                        error_text = PurchaseService._format_insumo_errors(validation_result['errors'])
+                        logger.warning("Error de validación: %s", error_text)
+                        raise ValueError(error_text)
             
-            # Si la validación pasa, iniciar transacción
-            print("Validación de insumos exitosa, iniciando transacción...")
-            connection.begin()
+                # Si la validación pasa, registrar la compra en la misma transacción
+                logger.debug("Validación de insumos exitosa, registrando compra")
             
-            # Validar que el vendedor existe
-            seller_query = "SELECT id FROM users WHERE username = %s"
-            seller = execute_query(seller_query, (purchase_data['seller_username'],), fetch_one=True)
-            if not seller:
-                raise ValueError(f"El vendedor '{purchase_data['seller_username']}' no existe")
+                # Validar que el vendedor existe (reutiliza la conexión de la transacción)
+                seller_query = "SELECT id FROM users WHERE username = %s"
+                seller = execute_query(seller_query, (purchase_data['seller_username'],), fetch_one=True)
+                if not seller:
+                    raise ValueError(f"El vendedor '{purchase_data['seller_username']}' no existe")
             
-            # Insertar la compra principal
-            purchase_query = """
-            INSERT INTO purchases (
-                invoice_number, invoice_date, invoice_time, client_name, 
-                seller_username, client_phone, has_delivery, 
-                delivery_address, delivery_person, delivery_fee,
-                subtotal_products, total_amount, amount_paid, 
-                change_returned, payment_method, payment_reference
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-            )
-            """
+                # Insertar la compra principal
+                purchase_query = f"""
+                INSERT INTO purchases ({', '.join(PURCHASE_COLUMNS)})
+                VALUES ({', '.join(['%s'] * len(PURCHASE_COLUMNS))})
+                """
+                cursor.execute(purchase_query, PurchaseService._purchase_row(purchase_data))
             
-            # Convertir fecha y hora si vienen como string
-            invoice_date = purchase_data['invoice_date']
-            if isinstance(invoice_date, str):
-                invoice_date = datetime.strptime(invoice_date, '%d/%m/%Y').date()
+                purchase_id = cursor.lastrowid
             
-            invoice_time = purchase_data['invoice_time']
-            if isinstance(invoice_time, str):
-                # Manejar formato con a.m./p.m.
-                invoice_time = invoice_time.replace(' a. m.', ' AM').replace(' p. m.', ' PM')
-                invoice_time = datetime.strptime(invoice_time, '%I:%M:%S %p').time()
+                # Insertar los detalles de los productos en un solo INSERT, con el
+                # producto resuelto y su categoría en el momento de la venta
+                if 'products' in purchase_data and purchase_data['products']:
+                    bulk_insert(
+                        'purchase_details',
+                        PURCHASE_DETAIL_COLUMNS,
+                        PurchaseService._detail_rows(purchase_id, purchase_data['products'], resolved_products),
+                        cursor=cursor
+                    )
+                
+                    # Descontar los insumos de toda la compra con una sola sentencia, o dejarlos
+                    # pendientes en modo diferido (el stock de los productos se calcula desde los insumos)
+                    consumption = PurchaseService._aggregate_consumption(purchase_data['products'], resolved_products)
+                    PurchaseService._record_consumption(cursor, [(purchase_id, consumption)])
             
-            cursor.execute(purchase_query, (
-                purchase_data['invoice_number'],
-                invoice_date,
-                invoice_time,
-                purchase_data['client_name'],
-                purchase_data['seller_username'],
-                purchase_data.get('client_phone'),
-                purchase_data.get('has_delivery', False),
-                purchase_data.get('delivery_address'),
-                purchase_data.get('delivery_person'),
-                purchase_data.get('delivery_fee', 0),
-                purchase_data['subtotal_products'],
-                purchase_data['total_amount'],
-                purchase_data['amount_paid'],
-                purchase_data['change_returned'],
-                purchase_data['payment_method'],
-                purchase_data.get('payment_reference')
-            ))
+                # Retornar la compra creada (el commit se hace al salir de la transacción)
+                return PurchaseService._created_result(purchase_id, purchase_data['invoice_number'])
+            finally:
+                cursor.close()
+    
+    @staticmethod
+    def _created_result(purchase_id: int, invoice_number: str) -> Dict:
+        """Respuesta de create_purchase"""
+        return {
+            'purchase_id': purchase_id,
+            'invoice_number': invoice_number,
+            'status': 'success',
+            'message': 'Compra registrada exitosamente'
+        }
+    
+    @staticmethod
+    def find_created_purchase(invoice_number: str) -> Optional[Dict]:
+        """
+        Respuesta de create_purchase para una factura ya registrada
+        
+        La usa la idempotencia de POST /purchases al recuperar una clave abandonada:
+        si la compra ya existe se devuelve en lugar de registrarla otra vez.
+        
+        Args:
+            invoice_number: Número de factura
             
-            purchase_id = cursor.lastrowid
+        Returns:
+            Dict como el de create_purchase, o None si la factura no existe
             
-            # Insertar los detalles de los productos
-            if 'products' in purchase_data and purchase_data['products']:
-                detail_query = """
-                INSERT INTO purchase_details (
-                    purchase_id, product_name, product_variant, 
-                    quantity, unit_price, subtotal
-                ) VALUES (%s, %s, %s, %s, %s, %s)
-                """
-                
-                for product in purchase_data['products']:
-                    cursor.execute(detail_query, (
-                        purchase_id,
-                        product['product_name'],
-                        product.get('product_variant'),
-                        product['quantity'],
-                        product['unit_price'],
-                        product['subtotal']
+        Raises:
+            Exception: si no se pudo consultar la factura
+        """
+        row = execute_query(
+            "SELECT id FROM purchases WHERE invoice_number = %s",
+            (invoice_number,), fetch_all=True, compact=True
+        )
+        if row is None:
+            raise Exception(f"No se pudo consultar la factura {invoice_number}")
+        if not row:
+            return None
+        return PurchaseService._created_result(row[0][0], invoice_number)
+    
+    @staticmethod
+    def create_purchases_bulk(purchases: Iterable[tuple], batch_size: Optional[int] = None,
+                              reserve: Optional[bool] = None) -> Iterator[Dict]:
+        """
+        Registra muchas compras, por ejemplo las acumuladas por un punto de venta sin conexión
+        
+        Las compras se procesan en lotes de batch_size, cada lote en una sola
+        transacción: una consulta para las facturas ya registradas, una para los
+        vendedores, los productos de todo el lote resueltos de una vez, los insumos
+        del lote bloqueados y leídos con una consulta, un INSERT de compras, uno de
+        detalles y un UPDATE de insumos. Las compras se validan en el orden
+        recibido contra lo que dejan disponible las anteriores del mismo lote, igual
+        que si se enviaran una a una; una compra rechazada no afecta a las demás.
+        
+        Args:
+            purchases: Pares (posición, datos de la compra) en el orden recibido
+            batch_size: Compras por transacción (por defecto PURCHASE_BULK_BATCH_SIZE)
+            reserve: Bloquear los insumos antes de validarlos (por defecto INSUMO_RESERVATION)
+            
+        Returns:
+            Generador con un resultado por compra a medida que se confirma cada lote:
+            {'index', 'invoice_number', 'status', 'purchase_id', 'message'}, con status
+            'created', 'duplicate' (ya registrada o repetida en el envío), 'rejected'
+            (vendedor, fecha o insumos inválidos) o 'error' (falló la transacción del lote)
+        """
+        batch_size = batch_size or BULK_BATCH_SIZE
+        if reserve is None:
+            reserve = INSUMO_RESERVATION
+        seen = set()
+        batch = []
+        for item in purchases:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield from PurchaseService._ingest_batch(batch, seen, reserve)
+                batch = []
+        if batch:
+            yield from PurchaseService._ingest_batch(batch, seen, reserve)
+    
+    @staticmethod
+    def _bulk_result(index: int, purchase_data: Dict, status: str, message: str,
+                     purchase_id: Optional[int] = None) -> Dict:
+        """Resultado de una compra de la carga masiva"""
+        return {
+            'index': index,
+            'invoice_number': purchase_data.get('invoice_number'),
+            'status': status,
+            'purchase_id': purchase_id,
+            'message': message
+        }
+    
+    @staticmethod
+    def _ingest_batch(batch: List[tuple], seen: set, reserve: bool) -> List[Dict]:
+        """
+        Registrar un lote de create_purchases_bulk; devuelve los resultados en orden
+        
+        seen guarda las facturas de lotes anteriores con resultado definitivo. Una
+        factura de un lote que falló no se añade: otra copia en el mismo envío se
+        intenta de nuevo en lugar de darse por registrada.
+        """
+        results = {}
+        pending = []
+        repeated = []
+        batch_invoices = set()
+        for index, purchase_data in batch:
+            invoice_number = purchase_data['invoice_number']
+            if invoice_number in seen:
+                results[index] = PurchaseService._bulk_result(
+                    index, purchase_data, 'duplicate', 'Factura repetida en el envío')
+            elif invoice_number in batch_invoices:
+                repeated.append((index, purchase_data))
+            else:
+                batch_invoices.add(invoice_number)
+                pending.append((index, purchase_data))
+        
+        if pending:
+            for attempt in range(2):
+                try:
+                    results.update(run_transaction_with_retry(
+                        lambda: PurchaseService._ingest_batch_transaction(pending, reserve)
                     ))
+                    break
+                except Exception as e:
+                    if attempt == 0 and isinstance(e, pymysql.err.IntegrityError) and e.args[0] == 1062:
+                        # Otra petición registró una de las facturas entre la comprobación y
+                        # el INSERT: al repetir el lote aparece como duplicada
+                        logger.info("Factura duplicada concurrente en la carga masiva, se repite el lote")
+                        continue
+                    logger.error("Error registrando un lote de %s compras: %s", len(pending), e)
+                    for index, purchase_data in pending + repeated:
+                        results[index] = PurchaseService._bulk_result(
+                            index, purchase_data, 'error', f"Error al registrar el lote: {str(e)}")
+                    break
+        
+        for index, purchase_data in repeated:
+            if index not in results:
+                results[index] = PurchaseService._bulk_result(
+                    index, purchase_data, 'duplicate', 'Factura repetida en el envío')
+        for index, purchase_data in pending:
+            if results[index]['status'] != 'error':
+                seen.add(purchase_data['invoice_number'])
+        
+        return [results[index] for index, _ in batch]
+    
+    @staticmethod
+    def _ingest_batch_transaction(pending: List[tuple], reserve: bool) -> Dict[int, Dict]:
+        """Un intento de registrar un lote en su propia transacción"""
+        results = {}
+        with transaction() as connection:
+            cursor = connection.cursor(pymysql.cursors.DictCursor)
+            try:
+                # Facturas ya registradas (reintentos del punto de venta)
+                invoice_numbers = [purchase_data['invoice_number'] for _, purchase_data in pending]
+                placeholders = ", ".join(["%s"] * len(invoice_numbers))
+                cursor.execute(
+                    f"SELECT id, invoice_number FROM purchases WHERE invoice_number IN ({placeholders})",
+                    invoice_numbers
+                )
+                existing = {row['invoice_number']: row['id'] for row in cursor.fetchall()}
+                
+                # Vendedores del lote en una sola consulta
+                sellers = sorted({purchase_data['seller_username'] for _, purchase_data in pending})
+                placeholders = ", ".join(["%s"] * len(sellers))
+                cursor.execute(f"SELECT username FROM users WHERE username IN ({placeholders})", sellers)
+                known_sellers = {row['username'] for row in cursor.fetchall()}
+                
+                # Productos de todo el lote resueltos de una vez (catálogo en memoria)
+                lines = [product for _, purchase_data in pending for product in purchase_data.get('products') or []]
+                resolved_products = PurchaseService._resolve_products(lines) if lines else {}
+                
+                candidates = []
+                for index, purchase_data in pending:
+                    if purchase_data['invoice_number'] in existing:
+                        results[index] = PurchaseService._bulk_result(
+                            index, purchase_data, 'duplicate', 'La factura ya estaba registrada',
+                            existing[purchase_data['invoice_number']])
+                        continue
+                    if purchase_data['seller_username'] not in known_sellers:
+                        results[index] = PurchaseService._bulk_result(
+                            index, purchase_data, 'rejected',
+                            f"El vendedor '{purchase_data['seller_username']}' no existe")
+                        continue
+                    try:
+                        row = PurchaseService._purchase_row(purchase_data)
+                    except ValueError as e:
+                        results[index] = PurchaseService._bulk_result(
+                            index, purchase_data, 'rejected', f"Fecha u hora inválida: {str(e)}")
+                        continue
+                    needs, errors = PurchaseService._collect_insumo_needs(
+                        purchase_data.get('products') or [], resolved_products)
+                    candidates.append((index, purchase_data, row, needs, errors))
+                
+                # Insumos de todo el lote bloqueados (modo reserva) y leídos con una consulta
+                insumo_ids = set()
+                for _, _, _, needs, _ in candidates:
+                    insumo_ids.update(needs)
+                availability = PurchaseService._fetch_insumo_availability(cursor, insumo_ids, lock=reserve)
+                
+                # Validar en orden: cada compra aceptada reduce lo disponible para las siguientes
+                accepted = []
+                for index, purchase_data, row, needs, errors in candidates:
+                    errors = errors + PurchaseService._check_insumo_needs(needs, availability)
+                    if errors:
+                        results[index] = PurchaseService._bulk_result(
+                            index, purchase_data, 'rejected', PurchaseService._format_insumo_errors(errors))
+                        continue
+                    for insumo_id, data in needs.items():
+                        if insumo_id in availability:
+                            availability[insumo_id]['disponible'] -= data['necesario']
+                    accepted.append((index, purchase_data, row))
+                
+                if accepted:
+                    purchase_ids = bulk_insert('purchases', PURCHASE_COLUMNS, [row for _, _, row in accepted], cursor=cursor)
                     
-                    # Actualizar el stock si el producto existe en la tabla products
-                    PurchaseService._update_product_stock(
-                        cursor, 
-                        product['product_name'], 
-                        product.get('product_variant'),
-                        product['quantity']
-                    )
-            
-            connection.commit()
+                    detail_rows = []
+                    consumptions = []
+                    for (index, purchase_data, _), purchase_id in zip(accepted, purchase_ids):
+                        products = purchase_data.get('products') or []
+                        detail_rows.extend(PurchaseService._detail_rows(purchase_id, products, resolved_products))
+                        consumptions.append(
+                            (purchase_id, PurchaseService._aggregate_consumption(products, resolved_products))
+                        )
+                        results[index] = PurchaseService._bulk_result(
+                            index, purchase_data, 'created', 'Compra registrada exitosamente', purchase_id)
+                    
+                    bulk_insert('purchase_details', PURCHASE_DETAIL_COLUMNS, detail_rows, cursor=cursor)
+                    PurchaseService._record_consumption(cursor, consumptions)
+                
+                logger.info("Carga masiva: lote de %s compras, %s registradas", len(pending), len(accepted))
+                return results
+            finally:
+                cursor.close()
+    
+    @staticmethod
+    def _purchase_row(purchase_data: Dict) -> tuple:
+        """Valores de una compra en el orden de PURCHASE_COLUMNS"""
+        # Convertir fecha y hora si vienen como string
+        invoice_date = purchase_data['invoice_date']
+        if isinstance(invoice_date, str):
+            invoice_date = datetime.strptime(invoice_date, '%d/%m/%Y').date()
+        
+        invoice_time = purchase_data['invoice_time']
+        if isinstance(invoice_time, str):
+            # Manejar formato con a.m./p.m.
+            invoice_time = invoice_time.replace(' a. m.', ' AM').replace(' p. m.', ' PM')
+            invoice_time = datetime.strptime(invoice_time, '%I:%M:%S %p').time()
+        
+        return (
+            purchase_data['invoice_number'],
+            invoice_date,
+            invoice_time,
+            purchase_data['client_name'],
+            purchase_data['seller_username'],
+            purchase_data.get('client_phone'),
+            purchase_data.get('has_delivery', False),
+            purchase_data.get('delivery_address'),
+            purchase_data.get('delivery_person'),
+            purchase_data.get('delivery_fee', 0),
+            purchase_data['subtotal_products'],
+            purchase_data['total_amount'],
+            purchase_data['amount_paid'],
+            purchase_data['change_returned'],
+            purchase_data['payment_method'],
+            purchase_data.get('payment_reference')
+        )
+    
+    @staticmethod
+    def _detail_rows(purchase_id: int, products: List[Dict], resolved_products: Dict) -> List[tuple]:
+        """Filas de purchase_details (en el orden de PURCHASE_DETAIL_COLUMNS) de una compra"""
+        rows = []
+        for product in products:
+            product_id = resolved_products.get(
+                PurchaseService._product_key(product['product_name'], product.get('product_variant'))
+            )
+            catalog_product = product_catalog.get(product_id) if product_id is not None else None
+            rows.append((
+                purchase_id,
+                product_id,
+                catalog_product.category_id if catalog_product else None,
+                product['product_name'],
+                product.get('product_variant'),
+                product['quantity'],
+                product['unit_price'],
+                product['subtotal']
+            ))
+        return rows
+    
+    @staticmethod
+    def _format_insumo_errors(errors: List[Dict]) -> str:
+        """Mensaje de error de una venta sin insumos suficientes"""
+        error_messages = []
+        for error in errors:
+            error_messages.append(
+                f"Producto '{error['product_name']}': Falta {error['insumo_name']} "
+                f"(necesario: {error['required']:.2f} {error['unit']}, "
+                f"disponible: {error['available']:.2f} {error['unit']})"
+            )
+        return "No hay suficientes insumos para completar la venta:\n" + "\n".join(error_messages)
+    
+    @staticmethod
+    def validate_purchase_insumos(products: List[Dict]) -> Dict:
+        """
+        Valida la disponibilidad de insumos para una compra sin registrarla
+        
+        Usa el motor de stock: el consumo del carrito se calcula sobre la matriz
+        de recetas en memoria y se compara con el vector de insumos (una
+        consulta). La venta real vuelve a validar con los insumos bloqueados.
+        
+        Args:
+            products: Lista de productos a vender
             
-            # Retornar la compra creada
-            return {
-                'purchase_id': purchase_id,
-                'invoice_number': purchase_data['invoice_number'],
-                'status': 'success',
-                'message': 'Compra registrada exitosamente'
-            }
+        Returns:
+            Dict con 'is_valid' (bool) y 'errors' (lista de errores, con el mismo
+            formato que _validate_insumos_availability)
+        """
+        resolved_products = PurchaseService._resolve_products(products)
+        
+        errors = []
+        cart = {}
+        for product in products:
+            product_id = resolved_products.get(
+                PurchaseService._product_key(product['product_name'], product.get('product_variant'))
+            )
+            if product_id is None:
+                errors.append({
+                    'product_name': product['product_name'],
+                    'insumo_name': 'Producto no encontrado',
+                    'unit': 'N/A',
+                    'required': 0,
+                    'available': 0
+                })
+                continue
+            cart[product_id] = cart.get(product_id, 0.0) + float(product['quantity'])
+        
+        snapshot = stock_engine.snapshot()
+        shortages = snapshot.shortages(cart)
+        if shortages:
+            # Cada insumo faltante se atribuye a la primera línea que lo usa
+            for product in products:
+                product_id = resolved_products.get(
+                    PurchaseService._product_key(product['product_name'], product.get('product_variant'))
+                )
+                recipe = recipe_cache.get(product_id) if product_id is not None else None
+                for insumo_id in (recipe.insumo_ids if recipe else ()):
+                    if insumo_id not in shortages:
+                        continue
+                    required, available = shortages.pop(insumo_id)
+                    nombre, unidad = snapshot.insumos.get(insumo_id, (None, None))[:2]
+                    errors.append({
+                        'insumo_id': insumo_id,
+                        'insumo_name': nombre,
+                        'unit': unidad,
+                        'required': required,
+                        'available': available,
+                        'product_name': product['product_name']
+                    })
+        
+        if errors:
+            logger.info("Validación de insumos fallida: %s errores", len(errors))
+        return {
+            'is_valid': len(errors) == 0,
+            'errors': errors
+        }
+    
+    @staticmethod
+    def _product_key(product_name: str, variant: Optional[str]) -> tuple:
+        """Clave de una línea de la compra en el mapa de productos resueltos"""
+        return (product_name, variant or None)
+    
+    @staticmethod
+    def _resolve_products(products: List[Dict]) -> Dict[tuple, Optional[int]]:
+        """
+        Resuelve todos los productos de una compra contra el catálogo en memoria
+        (sin consultas mientras el catálogo esté al día)
+        
+        Args:
+            products: Líneas de la compra (product_name, product_variant)
             
-        except Exception as e:
-            if connection:
-                connection.rollback()
-            raise e
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+        Returns:
+            Dict {(product_name, product_variant): product_id o None si no se encontró}
+        """
+        resolved = product_catalog.resolve_many(products)
+        if resolved is None:
+            raise Exception("No se pudo cargar el catálogo de productos")
+        
+        for (product_name, variant), product_id in resolved.items():
+            if product_id is None:
+                logger.warning("No se encontró el producto '%s' con variante '%s'", product_name, variant or 'NULL')
+        return resolved
     
     @staticmethod
-    def _validate_insumos_availability(cursor, products: List[Dict]) -> Dict:
+    def _validate_insumos_availability(cursor, products: List[Dict], resolved_products: Optional[Dict] = None,
+                                       lock: bool = False) -> Dict:
         """
         Valida que haya suficientes insumos disponibles para todos los productos
         
         Args:
             cursor: Cursor de la base de datos
             products: Lista de productos a vender
+            resolved_products: Mapa de _resolve_products (se calcula si no se proporciona)
+            lock: Bloquear las filas de los insumos (FOR UPDATE) hasta el fin de la transacción
             
         Returns:
             Dict con 'is_valid' (bool) y 'errors' (lista de errores),
         """
+        if resolved_products is None:
+            resolved_products = PurchaseService._resolve_products(products)
+        
+        insumos_needed, errors = PurchaseService._collect_insumo_needs(products, resolved_products)
+        availability = PurchaseService._fetch_insumo_availability(cursor, insumos_needed, lock)
+        errors.extend(PurchaseService._check_insumo_needs(insumos_needed, availability))
+        
+        if errors:
+            logger.info("Validación de insumos fallida: %s errores", len(errors))
+            if logger.isEnabledFor(logging.DEBUG):
+                for error in errors:
+                    logger.debug("- %s: Falta %s (necesario: %.2f %s, disponible: %.2f %s)",
+                                 error['product_name'], error['insumo_name'], error['required'], error['unit'],
+                                 error['available'], error['unit'])
+        
+        return {
+            'is_valid': len(errors) == 0,
+            'errors': errors
+        }
+    
+    @staticmethod
+    def _collect_insumo_needs(products: List[Dict], resolved_products: Dict) -> tuple:
+        """
+        Necesidad total por insumo de las líneas de una venta (en memoria, sin consultas)
+        
+        Returns:
+            Tupla ({insumo_id: {'necesario', 'product_name'}}, errores de productos no encontrados)
+        """
         errors = []
         insumos_needed = {}  # Diccionario para acumular necesidades totales por insumo
         
-        # Primero, calcular cuánto se necesita de cada insumo
         for product in products:
-            db_product = None
-            
-            # Buscar el producto en la base de datos - Método 1: Búsqueda exacta
-            if product.get('product_variant'):
-                query = """
-                SELECT id, nombre_producto, variante FROM products 
-                WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE
-                """
-                params = (product['product_name'], product['product_variant'])
-                cursor.execute(query, params)
-                db_product = cursor.fetchone()
-            else:
-                # Buscar sin variante
-                query = """
-                SELECT id, nombre_producto, variante FROM products 
-                WHERE nombre_producto = %s AND (variante IS NULL OR variante = '') AND is_active = TRUE
-                """
-                params = (product['product_name'],)
-                cursor.execute(query, params)
-                db_product = cursor.fetchone()
-            
-            # Método 2: Si no encontró, intentar separar por " - " 
-            if not db_product and ' - ' in product['product_name']:
-                parts = product['product_name'].split(' - ', 1)
-                if len(parts) == 2:
-                    nombre_base = parts[0].strip()
-                    variante_base = parts[1].strip()
-                    
-                    query = """
-                    SELECT id, nombre_producto, variante FROM products 
-                    WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE
-                    """
-                    cursor.execute(query, (nombre_base, variante_base))
-                    db_product = cursor.fetchone()
-                    
-                    if db_product:
-                        print(f"Producto encontrado separando '{product['product_name']}' en '{nombre_base}' + '{variante_base}'")
-            
-            # Método 3: Búsqueda más flexible usando LIKE
-            if not db_product:
-                query = """
-                SELECT id, nombre_producto, variante FROM products 
-                WHERE CONCAT(nombre_producto, IFNULL(CONCAT(' - ', variante), '')) = %s AND is_active = TRUE
-                """
-                cursor.execute(query, (product['product_name'],))
-                db_product = cursor.fetchone()
-                
-                if db_product:
-                    print(f"Producto encontrado con búsqueda flexible: {db_product}")
+            product_id = resolved_products.get(
+                PurchaseService._product_key(product['product_name'], product.get('product_variant'))
+            )
             
-            if not db_product:
+            if product_id is None:
                 # Si no encuentra el producto después de todos los intentos, agregar error
-                print(f"ERROR: No se encontró el producto '{product['product_name']}' con variante '{product.get('product_variant', 'NULL')}'")
                 errors.append({
                     'product_name': product['product_name'],
                     'insumo_name': 'Producto no encontrado',
@@ -228,130 +572,101 @@ class PurchaseService:
                 })
                 continue
                 
-            print(f"Producto encontrado: ID={db_product['id']}, nombre='{db_product['nombre_producto']}', variante='{db_product.get('variante', 'NULL')}')")
-                
-            # Obtener la receta del producto
-            recipe_query = """
-            SELECT pr.insumo_id, pr.cantidad, i.nombre_insumo, i.unidad,
-                   i.cantidad_unitaria, i.cantidad_utilizada,
-                   (i.cantidad_unitaria - i.cantidad_utilizada) as disponible
-            FROM product_recipes pr
-            JOIN insumos i ON pr.insumo_id = i.id
-            WHERE pr.product_id = %s
-            """
-            cursor.execute(recipe_query, (db_product['id'],))
-            recipe_items = cursor.fetchall()
+            # Receta precompilada (caché en memoria, sin consultas)
+            recipe = recipe_cache.get(product_id)
             
             # Si el producto no tiene receta, no necesita insumos
-            if not recipe_items:
-                print(f"Advertencia: El producto '{product['product_name']}' no tiene receta definida")
+            if not recipe:
+                logger.warning("El producto '%s' no tiene receta definida", product['product_name'])
                 continue
                 
             # Acumular necesidades por insumo
-            for item in recipe_items:
-                insumo_id = item['insumo_id']
-                needed = float(item['cantidad']) * float(product['quantity'])
-                disponible = float(item['disponible'])
-                
+            for insumo_id, needed in recipe.consumption(float(product['quantity'])).items():
                 if insumo_id not in insumos_needed:
                     insumos_needed[insumo_id] = {
-                        'nombre': item['nombre_insumo'],
-                        'unidad': item['unidad'],
-                        'disponible': disponible,
                         'necesario': 0,
                         'product_name': product['product_name']
                     }
                 
                 insumos_needed[insumo_id]['necesario'] += needed
         
-        # Verificar si hay suficientes insumos
-        for insumo_id, data in insumos_needed.items():
-            if data['necesario'] > data['disponible']:
-                errors.append({
-                    'insumo_id': insumo_id,
-                    'insumo_name': data['nombre'],
-                    'unit': data['unidad'],
-                    'required': data['necesario'],
-                    'available': data['disponible'],
-                    'product_name': data['product_name']
-                })
-        
-        # Debug para verificar
-        print(f"Validación de insumos: {'EXITOSA' if len(errors) == 0 else 'FALLIDA'}")
-        if errors:
-            print(f"Errores encontrados: {len(errors)}")
-            for error in errors:
-                print(f"- {error['product_name']}: Falta {error['insumo_name']} (necesario: {error['required']:.2f} {error['unit']}, disponible: {error['available']:.2f} {error['unit']})")
-        
-        return {
-            'is_valid': len(errors) == 0,
-            'errors': errors
-        }
+        return insumos_needed, errors
     
     @staticmethod
-    def _update_product_stock(cursor, product_name: str, variant: Optional[str], quantity: int):
+    def _fetch_insumo_availability(cursor, insumo_ids, lock: bool = False) -> Dict[int, Dict]:
         """
-        Actualiza solo los insumos después de una venta.
-        El stock del producto se calcula dinámicamente desde los insumos disponibles.
+        Disponibilidad actual de varios insumos en una sola consulta
         
         Args:
-            cursor: Cursor de la base de datos
-            product_name: Nombre del producto
-            variant: Variante del producto (opcional)
-            quantity: Cantidad vendida
+            cursor: Cursor (DictCursor) de la transacción
+            insumo_ids: Ids de los insumos
+            lock: Bloquear las filas (FOR UPDATE) hasta el fin de la transacción
+            
+        Returns:
+            Dict {insumo_id: {'nombre', 'unidad', 'disponible'}}
         """
-        product = None
+        availability = {}
+        if not insumo_ids:
+            return availability
         
-        # Buscar el producto - Método 1: Búsqueda exacta
-        if variant:
-            query = """
-            SELECT id, stock_quantity FROM products 
-            WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE
-            """
-            cursor.execute(query, (product_name, variant))
-            product = cursor.fetchone()
-        else:
-            query = """
-            SELECT id, stock_quantity FROM products 
-            WHERE nombre_producto = %s AND (variante IS NULL OR variante = '') AND is_active = TRUE
-            """
-            cursor.execute(query, (product_name,))
-            product = cursor.fetchone()
-        
-        # Método 2: Si no encontró, intentar separar por " - " 
-        if not product and ' - ' in product_name:
-            parts = product_name.split(' - ', 1)
-            if len(parts) == 2:
-                nombre_base = parts[0].strip()
-                variante_base = parts[1].strip()
-                
-                query = """
-                SELECT id, stock_quantity FROM products 
-                WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE
-                """
-                cursor.execute(query, (nombre_base, variante_base))
-                product = cursor.fetchone()
-        
-        # Método 3: Búsqueda más flexible
-        if not product:
-            query = """
-            SELECT id, stock_quantity FROM products 
-            WHERE CONCAT(nombre_producto, IFNULL(CONCAT(' - ', variante), '')) = %s AND is_active = TRUE
-            """
-            cursor.execute(query, (product_name,))
-            product = cursor.fetchone()
+        placeholders = ", ".join(["%s"] * len(insumo_ids))
+        availability_query = f"""
+        SELECT id, nombre_insumo, unidad, (cantidad_unitaria - cantidad_utilizada) AS disponible
+        FROM insumos
+        WHERE id IN ({placeholders})
+        """
+        if lock:
+            # Bloquear siempre en orden de id: dos ventas que comparten insumos
+            # esperan una a la otra en lugar de bloquearse mutuamente
+            availability_query += "ORDER BY id\n        FOR UPDATE\n"
+        cursor.execute(availability_query, tuple(sorted(insumo_ids)))
+        for row in cursor.fetchall():
+            availability[row['id']] = {
+                'nombre': row['nombre_insumo'],
+                'unidad': row['unidad'],
+                'disponible': float(row['disponible'])
+            }
         
-        if product:
-            print(f"DEBUG - Actualizando producto: {product_name} (ID: {product['id']})")
-            
-            # SOLO actualizar los insumos según la receta del producto
-            # NO actualizar stock_quantity del producto
-            PurchaseService._update_insumos_from_recipe(cursor, product['id'], quantity)
-            
-            print(f"DEBUG - Solo se actualizaron los insumos para el producto {product_name}")
-        else:
-            print(f"ADVERTENCIA - No se encontró el producto: {product_name}")
-
+        if INSUMO_WRITE_BEHIND and availability:
+            # Lo vendido que el hilo todavía no aplicó tampoco está disponible. El
+            # hilo aplica y elimina las filas en una transacción, así que una fila
+            # nunca se cuenta dos veces salvo en la ventana en que la instantánea de
+            # esta transacción es anterior a su commit (se rechaza de más, nunca de menos).
+            # Con bloqueo la lectura también bloquea (FOR SHARE): una lectura normal
+            # usaría la instantánea de la transacción, que pudo fijarse antes de
+            # esperar el FOR UPDATE y no vería las filas de una venta ya confirmada.
+            # El hilo bloquea los insumos antes que estas filas, en el mismo orden.
+            cursor.execute(
+                f"""
+                SELECT insumo_id, SUM(quantity) AS pendiente
+                FROM pending_insumo_consumption
+                WHERE insumo_id IN ({", ".join(["%s"] * len(availability))})
+                GROUP BY insumo_id
+                {"FOR SHARE" if lock else ""}
+                """,
+                tuple(sorted(availability))
+            )
+            for row in cursor.fetchall():
+                availability[row['insumo_id']]['disponible'] -= float(row['pendiente'])
+        return availability
+    
+    @staticmethod
+    def _check_insumo_needs(insumos_needed: Dict, availability: Dict[int, Dict]) -> List[Dict]:
+        """Errores de los insumos cuya necesidad supera lo disponible"""
+        errors = []
+        for insumo_id, data in insumos_needed.items():
+            insumo = availability.get(insumo_id, {'nombre': None, 'unidad': None, 'disponible': 0.0})
+            if data['necesario'] > insumo['disponible']:
+                errors.append({
+                    'insumo_id': insumo_id,
+                    'insumo_name': insumo['nombre'],
+                    'unit': insumo['unidad'],
+                    'required': data['necesario'],
+                    'available': insumo['disponible'],
+                    'product_name': data['product_name']
+                })
+        return errors
+    
     # def _update_product_stock(cursor, product_name: str, variant: Optional[str], quantity: int):
     #     """
     #     Actualiza el stock del producto y los insumos después de una venta
@@ -417,65 +732,235 @@ class PurchaseService:
     #         PurchaseService._update_insumos_from_recipe(cursor, product['id'], quantity)
     
     @staticmethod
-    def _update_insumos_from_recipe(cursor, product_id: int, quantity_sold: int):
+    def _aggregate_consumption(products: List[Dict], resolved_products: Dict) -> Dict[int, float]:
+        """
+        Consumo total por insumo de varias líneas de venta (en memoria, sin consultas)
+        
+        Args:
+            products: Líneas con product_name, product_variant y quantity (y product_id
+                si ya está guardado en purchase_details)
+            resolved_products: Mapa de _resolve_products para las líneas sin product_id
+            
+        Returns:
+            Dict {insumo_id: cantidad a descontar}
+        """
+        consumption = {}
+        for product in products:
+            product_id = product.get('product_id')
+            if product_id is None:
+                product_id = resolved_products.get(
+                    PurchaseService._product_key(product['product_name'], product.get('product_variant'))
+                )
+            if product_id is None:
+                logger.warning("No se encontró el producto: %s", product['product_name'])
+                continue
+            
+            recipe = recipe_cache.get(product_id)
+            if not recipe:
+                logger.warning("El producto ID %s no tiene receta definida", product_id)
+                continue
+            
+            for insumo_id, quantity in recipe.consumption(float(product['quantity'])).items():
+                consumption[insumo_id] = consumption.get(insumo_id, 0.0) + quantity
+        return consumption
+    
+    @staticmethod
+    def _apply_insumo_deltas(cursor, deltas: Dict[int, float], restore: bool = False):
         """
-        Actualiza la cantidad utilizada de insumos basado en la receta del producto vendido
+        Aplica el consumo de varios insumos con una sola sentencia
+        
+        El incremento se calcula en la base de datos sobre el valor actual de cada
+        fila (cantidad_utilizada = cantidad_utilizada + delta), por lo que dos ventas
+        simultáneas no se sobrescriben, y el costo no depende del tamaño de las recetas.
+        En la misma transacción se recalcula product_availability de los productos
+        que usan esos insumos.
         
         Args:
             cursor: Cursor de la base de datos
-            product_id: ID del producto vendido
-            quantity_sold: Cantidad vendida del producto
+            deltas: Dict {insumo_id: cantidad}
+            restore: True para devolver la cantidad (cancelación); nunca queda negativa
         """
-        # Obtener la receta del producto
-        recipe_query = """
-        SELECT pr.insumo_id, pr.cantidad, i.nombre_insumo, i.cantidad_utilizada, i.cantidad_unitaria, i.cantidad_por_producto
-        FROM product_recipes pr
-        JOIN insumos i ON pr.insumo_id = i.id
-        WHERE pr.product_id = %s
+        if not deltas:
+            return
+        
+        # Orden fijo de ids: las filas se bloquean siempre en el mismo orden
+        insumo_ids = sorted(deltas)
+        cases = " ".join(["WHEN %s THEN %s"] * len(insumo_ids))
+        placeholders = ", ".join(["%s"] * len(insumo_ids))
+        if restore:
+            new_value = f"GREATEST(0, cantidad_utilizada - CASE id {cases} END)"
+        else:
+            new_value = f"cantidad_utilizada + CASE id {cases} END"
+        
+        params = []
+        for insumo_id in insumo_ids:
+            params.extend((insumo_id, deltas[insumo_id]))
+        params.extend(insumo_ids)
+        
+        # Actualizar SOLO cantidad_utilizada del insumo, mantener cantidad_unitaria intacta
+        update_query = f"""
+        UPDATE insumos 
+        SET cantidad_utilizada = {new_value}
+        WHERE id IN ({placeholders})
         """
-        cursor.execute(recipe_query, (product_id,))
-        recipe_items = cursor.fetchall()
+        cursor.execute(update_query, params)
+        refresh_product_availability(insumo_ids=insumo_ids)
         
-        if recipe_items:
-            print(f"DEBUG - Actualizando insumos para producto ID {product_id}, cantidad vendida: {quantity_sold}")
-            
-            # Actualizar la cantidad utilizada de cada insumo
-            for item in recipe_items:
-                insumo_id = item['insumo_id']
-                cantidad_utilizada_actual = float(item['cantidad_utilizada'])
-                cantidad_unitaria_actual = float(item['cantidad_unitaria'])
-                
-                # Usar cantidad_por_producto si está disponible, de lo contrario usar la cantidad de la receta
-                cantidad_por_unidad = float(item['cantidad_por_producto']) if item['cantidad_por_producto'] and float(item['cantidad_por_producto']) > 0 else float(item['cantidad'])
-                total_quantity_to_use = cantidad_por_unidad * float(quantity_sold)
-                
-                print(f"DEBUG - Insumo ID {insumo_id}: cantidad_por_producto={cantidad_por_unidad}, quantity_sold={quantity_sold}")
-                print(f"DEBUG - Antes de actualizar: cantidad_utilizada={cantidad_utilizada_actual}, cantidad_unitaria={cantidad_unitaria_actual}")
-                
-                nueva_cantidad_utilizada = cantidad_utilizada_actual + total_quantity_to_use
-                
-                # Actualizar SOLO cantidad_utilizada del insumo, mantener cantidad_unitaria intacta
-                update_insumo_query = """
-                UPDATE insumos 
-                SET cantidad_utilizada = %s
-                WHERE id = %s
-                """
-                cursor.execute(update_insumo_query, (nueva_cantidad_utilizada, insumo_id))
+        # Verificación (una consulta extra) solo con DEBUG activo
+        if logger.isEnabledFor(logging.DEBUG):
+            cursor.execute(
+                f"SELECT id, cantidad_utilizada, cantidad_unitaria FROM insumos WHERE id IN ({placeholders})",
+                insumo_ids
+            )
+            for row in cursor.fetchall():
+                logger.debug("Insumo %s: %s%s, ahora tiene cantidad_utilizada = %s, cantidad_unitaria = %s",
+                             row['id'], '-' if restore else '+', deltas[row['id']],
+                             row['cantidad_utilizada'], row['cantidad_unitaria'])
+    
+    @staticmethod
+    def _record_consumption(cursor, consumptions: List[tuple]):
+        """
+        Descontar el consumo de insumos de una o varias compras
+        
+        Sin INSUMO_WRITE_BEHIND se aplica con un solo UPDATE; con él se guarda una
+        fila por compra e insumo en pending_insumo_consumption (en la misma
+        transacción que la compra) y la aplica el hilo de consumption_worker.
+        En ambos casos el consumo se anota en el libro de movimientos al vender.
+        
+        Args:
+            cursor: Cursor de la transacción de la compra
+            consumptions: Lista de (purchase_id, {insumo_id: cantidad})
+        """
+        record_movements(consumption_movements(MOVEMENT_SALE, consumptions), cursor=cursor)
+        if not INSUMO_WRITE_BEHIND:
+            deltas = {}
+            for _, consumption in consumptions:
+                for insumo_id, quantity in consumption.items():
+                    deltas[insumo_id] = deltas.get(insumo_id, 0.0) + quantity
+            PurchaseService._apply_insumo_deltas(cursor, deltas)
+            return
+        
+        bulk_insert(
+            'pending_insumo_consumption',
+            ['purchase_id', 'insumo_id', 'quantity'],
+            [
+                (purchase_id, insumo_id, quantity)
+                for purchase_id, consumption in consumptions
+                for insumo_id, quantity in sorted(consumption.items())
+                if quantity
+            ],
+            cursor=cursor
+        )
+        # La disponibilidad descuenta lo pendiente: cambia ya al vender
+        refresh_product_availability(
+            insumo_ids={insumo_id for _, consumption in consumptions for insumo_id in consumption}
+        )
+    
+    @staticmethod
+    def _take_pending_consumption(cursor, purchase_ids: List[int], insumo_ids: Iterable[int]) -> Dict[int, float]:
+        """
+        Quitar de la cola el consumo todavía no aplicado de unas compras (cancelación)
+        
+        Args:
+            cursor: Cursor de la transacción de la cancelación
+            purchase_ids: Compras canceladas (ya bloqueadas)
+            insumo_ids: Insumos que la cancelación va a restaurar
+        
+        Returns:
+            Dict {insumo_id: cantidad que seguía pendiente}
+        """
+        placeholders = ", ".join(["%s"] * len(purchase_ids))
+        # Primero los insumos, en orden de id, y después las filas pendientes: el
+        # mismo orden que el hilo de consumo y una venta en modo reserva. Las
+        # compras están bloqueadas, así que no aparecen filas nuevas suyas
+        cursor.execute(
+            f"SELECT DISTINCT insumo_id FROM pending_insumo_consumption WHERE purchase_id IN ({placeholders})",
+            purchase_ids
+        )
+        locked = sorted(set(insumo_ids) | {row['insumo_id'] for row in cursor.fetchall()})
+        if locked:
+            cursor.execute(
+                f"SELECT id FROM insumos WHERE id IN ({', '.join(['%s'] * len(locked))}) ORDER BY id FOR UPDATE",
+                locked
+            )
+        # Bloquea las filas: si el hilo las está aplicando se espera a su commit
+        # y entonces ya no aparecen (y su cantidad se restaura como aplicada)
+        cursor.execute(
+            f"SELECT id, insumo_id, quantity FROM pending_insumo_consumption "
+            f"WHERE purchase_id IN ({placeholders}) FOR UPDATE",
+            purchase_ids
+        )
+        pending = {}
+        row_ids = []
+        for row in cursor.fetchall():
+            row_ids.append(row['id'])
+            pending[row['insumo_id']] = pending.get(row['insumo_id'], 0.0) + float(row['quantity'])
+        if row_ids:
+            cursor.execute(
+                f"DELETE FROM pending_insumo_consumption WHERE id IN ({', '.join(['%s'] * len(row_ids))})",
+                row_ids
+            )
+            refresh_product_availability(insumo_ids=pending)
+        return pending
+    
+    @staticmethod
+    def apply_pending_consumption(batch_size: int) -> tuple:
+        """
+        Aplicar un lote de consumos pendientes (lo llama el hilo de consumption_worker)
+        
+        Las filas de cada insumo se suman y se aplican con un solo UPDATE; las filas
+        aplicadas se eliminan en la misma transacción, así que un fallo a mitad de
+        lote no descuenta nada dos veces.
+        
+        Returns:
+            Tupla (filas aplicadas, insumos actualizados)
+        """
+        # Los ids se leen sin bloqueo y luego se bloquean por clave primaria: así no
+        # se toman bloqueos de rango que frenarían los INSERT de las ventas
+        ids = execute_query(
+            "SELECT id, insumo_id FROM pending_insumo_consumption ORDER BY id LIMIT %s",
+            (batch_size,), fetch_all=True, compact=True
+        )
+        if not ids:
+            return 0, 0
+        
+        with transaction() as connection:
+            cursor = connection.cursor(pymysql.cursors.DictCursor)
+            try:
+                # Primero los insumos, en orden de id, y después las filas pendientes:
+                # el mismo orden que una venta en modo reserva, que bloquea sus insumos
+                # y luego lee con FOR SHARE las filas pendientes de esos insumos
+                insumo_ids = sorted({row[1] for row in ids})
+                cursor.execute(
+                    f"SELECT id FROM insumos WHERE id IN ({', '.join(['%s'] * len(insumo_ids))}) "
+                    f"ORDER BY id FOR UPDATE",
+                    insumo_ids
+                )
+                row_ids = [row[0] for row in ids]
+                placeholders = ", ".join(["%s"] * len(row_ids))
+                # Otro worker pudo aplicar algunas: solo cuentan las que siguen en la tabla
+                cursor.execute(
+                    f"SELECT id, insumo_id, quantity FROM pending_insumo_consumption "
+                    f"WHERE id IN ({placeholders}) FOR UPDATE",
+                    row_ids
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return 0, 0
                 
-                print(f"DEBUG - Insumo '{item['nombre_insumo']}' (ID: {insumo_id}): "
-                      f"Cantidad utilizada anterior: {cantidad_utilizada_actual}, "
-                      f"Incremento: +{total_quantity_to_use}, "
-                      f"Nueva cantidad utilizada: {nueva_cantidad_utilizada}")
+                deltas = {}
+                for row in rows:
+                    deltas[row['insumo_id']] = deltas.get(row['insumo_id'], 0.0) + float(row['quantity'])
+                PurchaseService._apply_insumo_deltas(cursor, deltas)
                 
-                # Verificar que se actualizó correctamente
-                verify_query = "SELECT cantidad_utilizada, cantidad_unitaria FROM insumos WHERE id = %s"
-                cursor.execute(verify_query, (insumo_id,))
-                verify_result = cursor.fetchone()
-                if verify_result:
-                    print(f"DEBUG - Verificación: Insumo {insumo_id} ahora tiene cantidad_utilizada = {verify_result['cantidad_utilizada']}, "
-                          f"cantidad_unitaria = {verify_result['cantidad_unitaria']}")
-        else:
-            print(f"Advertencia: El producto ID {product_id} no tiene receta definida")
+                applied_ids = [row['id'] for row in rows]
+                cursor.execute(
+                    f"DELETE FROM pending_insumo_consumption WHERE id IN ({', '.join(['%s'] * len(applied_ids))})",
+                    applied_ids
+                )
+                return len(rows), len(deltas)
+            finally:
+                cursor.close()
     
     @staticmethod
     def get_purchase_by_invoice(invoice_number: str) -> Optional[Dict]:
@@ -618,15 +1103,18 @@ class PurchaseService:
         # Query para productos más vendidos
         top_products_query = """
         SELECT 
-            pd.product_name,
-            pd.product_variant,
+            MAX(COALESCE(pr.nombre_producto, pd.product_name)) AS product_name,
+            MAX(CASE WHEN pr.id IS NULL THEN pd.product_variant ELSE pr.variante END) AS product_variant,
             SUM(pd.quantity) as total_quantity,
             SUM(pd.subtotal) as total_revenue,
             COUNT(DISTINCT p.id) as times_sold
         FROM purchase_details pd
         JOIN purchases p ON pd.purchase_id = p.id
+        LEFT JOIN products pr ON pd.product_id = pr.id
         WHERE p.invoice_date BETWEEN %s AND %s
-        GROUP BY pd.product_name, pd.product_variant
+        GROUP BY pd.product_id,
+                 CASE WHEN pd.product_id IS NULL THEN pd.product_name END,
+                 CASE WHEN pd.product_id IS NULL THEN pd.product_variant END
         ORDER BY total_quantity DESC
         LIMIT 10
         """
@@ -647,97 +1135,132 @@ class PurchaseService:
         """
         Cancela una compra y restaura solo los insumos
         (Ya no restaura stock_quantity porque no lo modificamos al vender)
+        
+        Se reintenta completa si se aborta por un deadlock o un timeout de bloqueo.
         """
-        connection = get_db_connection()
-        if not connection:
-            raise Exception("No se pudo establecer conexión con la base de datos")
+        outcome = run_transaction_with_retry(
+            lambda: PurchaseService._cancel_purchases([invoice_number], reason)
+        )[invoice_number]
         
-        cursor = None
-        try:
-            cursor = connection.cursor(pymysql.cursors.DictCursor)
-            connection.begin()
-            
-            # Verificar que la compra existe
-            purchase_query = "SELECT id FROM purchases WHERE invoice_number = %s"
-            cursor.execute(purchase_query, (invoice_number,))
-            purchase = cursor.fetchone()
-            
-            if not purchase:
-                raise ValueError(f"No se encontró la factura {invoice_number}")
-            
-            # Obtener detalles de los productos para restaurar insumos
-            details_query = "SELECT * FROM purchase_details WHERE purchase_id = %s"
-            cursor.execute(details_query, (purchase['id'],))
-            details = cursor.fetchall()
+        if outcome['status'] == 'not_found':
+            raise ValueError(f"No se encontró la factura {invoice_number}")
+        if outcome['status'] == 'already_cancelled':
+            raise ValueError(f"La factura {invoice_number} ya está cancelada")
+        
+        return {
+            'status': 'success',
+            'message': f'Factura {invoice_number} cancelada exitosamente',
+            'insumos_restored': outcome['insumos_restored']
+        }
+    
+    @staticmethod
+    def cancel_purchases(invoice_numbers: List[str], reason: str) -> List[Dict]:
+        """
+        Cancela varias compras en una sola transacción
+        
+        El consumo de insumos de todas las facturas se suma y se restaura con un
+        solo UPDATE; si algo falla no se cancela ninguna.
+        
+        Args:
+            invoice_numbers: Números de factura (los repetidos se cancelan una vez)
+            reason: Razón de la cancelación
             
-            # Restaurar SOLO los insumos (no stock_quantity)
-            for detail in details:
-                product = None
+        Returns:
+            Lista con un resultado por factura, en el orden recibido:
+            {'invoice_number', 'status' ('cancelled', 'not_found' o 'already_cancelled'), 'insumos_restored'}
+        """
+        unique_numbers = list(dict.fromkeys(invoice_numbers))
+        outcomes = run_transaction_with_retry(
+            lambda: PurchaseService._cancel_purchases(unique_numbers, reason)
+        )
+        return [outcomes[invoice_number] for invoice_number in unique_numbers]
+    
+    @staticmethod
+    def _cancel_purchases(invoice_numbers: List[str], reason: str) -> Dict[str, Dict]:
+        """Un intento de cancelar varias compras en su propia transacción"""
+        with transaction() as connection:
+            cursor = connection.cursor(pymysql.cursors.DictCursor)
+            try:
+                outcomes = {
+                    invoice_number: {'invoice_number': invoice_number, 'status': 'not_found', 'insumos_restored': 0}
+                    for invoice_number in invoice_numbers
+                }
                 
-                # Buscar el producto usando los mismos métodos que en _update_product_stock
-                if detail['product_variant']:
-                    product_query = """
-                    SELECT id FROM products 
-                    WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE
-                    """
-                    cursor.execute(product_query, (detail['product_name'], detail['product_variant']))
-                    product = cursor.fetchone()
-                else:
-                    product_query = """
-                    SELECT id FROM products 
-                    WHERE nombre_producto = %s AND (variante IS NULL OR variante = '') AND is_active = TRUE
-                    """
-                    cursor.execute(product_query, (detail['product_name'],))
-                    product = cursor.fetchone()
+                # Verificar que las compras existen (y bloquearlas: dos cancelaciones
+                # simultáneas de la misma factura no restauran dos veces)
+                placeholders = ", ".join(["%s"] * len(invoice_numbers))
+                cursor.execute(
+                    f"SELECT id, invoice_number, is_cancelled FROM purchases "
+                    f"WHERE invoice_number IN ({placeholders}) ORDER BY id FOR UPDATE",
+                    invoice_numbers
+                )
+                purchases = {}
+                for purchase in cursor.fetchall():
+                    if purchase['is_cancelled']:
+                        outcomes[purchase['invoice_number']]['status'] = 'already_cancelled'
+                    else:
+                        purchases[purchase['id']] = purchase['invoice_number']
                 
-                # Método alternativo si no encontró
-                if not product and ' - ' in detail['product_name']:
-                    parts = detail['product_name'].split(' - ', 1)
-                    if len(parts) == 2:
-                        nombre_base = parts[0].strip()
-                        variante_base = parts[1].strip()
-                        
-                        product_query = """
-                        SELECT id FROM products 
-                        WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE
-                        """
-                        cursor.execute(product_query, (nombre_base, variante_base))
-                        product = cursor.fetchone()
+                if not purchases:
+                    return outcomes
+                purchase_ids = sorted(purchases)
                 
-                if product:
-                    # SOLO restaurar insumos (revertir la cantidad utilizada)
-                    PurchaseService._restore_insumos_from_recipe(cursor, product['id'], detail['quantity'])
-                    print(f"DEBUG - Restaurados insumos para producto ID {product['id']}")
-                else:
-                    print(f"ADVERTENCIA - No se pudo encontrar producto para restaurar: {detail['product_name']}")
-            
-            # Marcar la compra como cancelada
-            cancel_query = """
-            UPDATE purchases 
-            SET is_cancelled = TRUE, 
-                cancellation_reason = %s,
-                cancelled_at = NOW()
-            WHERE id = %s
-            """
-            cursor.execute(cancel_query, (reason, purchase['id']))
-            
-            connection.commit()
+                # Obtener detalles de los productos de todas las compras para restaurar insumos
+                placeholders = ", ".join(["%s"] * len(purchase_ids))
+                cursor.execute(
+                    f"SELECT * FROM purchase_details WHERE purchase_id IN ({placeholders})",
+                    purchase_ids
+                )
+                details = cursor.fetchall()
+                for detail in details:
+                    outcomes[purchases[detail['purchase_id']]]['insumos_restored'] += 1
             
-            return {
-                'status': 'success',
-                'message': f'Factura {invoice_number} cancelada exitosamente',
-                'insumos_restored': len(details)
-            }
+                # Las líneas guardan el product_id de la venta; solo las anteriores a la
+                # migración 8 sin backfill se resuelven por nombre (catálogo en memoria)
+                unresolved = [detail for detail in details if detail.get('product_id') is None]
+                resolved_products = PurchaseService._resolve_products(unresolved) if unresolved else {}
+                
+                # Restaurar SOLO los insumos (no stock_quantity) de todas las compras, con una sola
+                # sentencia; el libro de movimientos recibe una fila por compra e insumo
+                details_by_purchase = {}
+                for detail in details:
+                    details_by_purchase.setdefault(detail['purchase_id'], []).append(detail)
+                consumptions = [
+                    (purchase_id, PurchaseService._aggregate_consumption(purchase_details, resolved_products))
+                    for purchase_id, purchase_details in sorted(details_by_purchase.items())
+                ]
+                record_movements(consumption_movements(MOVEMENT_CANCELLATION, consumptions), cursor=cursor)
+                consumption = {}
+                for _, purchase_consumption in consumptions:
+                    for insumo_id, quantity in purchase_consumption.items():
+                        consumption[insumo_id] = consumption.get(insumo_id, 0.0) + quantity
+                
+                # Lo que sigue pendiente (modo diferido) nunca se descontó: se elimina
+                # de la cola en lugar de restaurarlo
+                for insumo_id, quantity in PurchaseService._take_pending_consumption(cursor, purchase_ids, consumption).items():
+                    remaining = consumption.get(insumo_id, 0.0) - quantity
+                    if remaining > 1e-9:
+                        consumption[insumo_id] = remaining
+                    else:
+                        consumption.pop(insumo_id, None)
+                PurchaseService._apply_insumo_deltas(cursor, consumption, restore=True)
             
-        except Exception as e:
-            if connection:
-                connection.rollback()
-            raise e
-        finally:
-            if cursor:
+                # Marcar las compras como canceladas
+                cancel_query = f"""
+                UPDATE purchases 
+                SET is_cancelled = TRUE, 
+                    cancellation_reason = %s,
+                    cancelled_at = NOW()
+                WHERE id IN ({placeholders})
+                """
+                cursor.execute(cancel_query, [reason] + purchase_ids)
+                
+                for invoice_number in purchases.values():
+                    outcomes[invoice_number]['status'] = 'cancelled'
+                logger.info("Canceladas %s compras, %s insumos restaurados", len(purchase_ids), len(consumption))
+                return outcomes
+            finally:
                 cursor.close()
-            if connection:
-                connection.close()
 
     def repair_stock_data():
         """
@@ -756,7 +1279,7 @@ class PurchaseService:
             cursor = connection.cursor(pymysql.cursors.DictCursor)
             connection.begin()
             
-            print("INICIANDO REPARACIÓN DE DATOS DE STOCK...")
+            logger.info("Iniciando reparación de datos de stock")
             
             # OPCIÓN A: Resetear stock_quantity a -1 para todos los productos
             # Esto indica que son productos bajo demanda
@@ -767,7 +1290,7 @@ class PurchaseService:
             """
             cursor.execute(reset_products_query)
             affected_products = cursor.rowcount
-            print(f"✓ Reseteados {affected_products} productos a stock bajo demanda (stock_quantity = -1)")
+            logger.info("Reseteados %s productos a stock bajo demanda (stock_quantity = -1)", affected_products)
             
             # OPCIÓN B: Si quieres resetear completamente los insumos utilizados
             # (Descomenta solo si realmente quieres empezar desde cero)
@@ -779,7 +1302,7 @@ class PurchaseService:
             """
             
             connection.commit()
-            print("REPARACIÓN COMPLETADA EXITOSAMENTE")
+            logger.info("Reparación de datos de stock completada")
             
             return {
                 'status': 'success',
@@ -790,7 +1313,7 @@ class PurchaseService:
         except Exception as e:
             if connection:
                 connection.rollback()
-            print(f"ERROR durante la reparación: {e}")
+            logger.error("Error durante la reparación: %s", e)
             raise e
         finally:
             if cursor:
@@ -914,68 +1437,6 @@ class PurchaseService:
     #         if connection:
     #             connection.close()
                 
-    @staticmethod
-    def _restore_insumos_from_recipe(cursor, product_id: int, quantity: int):
-        """
-        Restaura la cantidad utilizada de insumos cuando se cancela una venta
-        
-        Args:
-            cursor: Cursor de la base de datos
-            product_id: ID del producto
-            quantity: Cantidad del producto que se canceló
-        """
-        # Obtener la receta del producto
-        recipe_query = """
-        SELECT pr.insumo_id, pr.cantidad, i.nombre_insumo, i.cantidad_utilizada, i.cantidad_unitaria, i.cantidad_por_producto
-        FROM product_recipes pr
-        JOIN insumos i ON pr.insumo_id = i.id
-        WHERE pr.product_id = %s
-        """
-        cursor.execute(recipe_query, (product_id,))
-        recipe_items = cursor.fetchall()
-        
-        if recipe_items:
-            print(f"DEBUG - Restaurando insumos para producto ID {product_id}, cantidad cancelada: {quantity}")
-            
-            # Actualizar la cantidad utilizada de cada insumo (restar)
-            for item in recipe_items:
-                insumo_id = item['insumo_id']
-                cantidad_utilizada_actual = float(item['cantidad_utilizada'])
-                cantidad_unitaria_actual = float(item['cantidad_unitaria'])
-                
-                # Usar cantidad_por_producto si está disponible, de lo contrario usar la cantidad de la receta
-                cantidad_por_unidad = float(item['cantidad_por_producto']) if item['cantidad_por_producto'] and float(item['cantidad_por_producto']) > 0 else float(item['cantidad'])
-                total_quantity_to_restore = cantidad_por_unidad * float(quantity)
-                
-                print(f"DEBUG - Insumo ID {insumo_id}: cantidad_por_producto={cantidad_por_unidad}, quantity={quantity}")
-                print(f"DEBUG - Antes de restaurar: cantidad_utilizada={cantidad_utilizada_actual}, cantidad_unitaria={cantidad_unitaria_actual}")
-                
-                # Restar de la cantidad utilizada (no puede ser negativa)
-                nueva_cantidad_utilizada = max(0, cantidad_utilizada_actual - total_quantity_to_restore)
-                
-                # Actualizar SOLO cantidad_utilizada del insumo
-                update_insumo_query = """
-                UPDATE insumos 
-                SET cantidad_utilizada = %s
-                WHERE id = %s
-                """
-                cursor.execute(update_insumo_query, (nueva_cantidad_utilizada, insumo_id))
-                
-                print(f"DEBUG - Insumo '{item['nombre_insumo']}' (ID: {insumo_id}): "
-                      f"Cantidad utilizada anterior: {cantidad_utilizada_actual}, "
-                      f"Decremento: -{total_quantity_to_restore}, "
-                      f"Nueva cantidad utilizada: {nueva_cantidad_utilizada}")
-                
-                # Verificar que se actualizó correctamente
-                verify_query = "SELECT cantidad_utilizada, cantidad_unitaria FROM insumos WHERE id = %s"
-                cursor.execute(verify_query, (insumo_id,))
-                verify_result = cursor.fetchone()
-                if verify_result:
-                    print(f"DEBUG - Verificación: Insumo {insumo_id} ahora tiene cantidad_utilizada = {verify_result['cantidad_utilizada']}, "
-                          f"cantidad_unitaria = {verify_result['cantidad_unitaria']}")
-        else:
-            print(f"Advertencia: El producto ID {product_id} no tiene receta definida")
-    
     @staticmethod
     def get_inventory_status() -> Dict:
         """
@@ -1031,10 +1492,14 @@ class PurchaseService:
         Returns:
             Lista de productos con sus ventas
         """
+        # Se agrupa por product_id (con el nombre actual del producto, así un
+        # producto renombrado conserva su historial); las líneas sin product_id
+        # se agrupan por el nombre guardado en la venta
         query = """
         SELECT 
-            pd.product_name,
-            pd.product_variant,
+            pd.product_id,
+            MAX(COALESCE(pr.nombre_producto, pd.product_name)) AS product_name,
+            MAX(CASE WHEN pr.id IS NULL THEN pd.product_variant ELSE pr.variante END) AS product_variant,
             COUNT(DISTINCT p.id) as numero_ventas,
             SUM(pd.quantity) as cantidad_total,
             SUM(pd.subtotal) as ingreso_total,
@@ -1043,9 +1508,12 @@ class PurchaseService:
             MAX(p.invoice_date) as ultima_venta
         FROM purchase_details pd
         JOIN purchases p ON pd.purchase_id = p.id
+        LEFT JOIN products pr ON pd.product_id = pr.id
         WHERE p.invoice_date BETWEEN %s AND %s
         AND p.is_cancelled = FALSE
-        GROUP BY pd.product_name, pd.product_variant
+        GROUP BY pd.product_id,
+                 CASE WHEN pd.product_id IS NULL THEN pd.product_name END,
+                 CASE WHEN pd.product_id IS NULL THEN pd.product_variant END
         ORDER BY ingreso_total DESC
         """
         
@@ -1056,29 +1524,45 @@ class PurchaseService:
         """
         Obtiene un reporte del consumo de insumos en un período
         
+        El consumo sale del libro de movimientos (ventas menos cancelaciones del
+        período), leído desde los puntos de control más cercanos a cada fecha.
+        
         Args:
             start_date: Fecha inicial
-            end_date: Fecha final
+            end_date: Fecha final (incluida)
             
         Returns:
-            Lista de insumos con su consumo
+            Lista de insumos con su consumo en el período, de mayor a menor valor
         """
-        # Esta query es más compleja porque necesitamos rastrear el consumo a través de las ventas
-        query = """
+        consumption = consumption_between(
+            datetime.combine(start_date, time.min),
+            datetime.combine(end_date + timedelta(days=1), time.min)
+        )
+        if consumption is None:
+            raise Exception("No se pudo leer el libro de movimientos de insumos")
+        if not consumption:
+            return []
+        
+        placeholders = ", ".join(["%s"] * len(consumption))
+        query = f"""
         SELECT 
             i.id,
             i.nombre_insumo,
             i.unidad,
             i.cantidad_utilizada as cantidad_total_utilizada,
             i.valor_unitario,
-            i.valor_total as valor_total_consumido,
             COUNT(DISTINCT p.id) as productos_que_lo_usan
         FROM insumos i
         LEFT JOIN product_recipes pr ON i.id = pr.insumo_id
         LEFT JOIN products p ON pr.product_id = p.id
-        WHERE i.cantidad_utilizada > 0
+        WHERE i.id IN ({placeholders})
         GROUP BY i.id
-        ORDER BY i.valor_total DESC
         """
         
-        return execute_query(query, fetch_all=True) or [] 
\ No newline at end of file
+        insumos = execute_query(query, list(consumption), fetch_all=True) or []
+        for insumo in insumos:
+            quantity = consumption[insumo['id']]
+            insumo['cantidad_consumida'] = round(quantity, 4)
+            insumo['valor_total_consumido'] = round(quantity * float(insumo['valor_unitario'] or 0), 2)
+        insumos.sort(key=lambda insumo: insumo['valor_total_consumido'], reverse=True)
+        return insumos 
\ No newline at end of file
@@ -1,9 +1,11 @@
 from fastapi import HTTPException, Depends, status, Request, APIRouter
 
 from models.product_service import ProductService
+from models.catalog import recipe_cache
+from models.product_availability import refresh_product_availability
 
 import pymysql
-from database.db import get_db_connection
+from database.db import get_db_connection, bulk_insert
 from api.v1.auth_service.login import get_current_active_user
 
 
@@ -86,23 +88,17 @@ async def add_recipe(
         cursor.execute(delete_query, (product_id,))
         print(f"Receta anterior eliminada para producto {product_id}")
         
-        # Insertar los nuevos ingredientes
-        inserted_count = 0
-        for ingredient in ingredients:
-            insumo_id = ingredient.get('insumo_id')
-            cantidad = ingredient.get('cantidad')
-            
-            if not insumo_id or not cantidad:
-                continue
-            
-            recipe_query = """
-            INSERT INTO product_recipes (product_id, insumo_id, cantidad)
-            VALUES (%s, %s, %s)
-            """
-            
-            cursor.execute(recipe_query, (product_id, insumo_id, cantidad))
-            inserted_count += 1
-            print(f"Ingrediente {insumo_id} insertado con cantidad {cantidad}")
+        # Insertar los nuevos ingredientes en un solo INSERT
+        recipe_rows = [
+            (product_id, ingredient.get('insumo_id'), ingredient.get('cantidad'))
+            for ingredient in ingredients
+            if ingredient.get('insumo_id') and ingredient.get('cantidad')
+        ]
+        inserted_ids = bulk_insert(
+            'product_recipes', ['product_id', 'insumo_id', 'cantidad'], recipe_rows, cursor=cursor
+        )
+        inserted_count = len(inserted_ids)
+        print(f"{inserted_count} ingredientes insertados para producto {product_id}")
         
         # Verificar que se insertaron todos los ingredientes
         if inserted_count != len(ingredients):
@@ -114,6 +110,8 @@ async def add_recipe(
         
         # Confirmar la transacción
         connection.commit()
+        recipe_cache.invalidate()
+        refresh_product_availability(product_ids=[product_id])
         print(f"=== RECETA CREADA EXITOSAMENTE PARA PRODUCTO {product_id} ===")
         
         return {
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Request, Header, Response
+from fastapi.responses import StreamingResponse
 from typing import Optional
 from .stock_service import StockService
 from .purchase_service import PurchaseService
@@ -9,11 +10,16 @@ from .domiciliary import router_domiciliary
 from .additions import router_additions
 from .pdf_service import router as router_pdf
 from .shirt_schedule import router_shirt_schedule
-from pydantic import BaseModel
+from .monitoring import router_monitoring
+from models.stock_stream import stock_broadcaster, STREAM_HEARTBEAT_SECONDS, STREAM_RETRY_MS
+from database.idempotency import run_idempotent, request_fingerprint, IdempotencyConflict, IdempotencyInProgress
+from pydantic import BaseModel, ValidationError, conlist
 from typing import List, Dict
-from datetime import date
-import pymysql
-from database.db import get_db_connection
+from datetime import date, datetime
+from starlette.concurrency import run_in_threadpool
+import anyio
+import asyncio
+import json
 
 # Modelos Pydantic para validación
 class ProductDetail(BaseModel):
@@ -42,6 +48,25 @@ class PurchaseCreate(BaseModel):
     payment_reference: Optional[str] = None
     products: List[ProductDetail]
 
+class PurchaseCancelBatch(BaseModel):
+    invoice_numbers: conlist(str, min_items=1, max_items=500)
+    reason: str
+
+class StockCartLine(BaseModel):
+    product_id: int
+    quantity: float
+
+class StockRestockLine(BaseModel):
+    insumo_id: int
+    quantity: float
+
+class StockScenario(BaseModel):
+    cart: List[StockCartLine] = []
+    restock: List[StockRestockLine] = []
+
+class StockWhatIf(BaseModel):
+    scenarios: conlist(StockScenario, min_items=1, max_items=200)
+
 router_services = APIRouter()
 
 # Incluir el router de dashboard
@@ -63,19 +88,32 @@ router_services.include_router(router_pdf)
 # Incluir el router de programación de camisetas
 router_services.include_router(router_shirt_schedule, prefix="/shirt-schedule", tags=["shirt-schedule"])
 
+# Incluir el router de monitoreo
+router_services.include_router(router_monitoring, prefix="/monitoring", tags=["monitoring"])
+
 @router_services.get("/")
 async def get_services():
     return {"message": " desde services"}
 
 # Endpoints para gestión de stock
 @router_services.get("/stock")
-async def get_product_stock():
+async def get_product_stock(
+    row_format: str = Query("json", alias="format", regex="^(json|compact)$", description="'compact': filas como arreglos más 'columns'")
+):
     """
     Obtiene el stock disponible de todos los productos basándose en los insumos disponibles.
     
     Calcula cuántas unidades de cada producto se pueden producir con los insumos actuales.
     """
     try:
+        if row_format == "compact":
+            stock_data = StockService.calculate_product_stock(compact=True)
+            return {
+                "total_productos": len(stock_data),
+                "columns": list(stock_data.columns),
+                "productos": stock_data.rows
+            }
+        
         stock_data = StockService.calculate_product_stock()
         
         return {
@@ -90,7 +128,8 @@ async def get_product_stock():
 
 @router_services.get("/stock/low")
 async def get_low_stock_products(
-    min_stock: Optional[int] = Query(5, description="Umbral mínimo de stock")
+    min_stock: Optional[int] = Query(5, description="Umbral mínimo de stock"),
+    row_format: str = Query("json", alias="format", regex="^(json|compact)$", description="'compact': filas como arreglos más 'columns'")
 ):
     """
     Obtiene productos que están por agotarse.
@@ -99,6 +138,15 @@ async def get_low_stock_products(
         min_stock: Umbral para considerar un producto con stock bajo (default: 5)
     """
     try:
+        if row_format == "compact":
+            low_stock_products = StockService.get_low_stock_products(min_stock, compact=True)
+            return {
+                "min_stock_threshold": min_stock,
+                "total_productos_bajo_stock": len(low_stock_products),
+                "columns": list(low_stock_products.columns),
+                "productos": low_stock_products.rows
+            }
+        
         low_stock_products = StockService.get_low_stock_products(min_stock)
         
         return {
@@ -112,6 +160,129 @@ async def get_low_stock_products(
             detail=f"Error al obtener productos con stock bajo: {str(e)}"
         )
 
+@router_services.post("/stock/what-if")
+async def get_stock_what_if(request: StockWhatIf):
+    """
+    Evalúa escenarios hipotéticos sin modificar el inventario: qué productos
+    se pueden seguir vendiendo después de un carrito, o qué productos se
+    habilitan si se reponen ciertos insumos.
+    
+    Todos los escenarios se calculan juntos sobre la matriz de recetas en memoria.
+    """
+    scenarios = []
+    for scenario in request.scenarios:
+        cart = {}
+        for line in scenario.cart:
+            cart[line.product_id] = cart.get(line.product_id, 0.0) + line.quantity
+        restock = {}
+        for line in scenario.restock:
+            restock[line.insumo_id] = restock.get(line.insumo_id, 0.0) + line.quantity
+        scenarios.append({'cart': cart, 'restock': restock})
+    
+    try:
+        results = await run_in_threadpool(StockService.what_if, scenarios)
+        return {'scenarios': results}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al evaluar los escenarios de stock: {str(e)}"
+        )
+
+@router_services.get("/stock/as-of")
+async def get_stock_as_of(
+    at: datetime = Query(..., description="Fecha y hora a reconstruir (YYYY-MM-DDTHH:MM:SS)")
+):
+    """
+    Reconstruye el inventario a una fecha y hora pasada: saldo de cada insumo y
+    unidades disponibles de cada producto activo.
+    
+    Parte del punto de control o de la instantánea diaria más reciente del libro
+    de movimientos de insumos y suma los movimientos hasta la fecha pedida.
+    """
+    try:
+        return await run_in_threadpool(StockService.stock_as_of, at)
+    except ValueError as ve:
+        raise HTTPException(
+            status_code=422,
+            detail=str(ve)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al reconstruir el inventario: {str(e)}"
+        )
+
+def _sse_frame(event: tuple) -> str:
+    """Evento (tipo, secuencia, datos) en formato Server-Sent Events"""
+    kind, sequence, data = event
+    return (
+        f"id: {stock_broadcaster.event_id(sequence)}\n"
+        f"event: {kind}\n"
+        f"data: {json.dumps(data, default=str)}\n\n"
+    )
+
+@router_services.get("/stock/stream")
+async def stream_stock_changes(
+    request: Request,
+    since: Optional[str] = Query(None, description="Último id de evento recibido (alternativa a Last-Event-ID)"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Stream (Server-Sent Events) de los cambios de stock, en lugar de consultar
+    /services/stock periódicamente.
+
+    Envía primero un evento `snapshot` con las unidades de todos los productos
+    activos y luego un evento `delta` cada vez que una compra, cancelación o
+    reposición cambia las unidades de algún producto (con los que se agotan, se
+    habilitan y cruzan el umbral de stock bajo). Al reconectar con Last-Event-ID
+    (o `since`) se envían solo los eventos perdidos, o un snapshot nuevo si ya no
+    están disponibles.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        subscription, backlog = await run_in_threadpool(
+            stock_broadcaster.subscribe, loop, last_event_id or since
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al abrir el stream de stock: {str(e)}"
+        )
+
+    async def events():
+        last_sequence = -1
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            for event in backlog:
+                last_sequence = event[1]
+                yield _sse_frame(event)
+            while not await request.is_disconnected():
+                if subscription.lagged:
+                    # La terminal se quedó atrás: se reemplaza lo pendiente por un snapshot
+                    subscription.drain()
+                    event = await run_in_threadpool(stock_broadcaster.snapshot_event)
+                    last_sequence = event[1]
+                    yield _sse_frame(event)
+                    continue
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comentario SSE: mantiene la conexión abierta en proxies
+                    yield ": ping\n\n"
+                    continue
+                if event[1] <= last_sequence:
+                    continue
+                last_sequence = event[1]
+                yield _sse_frame(event)
+        finally:
+            stock_broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router_services.get("/stock/{product_id}")
 async def get_product_stock_details(product_id: int):
     """
@@ -177,40 +348,24 @@ async def validate_purchase(purchase_data: PurchaseCreate):
     NO crea la compra, solo verifica la disponibilidad.
     """
     try:
-        connection = get_db_connection()
-        if not connection:
-            raise HTTPException(
-                status_code=500,
-                detail="No se pudo establecer conexión con la base de datos"
-            )
+        # La validación usa pymysql (bloqueante): se ejecuta en el threadpool
+        # para no congelar el event loop mientras espera a MySQL
+        validation_result = await run_in_threadpool(
+            PurchaseService.validate_purchase_insumos,
+            [product.dict() for product in purchase_data.products]
+        )
         
-        cursor = None
-        try:
-            cursor = connection.cursor(pymysql.cursors.DictCursor)
-            
-            validation_result = PurchaseService._validate_insumos_availability(
-                cursor, 
-                purchase_data.products
-            )
-            
-            if validation_result['is_valid']:
-                return {
-                    'is_valid': True,
-                    'message': 'Todos los insumos están disponibles'
-                }
-            else:
-                return {
-                    'is_valid': False,
-                    'message': 'No hay suficientes insumos',
-                    'errors': validation_result['errors']
-                }
-                
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
-                
+        if validation_result['is_valid']:
+            return {
+                'is_valid': True,
+                'message': 'Todos los insumos están disponibles'
+            }
+        else:
+            return {
+                'is_valid': False,
+                'message': 'No hay suficientes insumos',
+                'errors': validation_result['errors']
+            }
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -218,19 +373,45 @@ async def validate_purchase(purchase_data: PurchaseCreate):
         )
 
 @router_services.post("/purchases")
-async def create_purchase(purchase_data: PurchaseCreate):
+async def create_purchase(
+    purchase_data: PurchaseCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=150)
+):
     """
     Crea una nueva compra/factura con todos sus detalles.
     
     Incluye información del cliente, vendedor, productos, domicilio (si aplica) y pago.
+    
+    Los reintentos son idempotentes: con la misma cabecera Idempotency-Key (o, sin
+    ella, el mismo invoice_number) se devuelve la respuesta de la compra original
+    sin volver a validarla, con la cabecera Idempotent-Replayed: true. Un reintento
+    que llega mientras la original se está registrando espera a que termine.
     """
     try:
         print(f"Recibida solicitud para crear compra/factura: {purchase_data.invoice_number}")
         print(f"Productos en la solicitud: {len(purchase_data.products)}")
         
-        result = PurchaseService.create_purchase(purchase_data.dict())
+        data = purchase_data.dict()
+        key = f"purchases:{idempotency_key or 'invoice:' + purchase_data.invoice_number}"
+        result, replayed = await run_in_threadpool(
+            run_idempotent, key, request_fingerprint(data), lambda: PurchaseService.create_purchase(data),
+            lambda: PurchaseService.find_created_purchase(data['invoice_number'])
+        )
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
         print(f"Compra creada exitosamente: {result}")
         return result
+    except IdempotencyConflict:
+        raise HTTPException(
+            status_code=422,
+            detail="La clave de idempotencia ya se usó con una compra distinta"
+        )
+    except IdempotencyInProgress:
+        raise HTTPException(
+            status_code=409,
+            detail="La compra con esta clave todavía se está registrando; reintente en unos segundos"
+        )
     except ValueError as ve:
         print(f"Error de validación en compra: {str(ve)}")
         raise HTTPException(
@@ -244,6 +425,125 @@ async def create_purchase(purchase_data: PurchaseCreate):
             detail=f"Error al crear la compra: {str(e)}"
         )
 
+class _UploadStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse que no espera la desconexión del cliente en paralelo
+
+    StreamingResponse lee los mensajes de la petición para detectar la
+    desconexión y se quedaría con los trozos del cuerpo; así el generador puede
+    seguir leyendo el cuerpo mientras envía la respuesta.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+def _request_lines(request: Request):
+    """
+    Líneas del cuerpo a medida que llegan, para recorrerlas desde el threadpool
+
+    Cada línea se pide al bucle de eventos con anyio.from_thread; el cuerpo no
+    se carga entero en memoria.
+    """
+    async def read_lines():
+        pending = b''
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+
+    lines = read_lines()
+    while True:
+        try:
+            yield anyio.from_thread.run(lines.__anext__)
+        except StopAsyncIteration:
+            return
+
+def _ndjson_items(lines):
+    """Elementos de un cuerpo NDJSON (una excepción en lugar de cada línea mal formada)"""
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield e
+
+@router_services.post("/purchases/bulk")
+async def create_purchases_bulk(
+    request: Request,
+    batch_size: Optional[int] = Query(None, ge=1, le=500, description="Compras por transacción")
+):
+    """
+    Registra muchas compras de una vez (p. ej. las que un punto de venta acumuló sin conexión).
+    
+    El cuerpo es un arreglo JSON de compras o NDJSON (una compra por línea,
+    Content-Type: application/x-ndjson), con el mismo formato que POST /purchases.
+    La respuesta es NDJSON: una línea por compra (con su posición en el envío)
+    a medida que se confirma cada lote, y una última línea con el resumen.
+    Las facturas ya registradas o repetidas en el envío se devuelven como 'duplicate'.
+    
+    Con NDJSON el cuerpo se lee línea a línea mientras se registran los lotes:
+    el primer lote empieza en cuanto llegan sus líneas.
+    """
+    content_type = request.headers.get('content-type', '')
+    
+    if 'ndjson' in content_type:
+        items = _ndjson_items(_request_lines(request))
+    else:
+        body = await request.body()
+        if not body.lstrip().startswith(b'['):
+            items = _ndjson_items(body.split(b'\n'))
+        else:
+            try:
+                items = json.loads(body)
+            except json.JSONDecodeError as e:
+                raise HTTPException(status_code=400, detail=f"JSON inválido: {str(e)}")
+            if not isinstance(items, list):
+                raise HTTPException(status_code=400, detail="Se esperaba un arreglo de compras")
+    
+    summary = {'total': 0, 'created': 0, 'duplicate': 0, 'rejected': 0, 'error': 0}
+    invalid = []
+    
+    def purchases():
+        # Cada elemento se valida por separado: uno mal formado no invalida el envío
+        for index, item in enumerate(items):
+            summary['total'] += 1
+            try:
+                if isinstance(item, Exception):
+                    raise ValueError(f"Línea JSON inválida: {str(item)}")
+                yield index, PurchaseCreate.parse_obj(item).dict()
+            except (ValueError, ValidationError) as e:
+                invalid.append({
+                    'index': index,
+                    'invoice_number': item.get('invoice_number') if isinstance(item, dict) else None,
+                    'status': 'rejected',
+                    'purchase_id': None,
+                    'message': str(e)
+                })
+    
+    def generate():
+        def emit(result):
+            summary[result['status']] += 1
+            return json.dumps(result, ensure_ascii=False) + "\n"
+        
+        # Los rechazados por formato se envían junto con el siguiente lote confirmado
+        for result in PurchaseService.create_purchases_bulk(purchases(), batch_size):
+            for rejected in invalid:
+                yield emit(rejected)
+            invalid.clear()
+            yield emit(result)
+        for rejected in invalid:
+            yield emit(rejected)
+        yield json.dumps({'summary': summary}) + "\n"
+    
+    # El generador se recorre en el threadpool; cada lote se envía en cuanto se
+    # confirma su transacción
+    return _UploadStreamingResponse(generate(), media_type="application/x-ndjson")
+
 @router_services.get("/purchases/{invoice_number}")
 async def get_purchase(invoice_number: str):
     """
@@ -328,7 +628,7 @@ async def cancel_purchase(
     La compra no se elimina, solo se marca como cancelada en las notas.
     """
     try:
-        result = PurchaseService.cancel_purchase(invoice_number, reason)
+        result = await run_in_threadpool(PurchaseService.cancel_purchase, invoice_number, reason)
         return result
     except ValueError as ve:
         raise HTTPException(
@@ -341,6 +641,29 @@ async def cancel_purchase(
             detail=f"Error al cancelar la compra: {str(e)}"
         )
 
+@router_services.post("/purchases/cancel")
+async def cancel_purchases(cancel_data: PurchaseCancelBatch):
+    """
+    Cancela varias compras en una sola transacción y restaura sus insumos.
+    
+    El consumo de todas las facturas se suma y se restaura con una sola
+    actualización. Devuelve el resultado de cada factura: 'cancelled',
+    'not_found' o 'already_cancelled'.
+    """
+    try:
+        results = await run_in_threadpool(
+            PurchaseService.cancel_purchases, cancel_data.invoice_numbers, cancel_data.reason
+        )
+        return {
+            'cancelled': sum(1 for result in results if result['status'] == 'cancelled'),
+            'results': results
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al cancelar las compras: {str(e)}"
+        )
+
 # Nuevos endpoints para análisis de inventario y ventas
 @router_services.get("/inventory/status")
 async def get_inventory_status():
@@ -394,7 +717,8 @@ async def get_insumos_consumption_report(
     """
     Obtiene un reporte del consumo de insumos.
     
-    Muestra qué insumos se han consumido más y su valor total.
+    Muestra qué insumos se han consumido más en el período (ventas menos
+    cancelaciones, según el libro de movimientos) y su valor.
     """
     try:
         # Si no se especifican fechas, usar todo el histórico
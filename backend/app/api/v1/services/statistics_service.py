@@ -3,6 +3,7 @@ from typing import Dict, List, Any, Optional
 from datetime import date, datetime, timedelta
 import pymysql
 from database.db import get_db_connection
+from database import async_db
 
 # Router para los endpoints de estadísticas
 router_statistics = APIRouter()
@@ -11,100 +12,91 @@ class StatisticsService:
     """Servicio para proporcionar estadísticas de la aplicación"""
     
     @staticmethod
-    def get_app_statistics() -> Dict[str, Any]:
+    async def get_app_statistics() -> Dict[str, Any]:
         """
-        Obtiene estadísticas generales de la aplicación
+        Obtiene estadísticas generales de la aplicación.
+        
+        Usa la capa async de base de datos para no bloquear el event loop.
         
         Returns:
             Dict con información estadística de la aplicación
         """
         try:
-            connection = get_db_connection()
-            if not connection:
+            statistics = {}
+            
+            # 1. Total de productos activos
+            result = await async_db.fetch_one("""
+                SELECT COUNT(*) as total_products 
+                FROM products 
+            """)
+            if result is None:
                 return {
                     "error": "No se pudo establecer conexión con la base de datos"
                 }
+            statistics["total_products"] = result["total_products"] if result else 0
             
-            cursor = None
-            statistics = {}
+            # 2. Total de ventas en el mes actual
+            result = await async_db.fetch_one("""
+                SELECT COUNT(*) as total_sales, SUM(total_amount) as monthly_revenue
+                FROM purchases
+            """)
+            statistics["monthly_sales"] = {
+                "count": result["total_sales"] if result and result["total_sales"] else 0,
+                "revenue": float(result["monthly_revenue"]) if result and result["monthly_revenue"] else 0.0
+            }
             
-            try:
-                cursor = connection.cursor(pymysql.cursors.DictCursor)
-                
-                # 1. Total de productos activos
-                cursor.execute("""
-                    SELECT COUNT(*) as total_products 
-                    FROM products 
-                """)
-                result = cursor.fetchone()
-                statistics["total_products"] = result["total_products"] if result else 0
-                
-                # 2. Total de ventas en el mes actual
-                cursor.execute("""
-                    SELECT COUNT(*) as total_sales, SUM(total_amount) as monthly_revenue
-                    FROM purchases
-                """)
-                result = cursor.fetchone()
-                statistics["monthly_sales"] = {
-                    "count": result["total_sales"] if result and result["total_sales"] else 0,
-                    "revenue": float(result["monthly_revenue"]) if result and result["monthly_revenue"] else 0.0
-                }
-                
-                # 3. Ventas por día (simplificado)
-                cursor.execute("""
-                    SELECT 
-                        invoice_date as sale_date,
-                        COUNT(*) as sales_count,
-                        SUM(total_amount) as daily_revenue
-                    FROM purchases
-                    GROUP BY invoice_date
-                    LIMIT 30
-                """)
-                
-                weekly_sales = []
-                for row in cursor.fetchall():
-                    weekly_sales.append({
-                        "date": row["sale_date"],
-                        "count": row["sales_count"],
-                        "revenue": float(row["daily_revenue"]) if row["daily_revenue"] else 0.0
-                    })
-                
-                statistics["weekly_sales"] = weekly_sales
-                
-                # 4. Productos más vendidos (simplificado)
-                cursor.execute("""
-                    SELECT 
-                        pd.product_name,
-                        pd.product_variant,
-                        SUM(pd.quantity) as total_quantity,
-                        SUM(pd.subtotal) as total_revenue,
-                        COUNT(DISTINCT p.id) as numero_ordenes
-                    FROM purchase_details pd
-                    JOIN purchases p ON pd.purchase_id = p.id
-                    GROUP BY pd.product_name, pd.product_variant
-                    ORDER BY total_quantity DESC
-                    LIMIT 5
-                """)
-                
-                top_products = []
-                for row in cursor.fetchall():
-                    top_products.append({
-                        "product_name": row["product_name"],
-                        "product_variant": row["product_variant"] if row["product_variant"] else "",
-                        "quantity_sold": row["total_quantity"],
-                        "revenue": float(row["total_revenue"]) if row["total_revenue"] else 0.0,
-                        "numero_ordenes": row["numero_ordenes"]
-                    })
-                
-                statistics["top_products"] = top_products
-                
-                return statistics
-                
-            finally:
-                if cursor:
-                    cursor.close()
-                if connection:
-                    connection.close()
+            # 3. Ventas por día (simplificado)
+            rows = await async_db.fetch_rows("""
+                SELECT 
+                    invoice_date as sale_date,
+                    COUNT(*) as sales_count,
+                    SUM(total_amount) as daily_revenue
+                FROM purchases
+                GROUP BY invoice_date
+                LIMIT 30
+            """)
+            
+            weekly_sales = []
+            for sale_date, sales_count, daily_revenue in rows or ():
+                weekly_sales.append({
+                    "date": sale_date,
+                    "count": sales_count,
+                    "revenue": float(daily_revenue) if daily_revenue else 0.0
+                })
+            
+            statistics["weekly_sales"] = weekly_sales
+            
+            # 4. Productos más vendidos (simplificado)
+            rows = await async_db.fetch_rows("""
+                SELECT 
+                    MAX(COALESCE(pr.nombre_producto, pd.product_name)) AS product_name,
+                    MAX(CASE WHEN pr.id IS NULL THEN pd.product_variant ELSE pr.variante END) AS product_variant,
+                    SUM(pd.quantity) as total_quantity,
+                    SUM(pd.subtotal) as total_revenue,
+                    COUNT(DISTINCT p.id) as numero_ordenes
+                FROM purchase_details pd
+                JOIN purchases p ON pd.purchase_id = p.id
+                LEFT JOIN products pr ON pd.product_id = pr.id
+                GROUP BY pd.product_id,
+                         CASE WHEN pd.product_id IS NULL THEN pd.product_name END,
+                         CASE WHEN pd.product_id IS NULL THEN pd.product_variant END
+                ORDER BY total_quantity DESC
+                LIMIT 5
+            """)
+            
+            top_products = []
+            for product_name, product_variant, total_quantity, total_revenue, numero_ordenes in rows or ():
+                top_products.append({
+                    "product_name": product_name,
+                    "product_variant": product_variant if product_variant else "",
+                    "quantity_sold": total_quantity,
+                    "revenue": float(total_revenue) if total_revenue else 0.0,
+                    "numero_ordenes": numero_ordenes
+                })
+            
+            statistics["top_products"] = top_products
+            
+            return statistics
                     
         except Exception as e:
             print(f"Error obteniendo estadísticas: {str(e)}")
@@ -141,7 +133,8 @@ class StatisticsService:
             statistics = {}
             
             try:
-                cursor = connection.cursor(pymysql.cursors.DictCursor)
+                # Filas como tuplas (modo compacto): no se crea un diccionario por fila
+                cursor = connection.cursor()
                 
                 # Estadísticas por día (últimos 30 días)
                 if time_range == "day":
@@ -162,12 +155,12 @@ class StatisticsService:
                     """, (month_ago.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')))
                     
                     daily_sales = []
-                    for row in cursor.fetchall():
+                    for fecha, total_ventas, ingresos_dia, ticket_promedio in cursor.fetchall():
                         daily_sales.append({
-                            "fecha": row["fecha"],
-                            "total_ventas": row["total_ventas"],
-                            "ingresos": float(row["ingresos_dia"]) if row["ingresos_dia"] else 0.0,
-                            "ticket_promedio": float(row["ticket_promedio"]) if row["ticket_promedio"] else 0.0
+                            "fecha": fecha,
+                            "total_ventas": total_ventas,
+                            "ingresos": float(ingresos_dia) if ingresos_dia else 0.0,
+                            "ticket_promedio": float(ticket_promedio) if ticket_promedio else 0.0
                         })
                     
                     statistics["ventas_por_dia"] = daily_sales
@@ -189,13 +182,13 @@ class StatisticsService:
                     """)
                     
                     monthly_sales = []
-                    for row in cursor.fetchall():
+                    for año, mes, total_ventas, ingresos_mes, ingresos_domicilio in cursor.fetchall():
                         monthly_sales.append({
-                            "año": row["año"],
-                            "mes": row["mes"],
-                            "total_ventas": row["total_ventas"],
-                            "ingresos": float(row["ingresos_mes"]) if row["ingresos_mes"] else 0.0,
-                            "ingresos_domicilio": float(row["ingresos_domicilio"]) if row["ingresos_domicilio"] else 0.0
+                            "año": año,
+                            "mes": mes,
+                            "total_ventas": total_ventas,
+                            "ingresos": float(ingresos_mes) if ingresos_mes else 0.0,
+                            "ingresos_domicilio": float(ingresos_domicilio) if ingresos_domicilio else 0.0
                         })
                     
                     statistics["ventas_por_mes"] = monthly_sales
@@ -217,13 +210,13 @@ class StatisticsService:
                     """)
                     
                     weekly_sales = []
-                    for row in cursor.fetchall():
+                    for semana, inicio_semana, fin_semana, ventas_semana, ingresos_semana in cursor.fetchall():
                         weekly_sales.append({
-                            "semana": row["semana"],
-                            "inicio_semana": row["inicio_semana"].strftime('%d/%m/%Y') if row["inicio_semana"] else "",
-                            "fin_semana": row["fin_semana"].strftime('%d/%m/%Y') if row["fin_semana"] else "",
-                            "total_ventas": row["ventas_semana"],
-                            "ingresos": float(row["ingresos_semana"]) if row["ingresos_semana"] else 0.0
+                            "semana": semana,
+                            "inicio_semana": inicio_semana.strftime('%d/%m/%Y') if inicio_semana else "",
+                            "fin_semana": fin_semana.strftime('%d/%m/%Y') if fin_semana else "",
+                            "total_ventas": ventas_semana,
+                            "ingresos": float(ingresos_semana) if ingresos_semana else 0.0
                         })
                     
                     statistics["ventas_por_semana"] = weekly_sales
@@ -244,13 +237,13 @@ class StatisticsService:
                     """)
                     
                     yearly_sales = []
-                    for row in cursor.fetchall():
+                    for año, total_ventas, ingresos_año, ticket_promedio, ingresos_domicilio in cursor.fetchall():
                         yearly_sales.append({
-                            "año": row["año"],
-                            "total_ventas": row["total_ventas"],
-                            "ingresos": float(row["ingresos_año"]) if row["ingresos_año"] else 0.0,
-                            "ticket_promedio": float(row["ticket_promedio"]) if row["ticket_promedio"] else 0.0,
-                            "ingresos_domicilio": float(row["ingresos_domicilio"]) if row["ingresos_domicilio"] else 0.0
+                            "año": año,
+                            "total_ventas": total_ventas,
+                            "ingresos": float(ingresos_año) if ingresos_año else 0.0,
+                            "ticket_promedio": float(ticket_promedio) if ticket_promedio else 0.0,
+                            "ingresos_domicilio": float(ingresos_domicilio) if ingresos_domicilio else 0.0
                         })
                     
                     statistics["ventas_por_año"] = yearly_sales
@@ -292,7 +285,8 @@ class StatisticsService:
             statistics = {}
             
             try:
-                cursor = connection.cursor(pymysql.cursors.DictCursor)
+                # Filas como tuplas (modo compacto): no se crea un diccionario por fila
+                cursor = connection.cursor()
                 
                 # Si no se especifican fechas, usar todo el histórico
                 if not start_date:
@@ -307,28 +301,31 @@ class StatisticsService:
                 # Productos más vendidos por período
                 cursor.execute("""
                     SELECT 
-                        pd.product_name,
-                        pd.product_variant,
+                        MAX(COALESCE(pr.nombre_producto, pd.product_name)) AS product_name,
+                        MAX(CASE WHEN pr.id IS NULL THEN pd.product_variant ELSE pr.variante END) AS product_variant,
                         SUM(pd.quantity) as total_vendido,
                         SUM(pd.subtotal) as ingresos_producto,
                         COUNT(DISTINCT p.id) as numero_ordenes
                     FROM purchase_details pd
                     JOIN purchases p ON pd.purchase_id = p.id
+                    LEFT JOIN products pr ON pd.product_id = pr.id
                     WHERE p.is_cancelled = 0
                       AND STR_TO_DATE(p.invoice_date, '%%d/%%m/%%Y') BETWEEN STR_TO_DATE(%s, '%%Y-%%m-%%d') AND STR_TO_DATE(%s, '%%Y-%%m-%%d')
-                    GROUP BY pd.product_name, pd.product_variant
+                    GROUP BY pd.product_id,
+                             CASE WHEN pd.product_id IS NULL THEN pd.product_name END,
+                             CASE WHEN pd.product_id IS NULL THEN pd.product_variant END
                     ORDER BY total_vendido DESC
                     LIMIT 20
                 """, (start_date_str, end_date_str))
                 
                 top_products = []
-                for row in cursor.fetchall():
+                for product_name, product_variant, total_vendido, ingresos_producto, numero_ordenes in cursor.fetchall():
                     top_products.append({
-                        "producto": row["product_name"],
-                        "variante": row["product_variant"] if row["product_variant"] else "",
-                        "cantidad_vendida": row["total_vendido"],
-                        "ingresos": float(row["ingresos_producto"]) if row["ingresos_producto"] else 0.0,
-                        "numero_ordenes": row["numero_ordenes"]
+                        "producto": product_name,
+                        "variante": product_variant if product_variant else "",
+                        "cantidad_vendida": total_vendido,
+                        "ingresos": float(ingresos_producto) if ingresos_producto else 0.0,
+                        "numero_ordenes": numero_ordenes
                     })
                 
                 statistics["productos_mas_vendidos"] = top_products
@@ -452,7 +449,8 @@ class StatisticsService:
 
             cursor = None
             try:
-                cursor = connection.cursor(pymysql.cursors.DictCursor)
+                # Filas como tuplas (modo compacto): no se crea un diccionario por fila
+                cursor = connection.cursor()
                 
                 # Consulta muy básica que debería funcionar sin problemas
                 query = """
@@ -469,10 +467,10 @@ class StatisticsService:
                     cursor.execute(query)
                     
                     sales_summary = []
-                    for row in cursor.fetchall():
+                    for fecha_texto, total in cursor.fetchall():
                         sales_summary.append({
-                            "fecha": row["fecha_texto"],
-                            "total": float(row["total"]) if row["total"] else 0.0
+                            "fecha": fecha_texto,
+                            "total": float(total) if total else 0.0
                         })
                     
                     return {"sales_summary": sales_summary}
@@ -492,7 +490,7 @@ class StatisticsService:
                     
                     return {
                         "message": "No se pudieron agrupar las ventas por fecha debido a problemas con los datos",
-                        "total_general": float(result["total_general"]) if result and result["total_general"] else 0.0
+                        "total_general": float(result[0]) if result and result[0] else 0.0
                     }
                 
             finally:
@@ -521,7 +519,7 @@ async def get_app_statistics():
     - Productos más vendidos
     """
     try:
-        statistics = StatisticsService.get_app_statistics()
+        statistics = await StatisticsService.get_app_statistics()
         
         if "error" in statistics and not any(key != "error" for key in statistics):
             # Solo hay un error y no hay datos
@@ -1,5 +1,10 @@
-from database.db  import execute_query
-from typing import List, Dict, Any, Optional
+from database.rows import RowSet
+from models.catalog import product_catalog
+from models.insumo_ledger import ledger_start, ledger_state
+from models.product_availability import load_product_availability
+from models.stock_engine import stock_engine
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Union
 import logging
 
 logger = logging.getLogger(__name__)
@@ -7,8 +12,34 @@ logger = logging.getLogger(__name__)
 class StockService:
     """Servicio para calcular y gestionar el stock de productos basado en insumos disponibles"""
     
+    # Columnas de las filas de stock en modo compacto
+    STOCK_COLUMNS = ('producto_id', 'nombre_producto', 'variante', 'precio', 'categoria_nombre', 'stock_disponible', 'tipo')
+    LOW_STOCK_COLUMNS = ('producto_id', 'nombre_producto', 'variante', 'precio', 'categoria_nombre', 'stock_disponible', 'min_stock', 'estado')
+    
     @staticmethod
-    def calculate_product_stock() -> List[Dict[str, Any]]:
+    def _active_products_stock():
+        """
+        Productos activos del catálogo con sus unidades disponibles de product_availability
+
+        Una lectura de la tabla materializada, sin joins; nombres, precios y
+        categorías salen del catálogo en memoria.
+
+        Returns:
+            Lista de (CatalogProduct, stock_disponible) ordenada por nombre
+
+        Raises:
+            Exception: si no se pudo cargar el catálogo o la disponibilidad
+        """
+        products = product_catalog.products()
+        availability = load_product_availability()
+        if products is None or availability is None:
+            raise Exception("No se pudo cargar la disponibilidad de los productos")
+        products.sort(key=lambda product: (product.nombre_producto.casefold(), product.id))
+        # Sin fila: el producto no tiene receta (0 unidades)
+        return [(product, availability.get(product.id, (0, None))[0]) for product in products]
+    
+    @staticmethod
+    def calculate_product_stock(compact: bool = False) -> Union[List[Dict[str, Any]], RowSet]:
         """
         Calcula cuántas unidades de cada producto se pueden hacer con los insumos disponibles.
         
@@ -18,202 +49,226 @@ class StockService:
         - stock_disponible (cantidad que se puede producir)
         - categoria_nombre
         - precio
-        """
-        query = """
-        SELECT
-            p.id AS producto_id,
-            p.nombre_producto,
-            p.variante,
-            p.price AS precio,
-            c.nombre_categoria AS categoria_nombre,
-            COALESCE(FLOOR(MIN(
-                (i.cantidad_unitaria - i.cantidad_utilizada) / 
-                CASE 
-                    WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto
-                    ELSE pr.cantidad
-                END
-            )), 0) AS stock_disponible
-        FROM products p
-        LEFT JOIN categories c ON p.category_id = c.id
-        LEFT JOIN product_recipes pr ON p.id = pr.product_id
-        LEFT JOIN insumos i ON pr.insumo_id = i.id
-        WHERE p.is_active = TRUE
-        GROUP BY p.id, p.nombre_producto, p.variante, p.price, c.nombre_categoria
-        ORDER BY p.nombre_producto
-        """
         
+        Con compact=True retorna un RowSet de tuplas en el orden de STOCK_COLUMNS.
+        """
         try:
-            print("DEBUG - Ejecutando cálculo de stock de productos")
-            results = execute_query(query, fetch_all=True)
+            trace = logger.isEnabledFor(logging.DEBUG)
+            stock_rows = []
+            for product, stock_disponible in StockService._active_products_stock():
+                stock_info = (
+                    product.id,
+                    product.nombre_producto,
+                    product.variante or '',
+                    float(product.price),
+                    product.nombre_categoria or 'Sin categoría',
+                    stock_disponible,
+                    'producto'
+                )
+                if trace:
+                    logger.debug("Producto: %s - Stock disponible: %s", product.nombre_producto, stock_disponible)
+                stock_rows.append(stock_info)
             
-            # Transformar resultados para incluir información adicional
-            stock_data = []
-            for row in results:
-                stock_info = {
-                    'producto_id': row['producto_id'],
-                    'nombre_producto': row['nombre_producto'],
-                    'variante': row['variante'] or '',
-                    'precio': float(row['precio']),
-                    'categoria_nombre': row['categoria_nombre'] or 'Sin categoría',
-                    'stock_disponible': int(row['stock_disponible']) if row['stock_disponible'] is not None else 0,
-                    'tipo': 'producto'
-                }
-                print(f"DEBUG - Producto: {stock_info['nombre_producto']} - Stock disponible: {stock_info['stock_disponible']}")
-                stock_data.append(stock_info)
-            
-            return stock_data
+            stock_data = RowSet(StockService.STOCK_COLUMNS, stock_rows)
+            return stock_data if compact else stock_data.to_dicts()
             
         except Exception as e:
-            logger.error(f"Error calculando stock de productos: {e}")
-            print(f"DEBUG - Error calculando stock: {e}")
-            return []
+            logger.error("Error calculando stock de productos: %s", e)
+            return RowSet(StockService.STOCK_COLUMNS, []) if compact else []
     
     @staticmethod
-    def get_low_stock_products(min_stock_threshold: int = 5) -> List[Dict[str, Any]]:
+    def get_low_stock_products(min_stock_threshold: int = 5, compact: bool = False) -> Union[List[Dict[str, Any]], RowSet]:
         """
         Obtiene productos que están por agotarse basándose en el stock calculado.
         
         Args:
             min_stock_threshold: Umbral mínimo de stock para considerar un producto como "por agotarse"
+            compact: Retornar un RowSet de tuplas en el orden de LOW_STOCK_COLUMNS
         
         Retorna productos con stock_disponible <= min_stock_threshold
         """
-        query = """
-        WITH stock_por_producto AS (
-            SELECT
-                p.id AS producto_id,
-                p.nombre_producto,
-                p.variante,
-                p.price AS precio,
-                c.nombre_categoria AS categoria_nombre,
-                p.min_stock,
-                COALESCE(FLOOR(MIN(
-                    (i.cantidad_unitaria - i.cantidad_utilizada) / 
-                    CASE 
-                        WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto
-                        ELSE pr.cantidad
-                    END
-                )), 0) AS stock_disponible
-            FROM products p
-            LEFT JOIN categories c ON p.category_id = c.id
-            LEFT JOIN product_recipes pr ON p.id = pr.product_id
-            LEFT JOIN insumos i ON pr.insumo_id = i.id
-            WHERE p.is_active = TRUE
-            GROUP BY p.id, p.nombre_producto, p.variante, p.price, c.nombre_categoria, p.min_stock
-        )
-        SELECT *
-        FROM stock_por_producto
-        WHERE stock_disponible <= %s
-        ORDER BY stock_disponible ASC, nombre_producto
-        """
-        
         try:
-            results = execute_query(query, (min_stock_threshold,), fetch_all=True)
+            low_stock_rows = []
+            for product, stock_disponible in StockService._active_products_stock():
+                if stock_disponible > min_stock_threshold:
+                    continue
+                low_stock_rows.append((
+                    product.id,
+                    product.nombre_producto,
+                    product.variante or '',
+                    float(product.price),
+                    product.nombre_categoria or 'Sin categoría',
+                    stock_disponible,
+                    int(product.min_stock or 0),
+                    'crítico' if stock_disponible == 0 else 'bajo'
+                ))
+            # Los productos ya vienen por nombre: el orden estable deja stock ASC, nombre
+            low_stock_rows.sort(key=lambda row: row[5])
             
-            low_stock_products = []
-            for row in results:
-                product_info = {
-                    'producto_id': row['producto_id'],
-                    'nombre_producto': row['nombre_producto'],
-                    'variante': row['variante'] or '',
-                    'precio': float(row['precio']),
-                    'categoria_nombre': row['categoria_nombre'] or 'Sin categoría',
-                    'stock_disponible': int(row['stock_disponible']),
-                    'min_stock': int(row['min_stock']),
-                    'estado': 'crítico' if row['stock_disponible'] == 0 else 'bajo'
-                }
-                low_stock_products.append(product_info)
-            
-            return low_stock_products
+            low_stock_products = RowSet(StockService.LOW_STOCK_COLUMNS, low_stock_rows)
+            return low_stock_products if compact else low_stock_products.to_dicts()
             
         except Exception as e:
             logger.error(f"Error obteniendo productos con stock bajo: {e}")
-            return []
+            return RowSet(StockService.LOW_STOCK_COLUMNS, []) if compact else []
     
     @staticmethod
     def get_product_stock_details(product_id: int) -> Optional[Dict[str, Any]]:
         """
         Obtiene detalles del stock de un producto específico, incluyendo
         el detalle de cada insumo y cuánto limita la producción.
-        """
-        # Primero obtener info del producto
-        product_query = """
-        SELECT 
-            p.id, 
-            p.nombre_producto,
-            p.variante,
-            p.price,
-            c.nombre_categoria
-        FROM products p
-        LEFT JOIN categories c ON p.category_id = c.id
-        WHERE p.id = %s AND p.is_active = TRUE
-        """
         
-        product = execute_query(product_query, (product_id,), fetch_one=True)
+        Se calcula con el motor de stock (matriz de recetas en memoria y una
+        lectura del vector de insumos), sin consultas por producto.
+        """
+        # Primero obtener info del producto (catálogo en memoria, sin consulta)
+        product = product_catalog.get(product_id)
         if not product:
             return None
         
-        # Obtener detalles de cada insumo
-        insumos_query = """
-        SELECT 
-            i.id AS insumo_id,
-            i.nombre_insumo,
-            i.unidad,
-            (i.cantidad_unitaria - i.cantidad_utilizada) AS cantidad_disponible,
-            pr.cantidad AS cantidad_receta,
-            i.cantidad_por_producto,
-            CASE 
-                WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto
-                ELSE pr.cantidad
-            END AS cantidad_requerida,
-            FLOOR(
-                (i.cantidad_unitaria - i.cantidad_utilizada) / 
-                CASE 
-                    WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto
-                    ELSE pr.cantidad
-                END
-            ) AS unidades_posibles
-        FROM product_recipes pr
-        JOIN insumos i ON pr.insumo_id = i.id
-        WHERE pr.product_id = %s
-        ORDER BY unidades_posibles ASC
-        """
-        
-        insumos_details = execute_query(insumos_query, (product_id,), fetch_all=True)
+        snapshot = stock_engine.snapshot()
+        insumos_details = snapshot.product_detail(product_id) or []
         
-        # Calcular stock disponible (el mínimo de unidades posibles)
-        stock_disponible = 0
-        if insumos_details:
-            stock_disponible = min([row['unidades_posibles'] for row in insumos_details])
+        # Stock disponible: el mínimo de unidades posibles (el detalle viene ordenado)
+        stock_disponible = insumos_details[0][4] if insumos_details else 0
         
         # Preparar respuesta
         result = {
-            'producto_id': product['id'],
-            'nombre_producto': product['nombre_producto'],
-            'variante': product['variante'] or '',
-            'precio': float(product['price']),
-            'categoria_nombre': product['nombre_categoria'] or 'Sin categoría',
+            'producto_id': product.id,
+            'nombre_producto': product.nombre_producto,
+            'variante': product.variante or '',
+            'precio': float(product.price),
+            'categoria_nombre': product.nombre_categoria or 'Sin categoría',
             'stock_disponible': int(stock_disponible),
             'insumos_detalle': []
         }
         
         # Agregar detalles de cada insumo
-        for insumo in insumos_details:
+        for insumo_id, cantidad_disponible, cantidad_receta, cantidad_requerida, unidades_posibles in insumos_details:
+            nombre_insumo, unidad, _, cantidad_por_producto = snapshot.insumos[insumo_id]
             insumo_info = {
-                'insumo_id': insumo['insumo_id'],
-                'nombre_insumo': insumo['nombre_insumo'],
-                'unidad': insumo['unidad'],
-                'cantidad_disponible': float(insumo['cantidad_disponible']),
-                'cantidad_receta': float(insumo['cantidad_receta']),
-                'cantidad_por_producto': float(insumo['cantidad_por_producto']) if insumo['cantidad_por_producto'] else 0,
-                'cantidad_requerida': float(insumo['cantidad_requerida']),
-                'unidades_posibles': int(insumo['unidades_posibles']),
-                'es_limitante': int(insumo['unidades_posibles']) == stock_disponible
+                'insumo_id': insumo_id,
+                'nombre_insumo': nombre_insumo,
+                'unidad': unidad,
+                'cantidad_disponible': cantidad_disponible,
+                'cantidad_receta': cantidad_receta,
+                'cantidad_por_producto': cantidad_por_producto,
+                'cantidad_requerida': cantidad_requerida,
+                'unidades_posibles': unidades_posibles,
+                'es_limitante': unidades_posibles == stock_disponible
             }
             result['insumos_detalle'].append(insumo_info)
         
         return result
     
+    @staticmethod
+    def what_if(scenarios: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Evalúa escenarios hipotéticos sobre el stock actual sin modificar nada
+        
+        Args:
+            scenarios: Lista de {'cart': {product_id: unidades}, 'restock': {insumo_id: cantidad}};
+                el carrito se descuenta de los insumos y la reposición se suma
+        
+        Retorna por escenario los productos activos cuyas unidades disponibles
+        cambian (antes y después), los que se agotan y los que vuelven a estar
+        disponibles.
+        """
+        snapshot = stock_engine.snapshot()
+        results = []
+        for changes in snapshot.what_if(scenarios):
+            productos = []
+            for product_id, (antes, despues) in changes.items():
+                product = product_catalog.get(product_id)
+                if product is None:
+                    continue
+                productos.append({
+                    'producto_id': product_id,
+                    'nombre_producto': product.nombre_producto,
+                    'variante': product.variante or '',
+                    'stock_antes': antes,
+                    'stock_despues': despues
+                })
+            productos.sort(key=lambda item: (item['nombre_producto'].casefold(), item['producto_id']))
+            results.append({
+                'productos': productos,
+                'se_agotan': [item['producto_id'] for item in productos if item['stock_antes'] > 0 >= item['stock_despues']],
+                'se_habilitan': [item['producto_id'] for item in productos if item['stock_antes'] <= 0 < item['stock_despues']]
+            })
+        return results
+    
+    @staticmethod
+    def stock_as_of(moment: datetime) -> Dict[str, Any]:
+        """
+        Reconstruye el inventario a una fecha y hora pasada
+        
+        Los saldos de los insumos salen del libro de movimientos (punto de
+        control o instantánea diaria más reciente más los movimientos hasta
+        moment). Las unidades de los productos se calculan con el motor de stock,
+        es decir, con la misma fórmula que la disponibilidad actual, sobre las
+        recetas vigentes.
+        
+        Args:
+            moment: Fecha y hora a reconstruir; con zona horaria se convierte a la
+                hora local del servidor, la de created_at en el libro
+        
+        Retorna el punto de partida usado, los movimientos sumados, el saldo de
+        cada insumo y las unidades de cada producto activo con su insumo limitante.
+        
+        Raises:
+            ValueError: Si moment no es posterior al primer movimiento del libro
+                (los saldos iniciales); antes de él no hay datos
+        """
+        if moment.tzinfo is not None:
+            # pymysql envía las fechas sin su desfase: se pasa a hora local sin zona
+            moment = moment.astimezone().replace(tzinfo=None)
+        start = ledger_start()
+        if start is None or moment <= start:
+            since = f" antes del {start.isoformat(sep=' ', timespec='seconds')}" if start is not None else ""
+            raise ValueError(f"El libro de movimientos de insumos no tiene datos{since}")
+        state = ledger_state(moment)
+        if state is None:
+            raise Exception("No se pudo reconstruir el libro de movimientos de insumos")
+        totals = state['totals']
+        snapshot = stock_engine.snapshot_at({insumo_id: balance for insumo_id, (balance, _) in totals.items()})
+        
+        insumos = [
+            {
+                'insumo_id': insumo_id,
+                'nombre_insumo': nombre,
+                'unidad': unidad,
+                'cantidad_disponible': round(remaining, 4),
+                'consumo_acumulado': round(totals.get(insumo_id, (0.0, 0.0))[1], 4)
+            }
+            for insumo_id, (nombre, unidad, remaining, _) in snapshot.insumos.items()
+        ]
+        insumos.sort(key=lambda insumo: (insumo['nombre_insumo'].casefold(), insumo['insumo_id']))
+        
+        products = product_catalog.products()
+        if products is None:
+            raise Exception("No se pudo cargar el catálogo de productos")
+        products.sort(key=lambda product: (product.nombre_producto.casefold(), product.id))
+        availability = snapshot.availability_by_product()
+        productos = []
+        for product in products:
+            # Sin receta: 0 unidades, igual que en la disponibilidad actual
+            stock_disponible, limitante = availability.get(product.id, (0, None))
+            productos.append({
+                'producto_id': product.id,
+                'nombre_producto': product.nombre_producto,
+                'variante': product.variante or '',
+                'stock_disponible': stock_disponible,
+                'insumo_limitante_id': limitante
+            })
+        
+        return {
+            'fecha': moment,
+            'punto_de_partida': {'tipo': state['base']['type'], 'fecha': state['base']['at']},
+            'movimientos_reproducidos': state['replayed'],
+            'insumos': insumos,
+            'productos': productos
+        }
+    
     @staticmethod
     def get_stock_summary() -> Dict[str, Any]:
         """
@@ -225,40 +280,22 @@ class StockService:
         - productos_stock_bajo: Productos con stock <= min_stock
         - productos_disponibles: Productos con stock > min_stock
         """
-        summary_query = """
-        WITH stock_calculado AS (
-            SELECT
-                p.id AS producto_id,
-                p.min_stock,
-                COALESCE(FLOOR(MIN(
-                    (i.cantidad_unitaria - i.cantidad_utilizada) / 
-                    CASE 
-                        WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto
-                        ELSE pr.cantidad
-                    END
-                )), 0) AS stock_disponible
-            FROM products p
-            LEFT JOIN product_recipes pr ON p.id = pr.product_id
-            LEFT JOIN insumos i ON pr.insumo_id = i.id
-            WHERE p.is_active = TRUE
-            GROUP BY p.id, p.min_stock
-        )
-        SELECT
-            COUNT(*) AS total_productos,
-            SUM(CASE WHEN stock_disponible = 0 THEN 1 ELSE 0 END) AS productos_sin_stock,
-            SUM(CASE WHEN stock_disponible > 0 AND stock_disponible <= 5 THEN 1 ELSE 0 END) AS productos_stock_bajo,
-            SUM(CASE WHEN stock_disponible > 5 THEN 1 ELSE 0 END) AS productos_disponibles
-        FROM stock_calculado
-        """
-        
         try:
-            result = execute_query(summary_query, fetch_one=True)
+            total = sin_stock = stock_bajo = disponibles = 0
+            for _, stock_disponible in StockService._active_products_stock():
+                total += 1
+                if stock_disponible == 0:
+                    sin_stock += 1
+                elif 0 < stock_disponible <= 5:
+                    stock_bajo += 1
+                elif stock_disponible > 5:
+                    disponibles += 1
             
             return {
-                'total_productos': int(result['total_productos'] or 0),
-                'productos_sin_stock': int(result['productos_sin_stock'] or 0),
-                'productos_stock_bajo': int(result['productos_stock_bajo'] or 0),
-                'productos_disponibles': int(result['productos_disponibles'] or 0),
+                'total_productos': total,
+                'productos_sin_stock': sin_stock,
+                'productos_stock_bajo': stock_bajo,
+                'productos_disponibles': disponibles,
                 'fecha_actualizacion': None  # Podríamos agregar timestamp si es necesario
             }
             
@@ -0,0 +1,46 @@
+"""
+Revisar o reconstruir la disponibilidad materializada de los productos (product_availability)
+
+Uso (desde backend/app, con las migraciones aplicadas):
+    python availability.py check      Comparar la tabla con el cálculo completo, sin cambiar nada
+    python availability.py rebuild    Recalcular la disponibilidad de todos los productos
+"""
+import argparse
+import sys
+
+from logging_config import setup_logging
+from database.db import close_pool
+from models.product_availability import check_product_availability, rebuild_product_availability
+
+def main():
+    parser = argparse.ArgumentParser(description="Disponibilidad materializada de los productos")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('check', help="Comparar la tabla con el cálculo completo")
+    subparsers.add_parser('rebuild', help="Recalcular todos los productos")
+
+    args = parser.parse_args()
+    setup_logging()
+
+    try:
+        if args.command == 'check':
+            differences = check_product_availability()
+            if differences is None:
+                print("No se pudo revisar la disponibilidad (¿migraciones aplicadas?)")
+                return 1
+            for difference in differences:
+                print(f"Producto {difference['product_id']}: guardado {difference['stored']}  "
+                      f"calculado {difference['computed']}")
+            print(f"Productos con diferencias: {len(differences)}")
+            return 1 if differences else 0
+
+        result = rebuild_product_availability()
+        if result is None:
+            print("No se pudo recalcular la disponibilidad (¿migraciones aplicadas?)")
+            return 1
+        print(f"Productos recalculados: {result['products']}  filas eliminadas: {result['removed']}")
+        return 0
+    finally:
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
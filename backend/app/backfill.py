@@ -0,0 +1,59 @@
+"""
+Completar product_id y category_id en las líneas de venta anteriores a la migración 8
+
+Uso (desde backend/app, con las migraciones aplicadas):
+    python backfill.py status                      Ver el progreso guardado
+    python backfill.py run                         Procesar hasta terminar (continúa donde quedó)
+    python backfill.py run --chunks 10 --pause 0.5 Procesar 10 bloques con pausas entre ellos
+    python backfill.py run --restart               Empezar desde el primer id (p. ej. tras renombrar productos)
+"""
+import argparse
+import sys
+
+from logging_config import setup_logging
+from database.db import close_pool
+from models.purchase_backfill import (
+    BACKFILL_CHUNK_SIZE, backfill_purchase_products, get_backfill_progress, reset_backfill_progress
+)
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill de product_id en purchase_details")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('status', help="Ver el progreso guardado")
+
+    run_parser = subparsers.add_parser('run', help="Procesar las filas pendientes")
+    run_parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help="Filas por bloque")
+    run_parser.add_argument('--chunks', type=int, default=None, help="Máximo de bloques en esta ejecución")
+    run_parser.add_argument('--pause', type=float, default=0.0, help="Segundos de espera entre bloques")
+    run_parser.add_argument('--restart', action='store_true', help="Empezar desde el primer id")
+
+    args = parser.parse_args()
+    setup_logging()
+
+    try:
+        if args.command == 'status':
+            progress = get_backfill_progress()
+            if progress is None:
+                print("No se pudo leer el progreso (¿migraciones aplicadas?)")
+                return 1
+            state = f"terminado el {progress['finished_at']}" if progress['finished_at'] else "en curso"
+            print(f"Último id: {progress['last_id']}  procesadas: {progress['processed']}  "
+                  f"resueltas: {progress['resolved']}  ({state})")
+            return 0
+
+        if args.restart:
+            reset_backfill_progress()
+        result = backfill_purchase_products(args.chunk_size, args.chunks, args.pause)
+        if result is None:
+            print("No se pudo ejecutar el backfill (¿migraciones aplicadas?)")
+            return 1
+        print(f"Bloques: {result['chunks']}  último id: {result['last_id']}  procesadas: {result['processed']}  "
+              f"resueltas: {result['resolved']}  sin producto: {result['unresolved']}  "
+              f"{'terminado' if result['finished'] else 'pendiente'}")
+        return 0
+    finally:
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
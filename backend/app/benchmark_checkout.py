@@ -0,0 +1,183 @@
+"""
+Ventas simultáneas que compiten por los mismos insumos: rendimiento y ventas en
+exceso (oversell) con y sin el modo reserva de PurchaseService
+
+Crea una categoría y --products productos de prueba, cada uno con su insumo de
+existencias limitadas. Con más de un producto se crea además un combo (no se
+vende) cuya receta usa todos los insumos, de modo que ventas con tickets
+distintos afectan a productos que comparten insumos. Lanza --checkouts ventas
+desde --workers hilos y comprueba que cada insumo descontado coincide con las
+ventas aceptadas y no supera sus existencias, y que la disponibilidad guardada
+de los productos coincide con el cálculo completo. Al terminar elimina los
+datos de prueba.
+
+Uso (desde backend/app, con la base de datos configurada):
+    python benchmark_checkout.py                      Modo reserva (FOR UPDATE)
+    python benchmark_checkout.py --no-reservation     Validación sin bloqueo, para comparar
+    python benchmark_checkout.py --workers 16 --checkouts 200 --stock 50
+    python benchmark_checkout.py --products 4         Tickets distintos con recetas que comparten insumos
+"""
+import argparse
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from database.db import close_pool, execute_query, execute_insert_and_get_id, get_retry_stats
+from models.catalog import product_catalog, recipe_cache
+from models.product_availability import check_product_availability, refresh_product_availability
+from api.v1.services.purchase_service import PurchaseService
+
+def create_fixture(tag, stock, per_unit, products):
+    """Categoría, insumos, productos y recetas de prueba; devuelve sus ids"""
+    ids = {'insumo_ids': [], 'product_ids': []}
+    ids['category_id'] = execute_insert_and_get_id(
+        "INSERT INTO categories (nombre_categoria) VALUES (%s)", (f"bench-{tag}",))
+    for number in range(products):
+        insumo_id = execute_insert_and_get_id(
+            """
+            INSERT INTO insumos (nombre_insumo, unidad, cantidad_unitaria, precio_presentacion, cantidad_utilizada)
+            VALUES (%s, 'unidad', %s, %s, 0)
+            """, (f"bench-insumo-{tag}-{number}", stock, stock))
+        product_id = execute_insert_and_get_id(
+            "INSERT INTO products (nombre_producto, variante, price, category_id) VALUES (%s, NULL, 1000, %s)",
+            (f"bench-producto-{tag}-{number}", ids['category_id']))
+        execute_insert_and_get_id(
+            "INSERT INTO product_recipes (product_id, insumo_id, cantidad) VALUES (%s, %s, %s)",
+            (product_id, insumo_id, per_unit))
+        ids['insumo_ids'].append(insumo_id)
+        ids['product_ids'].append(product_id)
+    if products > 1:
+        combo_id = execute_insert_and_get_id(
+            "INSERT INTO products (nombre_producto, variante, price, category_id) VALUES (%s, NULL, 1000, %s)",
+            (f"bench-combo-{tag}", ids['category_id']))
+        for insumo_id in ids['insumo_ids']:
+            execute_insert_and_get_id(
+                "INSERT INTO product_recipes (product_id, insumo_id, cantidad) VALUES (%s, %s, %s)",
+                (combo_id, insumo_id, per_unit))
+        ids['product_ids'].append(combo_id)
+    if None in [ids['category_id'], *ids['insumo_ids'], *ids['product_ids']]:
+        raise RuntimeError("No se pudieron crear los datos de prueba")
+    product_catalog.invalidate()
+    recipe_cache.invalidate()
+    refresh_product_availability(product_ids=ids['product_ids'])
+    return ids
+
+def drop_fixture(tag, ids):
+    """Eliminar las compras y los registros de prueba"""
+    execute_query("DELETE FROM purchases WHERE invoice_number LIKE %s", (f"BENCH-{tag}-%",))
+    for product_id in ids['product_ids']:
+        execute_query("DELETE FROM products WHERE id = %s", (product_id,))
+    for insumo_id in ids['insumo_ids']:
+        execute_query("DELETE FROM insumos WHERE id = %s", (insumo_id,))
+    execute_query("DELETE FROM categories WHERE id = %s", (ids['category_id'],))
+    product_catalog.invalidate()
+    recipe_cache.invalidate()
+
+def purchase_data(tag, number, seller, quantity, product):
+    """Factura mínima de una línea para el producto de prueba número product"""
+    now = datetime.now()
+    total = 1000 * quantity
+    return {
+        'invoice_number': f"BENCH-{tag}-{number}",
+        'invoice_date': now.date(),
+        'invoice_time': now.time().replace(microsecond=0),
+        'client_name': 'benchmark',
+        'seller_username': seller,
+        'subtotal_products': total,
+        'total_amount': total,
+        'amount_paid': total,
+        'change_returned': 0,
+        'payment_method': 'efectivo',
+        'products': [{
+            'product_name': f"bench-producto-{tag}-{product}",
+            'product_variant': None,
+            'quantity': quantity,
+            'unit_price': 1000,
+            'subtotal': total
+        }]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Ventas simultáneas sobre insumos con existencias limitadas")
+    parser.add_argument('--workers', type=int, default=8, help="Hilos que venden a la vez")
+    parser.add_argument('--checkouts', type=int, default=100, help="Ventas a intentar")
+    parser.add_argument('--stock', type=float, default=40, help="Existencias de cada insumo de prueba")
+    parser.add_argument('--products', type=int, default=1, help="Productos vendidos (uno por insumo, más un combo)")
+    parser.add_argument('--per-unit', type=float, default=1, help="Insumo consumido por unidad vendida")
+    parser.add_argument('--quantity', type=int, default=1, help="Unidades por venta")
+    parser.add_argument('--seller', default='admin', help="Usuario vendedor existente")
+    parser.add_argument('--no-reservation', action='store_true', help="Validar sin bloquear los insumos")
+    args = parser.parse_args()
+
+    tag = uuid.uuid4().hex[:8]
+    reserve = not args.no_reservation
+    ids = create_fixture(tag, args.stock, args.per_unit, args.products)
+    counters = {'ok': 0, 'rejected': 0, 'failed': 0}
+    accepted = [0] * args.products
+    counters_lock = threading.Lock()
+
+    def checkout(number):
+        product = number % args.products
+        try:
+            PurchaseService.create_purchase(
+                purchase_data(tag, number, args.seller, args.quantity, product), reserve=reserve)
+            outcome = 'ok'
+            with counters_lock:
+                accepted[product] += 1
+        except ValueError:
+            # Sin insumos suficientes: rechazo esperado
+            outcome = 'rejected'
+        except Exception as e:
+            print(f"Venta {number} fallida: {e}", file=sys.stderr)
+            outcome = 'failed'
+        with counters_lock:
+            counters[outcome] += 1
+
+    try:
+        retries_before = get_retry_stats()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(checkout, range(args.checkouts)))
+        elapsed = time.perf_counter() - started
+        retries_after = get_retry_stats()
+
+        placeholders = ", ".join(["%s"] * len(ids['insumo_ids']))
+        rows = execute_query(
+            f"SELECT id, cantidad_unitaria, cantidad_utilizada FROM insumos WHERE id IN ({placeholders})",
+            ids['insumo_ids'], fetch_all=True, compact=True)
+        quantities = {insumo_id: (float(stock), float(used)) for insumo_id, stock, used in rows}
+        stock = sum(quantities[insumo_id][0] for insumo_id in ids['insumo_ids'])
+        used = sum(quantities[insumo_id][1] for insumo_id in ids['insumo_ids'])
+        expected_used = counters['ok'] * args.quantity * args.per_unit
+        oversold = sum(max(0.0, quantities[insumo_id][1] - quantities[insumo_id][0]) for insumo_id in ids['insumo_ids'])
+        lost_updates = round(sum(
+            abs(accepted[product] * args.quantity * args.per_unit - quantities[insumo_id][1])
+            for product, insumo_id in enumerate(ids['insumo_ids'])
+        ), 2)
+        # La disponibilidad se recalcula tras el commit de cada venta: debe coincidir con el cálculo completo
+        stale = [
+            difference['product_id'] for difference in check_product_availability() or []
+            if difference['product_id'] in ids['product_ids']
+        ]
+
+        print(f"Modo:            {'reserva (FOR UPDATE)' if reserve else 'sin bloqueo'}")
+        print(f"Ventas:          {args.checkouts} con {args.workers} hilos en {elapsed:.2f} s "
+              f"({args.checkouts / elapsed:.1f} ventas/s)")
+        print(f"Aceptadas:       {counters['ok']}  rechazadas: {counters['rejected']}  fallidas: {counters['failed']}")
+        print(f"Reintentos:      {retries_after['retries'] - retries_before['retries']}  "
+              f"agotados: {retries_after['exhausted'] - retries_before['exhausted']}")
+        print(f"Insumos:         {args.products}  existencias={stock:g} utilizado={used:g} esperado={expected_used:g}")
+        print(f"Exceso vendido:  {oversold:g}")
+        if lost_updates:
+            print(f"Descuentos perdidos: {lost_updates:g}")
+        print(f"Disponibilidad:  {len(stale)} productos desactualizados{' ' + str(stale) if stale else ''}")
+        return 0 if oversold == 0 and lost_updates == 0 and not stale else 1
+    finally:
+        drop_fixture(tag, ids)
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
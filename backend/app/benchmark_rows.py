@@ -0,0 +1,62 @@
+"""
+Comparar la memoria usada por las filas como diccionarios (DictCursor) y en
+modo compacto (tuplas + índice de columnas compartido)
+
+Uso (desde backend/app, con la base de datos configurada):
+    python benchmark_rows.py --year 2025 --month 7 Extracto mensual de compras
+    python benchmark_rows.py --stock               Cálculo de stock de productos
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+from database.db import close_pool
+from api.v1.services.extract_service import ExtractService
+from api.v1.services.stock_service import StockService
+
+def measure(label, load):
+    """Ejecutar load() y mostrar el pico de memoria, la memoria retenida y el tiempo"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = len(result) if result is not None else 0
+    print(f"{label:<12} filas={rows:<8} retenida={retained / 1024:>10.1f} KiB  "
+          f"pico={peak / 1024:>10.1f} KiB  tiempo={elapsed * 1000:>8.1f} ms")
+    return retained
+
+def main():
+    parser = argparse.ArgumentParser(description="Memoria de las filas: DictCursor frente a modo compacto")
+    parser.add_argument('--year', type=int, default=date.today().year, help="Año del extracto")
+    parser.add_argument('--month', type=int, default=date.today().month, help="Mes del extracto (1-12)")
+    parser.add_argument('--stock', action='store_true', help="Medir el cálculo de stock en lugar del extracto")
+    args = parser.parse_args()
+
+    try:
+        if args.stock:
+            loads = [
+                ("dict", lambda: StockService.calculate_product_stock()),
+                ("compact", lambda: StockService.calculate_product_stock(compact=True))
+            ]
+        else:
+            loads = [
+                ("dict", lambda: ExtractService.get_monthly_purchase_extract(args.year, args.month)),
+                ("compact", lambda: list(ExtractService.stream_monthly_purchase_extract(args.year, args.month)))
+            ]
+
+        # Primera ejecución para calentar el pool y la caché del servidor
+        loads[1][1]()
+
+        results = {label: measure(label, load) for label, load in loads}
+        if results['compact']:
+            print(f"Reducción: {results['dict'] / results['compact']:.1f}x menos memoria retenida")
+        return 0
+    finally:
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Comparar el cálculo de disponibilidad en SQL con el motor de stock en memoria
+(matriz de recetas CSR + vector de insumos)
+
+Mide, sobre los datos actuales y sin modificarlos:
+- disponibilidad de todos los productos: consulta SQL con joins frente a una
+  lectura del vector de insumos y una pasada vectorizada
+- detalle por producto: una consulta por producto frente a la misma instantánea
+- escenarios hipotéticos (carritos y reposiciones aleatorios) evaluados por lotes
+y comprueba que ambos cálculos den las mismas unidades.
+
+Uso (desde backend/app, con la base de datos configurada):
+    python benchmark_stock_engine.py
+    python benchmark_stock_engine.py --repeat 50 --scenarios 1000
+"""
+import argparse
+import random
+import sys
+import time
+
+from database.db import close_pool, execute_query
+from models.product_availability import compute_product_availability
+from models.stock_engine import stock_engine
+
+# Consulta de detalle por producto anterior al motor de stock
+DETAIL_QUERY = """
+SELECT i.id, (i.cantidad_unitaria - i.cantidad_utilizada) AS cantidad_disponible,
+       FLOOR((i.cantidad_unitaria - i.cantidad_utilizada) /
+             CASE WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto ELSE pr.cantidad END) AS unidades_posibles
+FROM product_recipes pr
+JOIN insumos i ON pr.insumo_id = i.id
+WHERE pr.product_id = %s
+ORDER BY unidades_posibles ASC
+"""
+
+def timed(operation, repeat):
+    """Ejecutar operation() repeat veces; devuelve (último resultado, ms por ejecución)"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = operation()
+    return result, (time.perf_counter() - started) * 1000 / repeat
+
+def random_scenarios(matrix, count, seed):
+    """Carritos de 1-5 productos y reposiciones de 1-3 insumos al azar"""
+    rng = random.Random(seed)
+    product_ids = matrix.product_ids.tolist()
+    insumo_ids = matrix.insumo_ids.tolist()
+    scenarios = []
+    for _ in range(count):
+        cart = {rng.choice(product_ids): rng.randint(1, 3) for _ in range(rng.randint(1, 5))}
+        restock = {rng.choice(insumo_ids): rng.uniform(1, 100) for _ in range(rng.randint(0, 3))}
+        scenarios.append({'cart': cart, 'restock': restock})
+    return scenarios
+
+def main():
+    parser = argparse.ArgumentParser(description="Disponibilidad en SQL frente al motor de stock en memoria")
+    parser.add_argument('--repeat', type=int, default=20, help="Repeticiones de cada medición")
+    parser.add_argument('--scenarios', type=int, default=500, help="Escenarios hipotéticos por lote")
+    parser.add_argument('--seed', type=int, default=1, help="Semilla de los escenarios aleatorios")
+    args = parser.parse_args()
+
+    try:
+        # Primera ejecución para calentar el pool, las cachés y la caché del servidor
+        compute_product_availability()
+        _, build_ms = timed(lambda: stock_engine.matrix(), 1)
+        matrix = stock_engine.matrix()
+        if not len(matrix):
+            print("No hay productos con receta")
+            return 1
+
+        sql_units, sql_ms = timed(compute_product_availability, args.repeat)
+        snapshot, snapshot_ms = timed(stock_engine.snapshot, args.repeat)
+        (units, _), pass_ms = timed(lambda: matrix.availability(snapshot.remaining), args.repeat)
+
+        engine_units = dict(zip(matrix.product_ids.tolist(), units.tolist()))
+        mismatches = [
+            product_id for product_id, (stock, _) in (sql_units or {}).items()
+            if engine_units.get(product_id, 0) != stock
+        ]
+
+        product_ids = matrix.product_ids.tolist()
+        _, sql_detail_ms = timed(
+            lambda: [execute_query(DETAIL_QUERY, (product_id,), fetch_all=True, compact=True)
+                     for product_id in product_ids],
+            max(1, args.repeat // 5)
+        )
+        _, engine_detail_ms = timed(
+            lambda: [snapshot.product_detail(product_id) for product_id in product_ids], args.repeat
+        )
+
+        scenarios = random_scenarios(matrix, args.scenarios, args.seed)
+        _, what_if_ms = timed(lambda: snapshot.what_if(scenarios), max(1, args.repeat // 5))
+
+        print(f"Matriz:            {len(matrix)} productos x {len(matrix.insumo_ids)} insumos, "
+              f"{len(matrix.indices)} elementos (construida en {build_ms:.2f} ms)")
+        print(f"SQL (joins):       {sql_ms:>9.3f} ms por cálculo completo")
+        print(f"Motor:             {snapshot_ms + pass_ms:>9.3f} ms (lectura de insumos {snapshot_ms:.3f} ms "
+              f"+ pasada vectorizada {pass_ms * 1000:.1f} µs)")
+        print(f"Detalle SQL:       {sql_detail_ms:>9.3f} ms para {len(product_ids)} productos (una consulta cada uno)")
+        print(f"Detalle motor:     {engine_detail_ms:>9.3f} ms para {len(product_ids)} productos (misma instantánea)")
+        print(f"Escenarios:        {args.scenarios} en {what_if_ms:.3f} ms "
+              f"({what_if_ms * 1000 / args.scenarios:.1f} µs por escenario)")
+        print(f"Diferencias:       {len(mismatches)}{' ' + str(mismatches[:10]) if mismatches else ''}")
+        return 1 if mismatches else 0
+    finally:
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+import aiomysql
+import pymysql
+from database.db import DATABASE_CONFIG, POOL_CONFIG
+from database.instrumentation import record_query, fingerprint
+from database.rows import RowSet, columns_from_description
+
+# Capa de acceso a datos para los endpoints async.
+# Usa la misma configuración (.env.dev) que database/db.py, por lo que basta con
+# apuntar HOSTNAME/PORT/DATABASE_NAME a cualquier servidor compatible con MySQL
+# (MariaDB, un contenedor local, etc.) para probarla.
+
+logger = logging.getLogger(__name__)
+
+_async_pool = None
+_async_pool_lock = asyncio.Lock()
+
+async def get_async_pool():
+    """
+    Obtener el pool async de conexiones, creándolo en el primer uso
+    """
+    global _async_pool
+    if _async_pool is None:
+        async with _async_pool_lock:
+            if _async_pool is None:
+                _async_pool = await aiomysql.create_pool(
+                    host=DATABASE_CONFIG['host'],
+                    port=DATABASE_CONFIG['port'],
+                    user=DATABASE_CONFIG['user'],
+                    password=DATABASE_CONFIG['password'] or '',
+                    db=DATABASE_CONFIG['database'],
+                    charset=DATABASE_CONFIG['charset'],
+                    autocommit=DATABASE_CONFIG['autocommit'],
+                    minsize=POOL_CONFIG['min_size'],
+                    maxsize=POOL_CONFIG['max_size'],
+                    pool_recycle=POOL_CONFIG['recycle'],
+                    cursorclass=aiomysql.DictCursor
+                )
+    return _async_pool
+
+async def close_async_pool():
+    """
+    Cerrar el pool async (se llama al apagar la aplicación)
+    """
+    global _async_pool
+    if _async_pool is not None:
+        _async_pool.close()
+        await _async_pool.wait_closed()
+        _async_pool = None
+
+def get_async_pool_stats():
+    """
+    Estadísticas del pool async para monitoreo
+    """
+    if _async_pool is None:
+        return {'initialized': False}
+    return {
+        'initialized': True,
+        'min_size': _async_pool.minsize,
+        'max_size': _async_pool.maxsize,
+        'size': _async_pool.size,
+        'idle': _async_pool.freesize,
+        'in_use': _async_pool.size - _async_pool.freesize
+    }
+
+async def execute_query(query, params=None, fetch_one=False, fetch_all=False, compact=False):
+    """
+    Ejecutar una consulta SQL sin bloquear el event loop.
+
+    Mismo contrato que database.db.execute_query: devuelve la fila, la lista de
+    filas o el número de filas afectadas, y None si ocurre un error. Con
+    compact=True fetch_all devuelve un RowSet y fetch_one una tupla.
+    """
+    try:
+        pool = await get_async_pool()
+    except Exception as e:
+        logger.error("Error conectando a la base de datos (async): %s", e)
+        return None
+
+    async with pool.acquire() as connection:
+        try:
+            async with connection.cursor(aiomysql.Cursor if compact else aiomysql.DictCursor) as cursor:
+                started = time.perf_counter()
+                try:
+                    await cursor.execute(query, params)
+                finally:
+                    record_query(query, time.perf_counter() - started, cursor.rowcount)
+
+                if fetch_one:
+                    result = await cursor.fetchone()
+                elif fetch_all and compact:
+                    result = RowSet(columns_from_description(cursor.description), await cursor.fetchall())
+                elif fetch_all:
+                    result = await cursor.fetchall()
+                else:
+                    result = cursor.rowcount
+
+            await connection.commit()
+            return result
+
+        except (pymysql.err.OperationalError, pymysql.err.IntegrityError, pymysql.err.DataError) as e:
+            error_code, error_message = e.args
+            logger.error("Error en la base de datos (async): [%s] %s [%s]", error_code, error_message, fingerprint(query))
+            logger.debug("Query: %s | Params: %r", query, params)
+            await connection.rollback()
+            return None
+        except Exception as e:
+            logger.error("Error ejecutando consulta (async): %s: %s [%s]", type(e).__name__, e, fingerprint(query))
+            logger.debug("Query: %s | Params: %r", query, params)
+            await connection.rollback()
+            return None
+
+async def fetch_one(query, params=None):
+    """
+    Obtener una sola fila (o None)
+    """
+    return await execute_query(query, params, fetch_one=True)
+
+async def fetch_all(query, params=None):
+    """
+    Obtener todas las filas (lista vacía si no hay resultados o hay error)
+    """
+    return await execute_query(query, params, fetch_all=True) or []
+
+async def fetch_rows(query, params=None):
+    """
+    Obtener todas las filas en modo compacto (RowSet de tuplas), o None si hay error
+    """
+    return await execute_query(query, params, fetch_all=True, compact=True)
+
+async def insert(query, params=None):
+    """
+    Ejecutar un INSERT y devolver el ID del registro insertado
+    """
+    try:
+        pool = await get_async_pool()
+    except Exception as e:
+        logger.error("Error conectando a la base de datos (async): %s", e)
+        return None
+
+    async with pool.acquire() as connection:
+        try:
+            async with connection.cursor() as cursor:
+                started = time.perf_counter()
+                try:
+                    await cursor.execute(query, params)
+                finally:
+                    record_query(query, time.perf_counter() - started, cursor.rowcount)
+                inserted_id = cursor.lastrowid if cursor.rowcount > 0 else None
+
+            await connection.commit()
+            return inserted_id or None
+
+        except Exception as e:
+            logger.error("Error ejecutando INSERT (async): %s: %s [%s]", type(e).__name__, e, fingerprint(query))
+            logger.debug("Query: %s | Params: %r", query, params)
+            await connection.rollback()
+            return None
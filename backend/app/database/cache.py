@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+import time
+
+from database.db import execute_query
+from database import async_db
+
+# Cachés en memoria del proceso para datos que cambian poco (catálogo de
+# productos, recetas). Cada caché tiene un número de versión en la tabla
+# cache_versions: quien modifica los datos incrementa la versión y los demás
+# workers detectan que su copia quedó vieja con una consulta por clave primaria,
+# como mucho una vez cada CACHE_VERSION_CHECK_SECONDS.
+
+CACHE_VERSION_CHECK_SECONDS = float(os.getenv('CACHE_VERSION_CHECK_SECONDS', 2))
+
+CACHE_VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS cache_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+
+_BUMP_VERSION_QUERY = """
+INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+ON DUPLICATE KEY UPDATE version = version + 1
+"""
+
+logger = logging.getLogger(__name__)
+
+def get_cache_version(name):
+    """Versión actual de una caché en la base de datos (0 si nunca se modificó)"""
+    row = execute_query("SELECT version FROM cache_versions WHERE name = %s", (name,), fetch_one=True, compact=True)
+    # Sin fila (nunca se modificó) o error: para la caché ambos casos son la versión 0
+    return row[0] if row else 0
+
+def bump_cache_version(name):
+    """Marcar una caché como modificada para todos los workers"""
+    return execute_query(_BUMP_VERSION_QUERY, (name,))
+
+async def bump_cache_version_async(name):
+    """Igual que bump_cache_version, sin bloquear el event loop"""
+    return await async_db.execute_query(_BUMP_VERSION_QUERY, (name,))
+
+class VersionedCache:
+    """
+    Base de las cachés del proceso: carga perezosa, invalidación y control de
+    versión entre workers.
+
+    Las subclases implementan _load(), que devuelve los datos indexados, y
+    usan self._data() para obtenerlos al día.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._payload = None
+        self._version = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _size(self, payload):
+        return len(payload)
+
+    def _data(self):
+        """Datos de la caché, recargándolos si no están cargados o la versión cambió"""
+        payload = self._payload
+        now = time.monotonic()
+        if payload is not None and now - self._checked_at < CACHE_VERSION_CHECK_SECONDS:
+            return payload
+
+        with self._lock:
+            if self._payload is not None and now - self._checked_at < CACHE_VERSION_CHECK_SECONDS:
+                return self._payload
+            version = get_cache_version(self.name)
+            if self._payload is None or version != self._version:
+                payload = self._load()
+                if payload is None:
+                    # Error cargando: no se guarda nada y se reintenta en el próximo acceso
+                    return None
+                if self._payload is not None:
+                    logger.info("Caché '%s' desactualizada (versión %s -> %s), recargada", self.name, self._version, version)
+                self._payload = payload
+                self._version = version
+                self.loads += 1
+            self._checked_at = now
+            return self._payload
+
+    def clear(self):
+        """Descartar la copia local; se recarga en el próximo acceso"""
+        with self._lock:
+            self._payload = None
+            self._checked_at = 0.0
+
+    def invalidate(self):
+        """Incrementar la versión (los demás workers recargan) y descartar la copia local"""
+        bump_cache_version(self.name)
+        self.clear()
+
+    async def invalidate_async(self):
+        """Igual que invalidate, desde código async"""
+        await bump_cache_version_async(self.name)
+        self.clear()
+
+    def stats(self):
+        """Contadores de la caché"""
+        payload = self._payload
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'loaded': payload is not None,
+            'version': self._version,
+            'size': self._size(payload) if payload is not None else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'loads': self.loads
+        }
@@ -1,10 +1,22 @@
+import contextvars
+import logging
 import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
 import pymysql
 from dotenv import load_dotenv
+from database.pool import ConnectionPool
+from database.rows import RowSet, columns_from_description
+from database.instrumentation import fingerprint
 
 # Cargar variables de entorno desde .env.dev
 load_dotenv('.env.dev')
 
+logger = logging.getLogger(__name__)
+
 # Configuración de la base de datos
 DATABASE_CONFIG = {
     'host': os.getenv('HOSTNAME'),
@@ -16,15 +28,66 @@ DATABASE_CONFIG = {
     'autocommit': True # para que se guarden los cambios automaticamente
 }
 
+# Configuración del pool de conexiones
+POOL_CONFIG = {
+    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),  # segundos esperando una conexión libre
+    'recycle': int(os.getenv('DB_POOL_RECYCLE', 3600)),  # segundos de vida máxima de una conexión
+    'ping_interval': int(os.getenv('DB_POOL_PING_INTERVAL', 30))  # segundos de inactividad antes de verificarla
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Obtener el pool de conexiones del proceso, creándolo en el primer uso
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_CONFIG, **POOL_CONFIG)
+    return _pool
+
+def _reset_pool_after_fork():
+    # Los sockets no se pueden compartir entre procesos: cada worker crea su propio pool
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+def close_pool():
+    """
+    Cerrar las conexiones libres del pool (se llama al apagar la aplicación)
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+def get_pool_stats():
+    """
+    Estadísticas del pool de conexiones (en uso, libres, tiempos de espera...)
+    """
+    return get_pool().stats()
+
 def get_db_connection():
     """
-    Crear y retornar una conexión a la base de datos MySQL
+    Obtener una conexión a la base de datos MySQL desde el pool.
+
+    La conexión devuelta se usa igual que una de pymysql; al llamar a close()
+    vuelve al pool en lugar de cerrarse.
     """
     try:
-        connection = pymysql.connect(**DATABASE_CONFIG)
+        connection = get_pool().acquire()
         return connection
     except Exception as e:
-        print(f"Error conectando a la base de datos: {e}")
+        logger.error("Error conectando a la base de datos: %s", e)
         return None
 
 def create_database_if_not_exists():
@@ -41,108 +104,275 @@ def create_database_if_not_exists():
         
         # Crear la base de datos si no existe
         cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database_name}")
-        print(f"Base de datos '{database_name}' verificada/creada exitosamente")
+        logger.info("Base de datos '%s' verificada/creada exitosamente", database_name)
         
         cursor.close()
         connection.close()
         
     except Exception as e:
-        print(f"Error creando la base de datos: {e}")
+        logger.error("Error creando la base de datos: %s", e)
 
 
-def execute_query(query, params=None, fetch_one=False, fetch_all=False):
+# Conexión ligada a la unidad de trabajo (transacción) en curso
+_current_connection = contextvars.ContextVar('db_current_connection', default=None)
+# Funciones que se ejecutan tras el commit de la unidad de trabajo en curso
+_commit_callbacks = contextvars.ContextVar('db_commit_callbacks', default=None)
+# Datos que esas funciones acumulan durante la unidad de trabajo en curso
+_commit_state = contextvars.ContextVar('db_commit_state', default=None)
+
+_ISOLATION_LEVELS = ('READ UNCOMMITTED', 'READ COMMITTED', 'REPEATABLE READ', 'SERIALIZABLE')
+
+def get_current_connection():
     """
-    Ejecutar una consulta SQL
+    Conexión de la unidad de trabajo activa, o None si no hay ninguna
+    """
+    return _current_connection.get()
+
+@contextmanager
+def transaction(isolation_level=None):
     """
+    Unidad de trabajo: liga una conexión del pool al contexto actual y la
+    envuelve en una transacción.
+
+    Args:
+        isolation_level: Nivel de aislamiento solo para esta transacción (p. ej.
+                         'READ COMMITTED'); por defecto el del servidor. No se
+                         aplica si se une a una transacción exterior.
+
+    Mientras está activa, execute_query, execute_insert_and_get_id,
+    execute_many, bulk_insert y los servicios construidos sobre ellas
+    (InsumoService, ProductService, SalesService...) reutilizan esa conexión;
+    sus errores SQL se lanzan en lugar de devolver None. Al salir se hace
+    commit, o rollback si hubo una excepción. Las llamadas anidadas se unen a
+    la transacción exterior.
+
+    Uso:
+        with transaction() as connection:
+            cursor = connection.cursor(pymysql.cursors.DictCursor)
+            ...
+    """
+    if isolation_level is not None and isolation_level not in _ISOLATION_LEVELS:
+        raise ValueError(f"Nivel de aislamiento inválido: {isolation_level}")
+    
+    connection = _current_connection.get()
+    if connection is not None:
+        yield connection
+        return
+    
     connection = get_db_connection()
     if not connection:
-        print("No se pudo establecer conexión con la base de datos")
+        raise Exception("No se pudo establecer conexión con la base de datos")
+    
+    token = _current_connection.set(connection)
+    callbacks = []
+    callbacks_token = _commit_callbacks.set(callbacks)
+    state_token = _commit_state.set({})
+    try:
+        if isolation_level is not None:
+            # Sin SESSION: solo afecta a la transacción siguiente de la conexión
+            with connection.cursor() as cursor:
+                cursor.execute(f"SET TRANSACTION ISOLATION LEVEL {isolation_level}")
+        connection.begin()
+        yield connection
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        _commit_state.reset(state_token)
+        _commit_callbacks.reset(callbacks_token)
+        _current_connection.reset(token)
+        connection.close()
+    _run_commit_callbacks(callbacks)
+
+def on_commit(callback):
+    """
+    Ejecutar callback() tras el commit de la unidad de trabajo en curso (no se
+    ejecuta si hay rollback); sin unidad de trabajo se ejecuta en el momento.
+    Un mismo callback registrado varias veces se ejecuta una vez.
+    """
+    callbacks = _commit_callbacks.get()
+    if callbacks is None:
+        _run_commit_callbacks([callback])
+    elif callback not in callbacks:
+        callbacks.append(callback)
+
+def commit_state():
+    """
+    Diccionario propio de la unidad de trabajo en curso, o None si no hay
+    ninguna. Sirve para acumular durante la transacción lo que una función
+    registrada con on_commit hará tras el commit (se descarta con el rollback).
+    """
+    return _commit_state.get()
+
+def _run_commit_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.error("Error en una función posterior al commit: %s", e)
+
+# Reintentos de transacciones que fallan por contención de bloqueos
+TRANSACTION_RETRIES = int(os.getenv('DB_TRANSACTION_RETRIES', 3))  # reintentos tras el primer intento
+TRANSACTION_RETRY_BACKOFF = float(os.getenv('DB_TRANSACTION_RETRY_BACKOFF', 0.05))  # segundos, se duplica en cada reintento
+_RETRYABLE_ERRORS = (
+    1213,  # Deadlock found when trying to get lock
+    1205,  # Lock wait timeout exceeded
+)
+
+_retry_stats = {'retries': 0, 'exhausted': 0}
+_retry_lock = threading.Lock()
+
+def is_retryable_error(error):
+    """True si el error es un deadlock o un timeout esperando un bloqueo"""
+    return (
+        isinstance(error, pymysql.err.OperationalError)
+        and bool(error.args) and error.args[0] in _RETRYABLE_ERRORS
+    )
+
+def run_transaction_with_retry(operation, retries=None, backoff=None):
+    """
+    Ejecutar operation() (que abre su propia transacción con `transaction()`)
+    reintentándola si MySQL la aborta por deadlock o timeout de bloqueo.
+
+    La espera entre intentos crece exponencialmente (backoff, 2*backoff, ...)
+    con una variación aleatoria para que las transacciones en conflicto no
+    vuelvan a chocar. Dentro de una unidad de trabajo exterior no se reintenta:
+    el rollback deshace también el trabajo del llamador, así que el error se
+    propaga para que lo gestione quien abrió la transacción.
+    """
+    retries = TRANSACTION_RETRIES if retries is None else retries
+    backoff = TRANSACTION_RETRY_BACKOFF if backoff is None else backoff
+    attempt = 0
+    while True:
+        try:
+            return operation()
+        except pymysql.err.OperationalError as e:
+            if not is_retryable_error(e) or get_current_connection() is not None:
+                raise
+            if attempt >= retries:
+                with _retry_lock:
+                    _retry_stats['exhausted'] += 1
+                logger.error("Transacción abortada tras %s reintentos: [%s] %s", attempt, e.args[0], e.args[1])
+                raise
+            delay = backoff * (2 ** attempt) * (0.5 + random.random())
+            attempt += 1
+            with _retry_lock:
+                _retry_stats['retries'] += 1
+            logger.warning("Conflicto de bloqueos [%s], reintento %s/%s en %.0f ms", e.args[0], attempt, retries, delay * 1000)
+            time.sleep(delay)
+
+def get_retry_stats():
+    """Reintentos por deadlock/timeout de bloqueo y transacciones que agotaron los reintentos"""
+    with _retry_lock:
+        return dict(_retry_stats)
+
+# Mensajes más descriptivos para los errores de MySQL más comunes
+_ERROR_HINTS = {
+    1054: "Columna desconocida en la consulta. Verifique el nombre de la columna.",
+    1064: "Error de sintaxis en la consulta SQL.",
+    1146: "La tabla no existe. Verifique el nombre de la tabla.",
+    2003: "No se puede conectar al servidor MySQL. Verifique que el servidor esté en ejecución.",
+    1045: "Acceso denegado. Verifique las credenciales de la base de datos.",
+    1062: "Entrada duplicada. El valor ya existe en la base de datos.",
+    1452: "Error de clave foránea. El valor referenciado no existe.",
+    1451: "No se puede eliminar o actualizar un registro padre. Hay registros dependientes.",
+    1264: "Valor fuera de rango para la columna.",
+    1366: "Valor de cadena incorrecto para la columna."
+}
+
+_ERROR_KINDS = (
+    (pymysql.err.OperationalError, "Error operacional en la base de datos"),
+    (pymysql.err.IntegrityError, "Error de integridad en la base de datos"),
+    (pymysql.err.DataError, "Error de datos en la base de datos")
+)
+
+def _log_query_error(error, query, params):
+    """
+    Registrar un error de MySQL.
+
+    En el nivel ERROR solo va la huella de la consulta (sin valores); el texto
+    completo y los parámetros se registran en DEBUG.
+    """
+    error_code, error_message = error.args if len(error.args) == 2 else (None, str(error))
+    kind = next((text for error_type, text in _ERROR_KINDS if isinstance(error, error_type)), "Error ejecutando consulta")
+    hint = _ERROR_HINTS.get(error_code)
+    logger.error("%s: [%s] %s%s [%s]", kind, error_code, error_message,
+                 f" {hint}" if hint else "", fingerprint(query))
+    logger.debug("Query: %s | Params: %r", query, params)
+
+def execute_query(query, params=None, fetch_one=False, fetch_all=False, compact=False):
+    """
+    Ejecutar una consulta SQL
+
+    Con compact=True las filas no se convierten a diccionarios: fetch_all
+    devuelve un RowSet (tuplas + índice de columnas compartido) y fetch_one
+    una tupla. Pensado para lecturas grandes (extractos, stock, estadísticas).
+
+    Devuelve None si hay un error, salvo dentro de una unidad de trabajo
+    (transaction()), donde el error se lanza.
+    """
+    # Dentro de una unidad de trabajo se reutiliza su conexión y su transacción
+    connection = get_current_connection()
+    owns_connection = connection is None
+    if owns_connection:
+        connection = get_db_connection()
+    if not connection:
+        logger.error("No se pudo establecer conexión con la base de datos")
         return None
     
     cursor = None
     try:
-        cursor = connection.cursor(pymysql.cursors.DictCursor)
+        cursor = connection.cursor(pymysql.cursors.Cursor if compact else pymysql.cursors.DictCursor)
         cursor.execute(query, params)
         
         if fetch_one:
             result = cursor.fetchone()
+        elif fetch_all and compact:
+            result = RowSet(columns_from_description(cursor.description), cursor.fetchall())
         elif fetch_all:
             result = cursor.fetchall()
         else:
             result = cursor.rowcount
             
-        connection.commit()
+        if owns_connection:
+            connection.commit()
         return result
         
-    except pymysql.err.OperationalError as e:
-        error_code, error_message = e.args
-        print(f"Error operacional en la base de datos: [{error_code}] {error_message}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
-        
-        # Proporcionar mensajes más descriptivos para errores comunes
-        if error_code == 1054:  # Unknown column
-            print(f"Columna desconocida en la consulta. Verifique el nombre de la columna.")
-        elif error_code == 1064:  # Syntax error
-            print(f"Error de sintaxis en la consulta SQL.")
-        elif error_code == 1146:  # Table doesn't exist
-            print(f"La tabla no existe. Verifique el nombre de la tabla.")
-        elif error_code == 2003:  # Can't connect to MySQL server
-            print(f"No se puede conectar al servidor MySQL. Verifique que el servidor esté en ejecución.")
-        elif error_code == 1045:  # Access denied
-            print(f"Acceso denegado. Verifique las credenciales de la base de datos.")
-            
-        connection.rollback()
-        return None
-    except pymysql.err.IntegrityError as e:
-        error_code, error_message = e.args
-        print(f"Error de integridad en la base de datos: [{error_code}] {error_message}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
-        
-        # Proporcionar mensajes más descriptivos para errores comunes
-        if error_code == 1062:  # Duplicate entry
-            print(f"Entrada duplicada. El valor ya existe en la base de datos.")
-        elif error_code == 1452:  # Foreign key constraint fails
-            print(f"Error de clave foránea. El valor referenciado no existe.")
-        elif error_code == 1451:  # Cannot delete or update a parent row
-            print(f"No se puede eliminar o actualizar un registro padre. Hay registros dependientes.")
-            
-        connection.rollback()
-        return None
-    except pymysql.err.DataError as e:
-        error_code, error_message = e.args
-        print(f"Error de datos en la base de datos: [{error_code}] {error_message}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
-        
-        # Proporcionar mensajes más descriptivos para errores comunes
-        if error_code == 1264:  # Out of range value
-            print(f"Valor fuera de rango para la columna.")
-        elif error_code == 1366:  # Incorrect string value
-            print(f"Valor de cadena incorrecto para la columna.")
-            
+    except pymysql.err.MySQLError as e:
+        _log_query_error(e, query, params)
+        if not owns_connection:
+            # La unidad de trabajo no debe confirmar trabajo a medias: el error
+            # llega a transaction(), que hace rollback (y a los reintentos)
+            raise
         connection.rollback()
         return None
     except Exception as e:
-        print(f"Error ejecutando consulta: {type(e).__name__}: {e}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
+        logger.error("Error ejecutando consulta: %s: %s [%s]", type(e).__name__, e, fingerprint(query))
+        logger.debug("Query: %s | Params: %r", query, params)
+        if not owns_connection:
+            raise
         connection.rollback()
         return None
     finally:
         if cursor:
             cursor.close()
-        if connection:
+        if owns_connection and connection:
             connection.close()
 
 def execute_insert_and_get_id(query, params=None):
     """
     Ejecutar una consulta INSERT y devolver el ID del registro insertado
+
+    Como execute_query, dentro de una unidad de trabajo los errores se lanzan.
     """
-    connection = get_db_connection()
+    # Dentro de una unidad de trabajo se reutiliza su conexión y su transacción
+    connection = get_current_connection()
+    owns_connection = connection is None
+    if owns_connection:
+        connection = get_db_connection()
     if not connection:
-        print("No se pudo establecer conexión con la base de datos")
+        logger.error("No se pudo establecer conexión con la base de datos")
         return None
     
     cursor = None
@@ -157,31 +387,83 @@ def execute_insert_and_get_id(query, params=None):
             # Si se insertó al menos una fila, obtener el ID
             cursor.execute("SELECT LAST_INSERT_ID() as id")
             result = cursor.fetchone()
-            connection.commit()
+            if owns_connection:
+                connection.commit()
             return result['id'] if result and result['id'] else None
         else:
             # No se insertó ninguna fila
-            connection.rollback()
+            if owns_connection:
+                connection.rollback()
             return None
             
-    except pymysql.err.OperationalError as e:
-        error_code, error_message = e.args
-        print(f"Error operacional en la base de datos: [{error_code}] {error_message}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
+    except pymysql.err.MySQLError as e:
+        _log_query_error(e, query, params)
+        if not owns_connection:
+            raise
         connection.rollback()
         return None
-    except pymysql.err.IntegrityError as e:
-        error_code, error_message = e.args
-        print(f"Error de integridad en la base de datos: [{error_code}] {error_message}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
+    except Exception as e:
+        logger.error("Error ejecutando INSERT: %s: %s [%s]", type(e).__name__, e, fingerprint(query))
+        logger.debug("Query: %s | Params: %r", query, params)
+        if not owns_connection:
+            raise
         connection.rollback()
         return None
+    finally:
+        if cursor:
+            cursor.close()
+        if owns_connection and connection:
+            connection.close()
+
+# Tamaño por defecto de los lotes de escritura masiva
+BULK_CHUNK_SIZE = int(os.getenv('DB_BULK_CHUNK_SIZE', 500))
+
+_IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def _quote_identifier(name):
+    """
+    Validar y escapar el nombre de una tabla o columna
+    """
+    if not _IDENTIFIER_RE.match(name):
+        raise ValueError(f"Identificador SQL inválido: {name}")
+    return f"`{name}`"
+
+def _chunks(rows, chunk_size):
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+def _run_in_transaction(operation, query_description):
+    """
+    Ejecutar operation(cursor) en una conexión del pool dentro de una transacción.
+    Devuelve el resultado de operation o None si ocurre un error (con rollback).
+    Dentro de una unidad de trabajo se ejecuta sobre su conexión sin hacer commit
+    y los errores se propagan para que la unidad de trabajo haga rollback.
+    """
+    bound_connection = get_current_connection()
+    if bound_connection is not None:
+        cursor = bound_connection.cursor(pymysql.cursors.DictCursor)
+        try:
+            return operation(cursor)
+        except Exception as e:
+            logger.error("Error ejecutando operación masiva: %s: %s [%s]", type(e).__name__, e, fingerprint(query_description))
+            raise
+        finally:
+            cursor.close()
+    
+    connection = get_db_connection()
+    if not connection:
+        logger.error("No se pudo establecer conexión con la base de datos")
+        return None
+    
+    cursor = None
+    try:
+        cursor = connection.cursor(pymysql.cursors.DictCursor)
+        connection.begin()
+        result = operation(cursor)
+        connection.commit()
+        return result
     except Exception as e:
-        print(f"Error ejecutando INSERT: {type(e).__name__}: {e}")
-        print(f"Query: {query}")
-        print(f"Params: {params}")
+        logger.error("Error ejecutando operación masiva: %s: %s [%s]", type(e).__name__, e, fingerprint(query_description))
         connection.rollback()
         return None
     finally:
@@ -190,9 +472,149 @@ def execute_insert_and_get_id(query, params=None):
         if connection:
             connection.close()
 
-def create_tables():
+def execute_many(query, params_seq, chunk_size=None, cursor=None):
+    """
+    Ejecutar la misma sentencia con muchas filas de parámetros en una sola transacción.
+
+    pymysql reescribe los INSERT ... VALUES como un único INSERT de varias filas;
+    los UPDATE/DELETE se envían por lotes sobre la misma conexión.
+
+    Args:
+        query: Sentencia SQL con marcadores %s
+        params_seq: Secuencia de tuplas de parámetros
+        chunk_size: Filas por lote (por defecto DB_BULK_CHUNK_SIZE)
+        cursor: Cursor de una transacción ya abierta; si se indica, no se
+                abre conexión ni se hace commit
+
+    Returns:
+        Número total de filas afectadas, o None si ocurre un error
+    """
+    params_seq = list(params_seq)
+    if not params_seq:
+        return 0
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    
+    def operation(cur):
+        affected = 0
+        for chunk in _chunks(params_seq, chunk_size):
+            affected += cur.executemany(query, chunk) or 0
+        return affected
+    
+    if cursor is not None:
+        return operation(cursor)
+    return _run_in_transaction(operation, query)
+
+def bulk_insert(table, columns, rows, chunk_size=None, cursor=None):
+    """
+    Insertar muchas filas con INSERT de varios VALUES por lote, en una sola transacción.
+
+    Args:
+        table: Nombre de la tabla
+        columns: Lista de columnas a insertar
+        rows: Secuencia de tuplas con los valores (en el orden de columns)
+        chunk_size: Filas por sentencia (por defecto DB_BULK_CHUNK_SIZE)
+        cursor: Cursor de una transacción ya abierta; si se indica, no se
+                abre conexión ni se hace commit
+
+    Returns:
+        Lista con los IDs insertados (en el mismo orden que rows), o None si
+        ocurre un error. InnoDB asigna IDs consecutivos a las filas de un mismo
+        INSERT de varios VALUES, por lo que se calculan a partir de LAST_INSERT_ID.
+    """
+    rows = [tuple(row) for row in rows]
+    if not rows:
+        return []
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    
+    column_list = ", ".join(_quote_identifier(column) for column in columns)
+    placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    base_query = f"INSERT INTO {_quote_identifier(table)} ({column_list}) VALUES "
+    
+    def operation(cur):
+        inserted_ids = []
+        for chunk in _chunks(rows, chunk_size):
+            query = base_query + ", ".join([placeholders] * len(chunk))
+            cur.execute(query, [value for row in chunk for value in row])
+            first_id = cur.lastrowid
+            inserted_ids.extend(range(first_id, first_id + cur.rowcount))
+        return inserted_ids
+    
+    if cursor is not None:
+        return operation(cursor)
+    return _run_in_transaction(operation, base_query)
+
+# Filas que se leen del servidor en cada lote al recorrer un resultado en streaming
+STREAM_BATCH_SIZE = int(os.getenv('DB_STREAM_BATCH_SIZE', 1000))
+
+def stream_query_batches(query, params=None, batch_size=None, compact=False):
+    """
+    Ejecutar una consulta con un cursor del lado del servidor (sin buffer) y
+    devolver las filas en lotes de tamaño fijo a medida que llegan.
+
+    A diferencia de execute_query(fetch_all=True), el resultado nunca se carga
+    completo en memoria: solo se mantiene el lote actual.
+
+    Args:
+        query: Consulta SELECT
+        params: Parámetros de la consulta
+        batch_size: Filas por lote (por defecto DB_STREAM_BATCH_SIZE)
+        compact: Entregar cada lote como RowSet (tuplas + índice de columnas
+                 compartido entre todos los lotes) en lugar de diccionarios
+
+    Returns:
+        Generador de listas de diccionarios (o de RowSet) - uno por lote
+
+    Usa siempre su propia conexión del pool, incluso dentro de transaction():
+    mientras el resultado no se lea por completo la conexión no puede ejecutar
+    otras consultas. Si no hay conexión se lanza una excepción.
+    """
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    connection = get_db_connection()
+    if not connection:
+        raise Exception("No se pudo establecer conexión con la base de datos")
+
+    cursor = None
+    finished = False
+    try:
+        cursor = connection.cursor(pymysql.cursors.SSCursor if compact else pymysql.cursors.SSDictCursor)
+        cursor.execute(query, params)
+        columns = columns_from_description(cursor.description)
+        index = None
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if compact:
+                batch = RowSet(columns, rows, index)
+                index = batch.index
+                yield batch
+            else:
+                yield rows
+        finished = True
+    finally:
+        if finished:
+            cursor.close()
+        else:
+            # El consumidor abandonó el resultado a medias (o hubo un error):
+            # cerrar el socket en lugar de leer las filas restantes; el pool
+            # descarta la conexión cerrada al devolverla
+            try:
+                connection.raw_connection.close()
+            except Exception:
+                pass
+        connection.close()
+
+def stream_query(query, params=None, batch_size=None, compact=False):
+    """
+    Igual que stream_query_batches pero devolviendo las filas de una en una
+    (tuplas en el orden del SELECT si compact=True)
     """
-    Crear las tablas necesarias para el sistema de inventario
+    for rows in stream_query_batches(query, params, batch_size, compact):
+        yield from rows
+
+def get_schema_statements():
+    """
+    Sentencias CREATE TABLE del esquema base, en orden de dependencia
     """
     
     # Tabla de roles
@@ -381,6 +803,33 @@ def create_tables():
     )
     """
     
+    # Tabla de adiciones
+    additions_table = """
+    CREATE TABLE IF NOT EXISTS adiciones (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nombre VARCHAR(100) NOT NULL,
+        tipo VARCHAR(50) NOT NULL,
+        precio DECIMAL(10, 2) NOT NULL,
+        stock INT NOT NULL DEFAULT 0,
+        minimo INT NOT NULL DEFAULT 0,
+        estado VARCHAR(20) NOT NULL DEFAULT 'bien',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+    """
+    
+    # Tabla de domiciliarios
+    domiciliary_table = """
+    CREATE TABLE IF NOT EXISTS domiciliarios (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nombre VARCHAR(100) NOT NULL,
+        telefono VARCHAR(20) NOT NULL,
+        tarifa DECIMAL(10, 2) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+    """
+    
     # Lista de tablas en orden de dependencia
     tables = [
         roles_table,
@@ -394,9 +843,23 @@ def create_tables():
         sale_details_table,
         purchases_table,
         purchase_details_table,
-        shirt_schedule_table  # Añadimos la tabla de camisetas al final
+        shirt_schedule_table,  # Añadimos la tabla de camisetas al final
+        additions_table,
+        domiciliary_table
     ]
     
+    return tables
+
+def create_tables():
+    """
+    Crear las tablas necesarias para el sistema de inventario.
+
+    Ejecuta todo el DDL sin consultar el registro de versiones; al arrancar la
+    aplicación se usa database.schema.ensure_schema(), que solo lo ejecuta
+    cuando el esquema no está al día.
+    """
+    tables = get_schema_statements()
+    
     try:
         # Primero asegurarnos de que la base de datos existe
         create_database_if_not_exists()
@@ -425,7 +888,7 @@ def create_tables():
         # Crear las tablas en el orden correcto
         for table_query in tables:
             execute_query(table_query)
-            print(f"Tabla creada: {table_query[:50]}...")
+            logger.debug("Tabla creada: %s...", table_query.strip()[:50])
         
         # Crear roles predeterminados
         create_default_roles()
@@ -433,11 +896,11 @@ def create_tables():
         # Crear superusuario
         create_superuser()
             
-        print("Todas las tablas han sido creadas exitosamente")
+        logger.info("Todas las tablas han sido creadas exitosamente")
         return True
         
     except Exception as e:
-        print(f"Error creando las tablas: {e}")
+        logger.error("Error creando las tablas: %s", e)
         return False
 
 def create_default_roles():
@@ -462,7 +925,7 @@ def create_default_roles():
             VALUES (%s, %s, %s)
             """
             execute_query(insert_query, (role_id, name, description))
-            print(f"Rol '{name}' creado exitosamente")
+            logger.info("Rol '%s' creado exitosamente", name)
 
 def create_superuser():
     """
@@ -490,7 +953,7 @@ def create_superuser():
         VALUES (%s, %s, %s, %s, %s)
         """
         execute_query(insert_query, (username, email, hashed_password, role_id, True))
-        print(f"Superusuario '{username}' creado exitosamente")
+        logger.info("Superusuario '%s' creado exitosamente", username)
 
 # Inicializar la base de datos al importar el módulo
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import pymysql
+from database.db import execute_query, run_transaction_with_retry, transaction
+
+# Peticiones idempotentes (p. ej. POST /purchases con la cabecera Idempotency-Key).
+#
+# La primera petición con una clave inserta una fila 'processing' en
+# idempotency_keys. La operación y el paso de la clave a 'completed' con su
+# respuesta se confirman en la misma transacción, así que nunca queda una
+# compra registrada con su clave en 'processing'. Un reintento con la misma
+# clave devuelve la respuesta guardada sin volver a ejecutar la operación, y si
+# llega mientras la primera todavía se está ejecutando espera a que termine (en
+# el mismo proceso con un Event, entre workers consultando la fila). Si la
+# operación falla la clave se elimina para que el cliente pueda reintentar.
+#
+# Una clave 'processing' abandonada (el proceso murió antes del commit) o
+# caducada se recupera tras IDEMPOTENCY_LOCK_SECONDS; antes de repetir la
+# operación se pregunta a `recover` si ya quedó hecha (p. ej. la factura ya
+# existe) y en ese caso se devuelve su resultado.
+
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 10))  # espera máxima a una petición en curso
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 60))  # 'processing' más antiguo: el worker murió
+IDEMPOTENCY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_TTL_HOURS', 24))  # tiempo que se conservan las respuestas
+
+IDEMPOTENCY_TABLE = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    idem_key VARCHAR(190) PRIMARY KEY,
+    fingerprint CHAR(64) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'processing',
+    response TEXT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_idempotency_keys_created (created_at)
+)
+"""
+
+# Cada cuánto un proceso elimina las claves caducadas
+_CLEANUP_INTERVAL_SECONDS = 600
+_POLL_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+_last_cleanup = 0.0
+_stats = {'executed': 0, 'replayed': 0, 'waited': 0, 'conflicts': 0, 'timeouts': 0}
+
+class IdempotencyConflict(Exception):
+    """La clave ya se usó con un cuerpo de petición distinto"""
+
+class IdempotencyInProgress(Exception):
+    """La petición original sigue en curso tras IDEMPOTENCY_WAIT_SECONDS"""
+
+def request_fingerprint(payload):
+    """Huella (sha256) del cuerpo de una petición, independiente del orden de las claves"""
+    normalized = json.dumps(payload, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def _count(name):
+    with _inflight_lock:
+        _stats[name] += 1
+
+# Resultado de _claim
+_CLAIMED = 'claimed'
+_RECLAIMED = 'reclaimed'
+
+def _claim(key, fingerprint):
+    """
+    Insertar la clave como 'processing' (o recuperar una abandonada o caducada)
+
+    Returns:
+        _CLAIMED o _RECLAIMED si la petición es nuestra, None si otra la tiene
+    """
+    try:
+        with transaction() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO idempotency_keys (idem_key, fingerprint, status) VALUES (%s, %s, 'processing')",
+                    (key, fingerprint)
+                )
+        return _CLAIMED
+    except pymysql.err.IntegrityError as e:
+        if e.args[0] != 1062:
+            raise
+
+    # Ya existe: se recupera si quedó 'processing' de un worker que murió o si caducó
+    with transaction() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE idempotency_keys
+                SET fingerprint = %s, status = 'processing', response = NULL, created_at = NOW()
+                WHERE idem_key = %s
+                  AND ((status = 'processing' AND updated_at < NOW() - INTERVAL %s SECOND)
+                       OR created_at < NOW() - INTERVAL %s HOUR)
+                """,
+                (fingerprint, key, IDEMPOTENCY_LOCK_SECONDS, IDEMPOTENCY_TTL_HOURS)
+            )
+            return _RECLAIMED if cursor.rowcount == 1 else None
+
+def _complete(key, result):
+    """
+    Guardar la respuesta y marcar la clave 'completed' en la transacción en curso
+
+    Raises:
+        Exception: si la clave ya no está en 'processing' (p. ej. se eliminó), para
+                   que la operación se deshaga en lugar de quedar sin respuesta guardada
+    """
+    updated = execute_query(
+        "UPDATE idempotency_keys SET status = 'completed', response = %s "
+        "WHERE idem_key = %s AND status = 'processing'",
+        (json.dumps(result, default=str), key)
+    )
+    if updated != 1:
+        raise Exception(f"No se pudo guardar la respuesta de la clave de idempotencia {key}")
+
+def _execute(key, operation):
+    """Ejecutar operation() y completar la clave en una sola transacción"""
+    with transaction():
+        result = operation()
+        _complete(key, result)
+    return result
+
+def _read(key):
+    """(fingerprint, status, respuesta) de una clave, o None si no existe"""
+    row = execute_query(
+        "SELECT fingerprint, status, response FROM idempotency_keys WHERE idem_key = %s",
+        (key,), fetch_one=True, compact=True
+    )
+    if row is None:
+        return None
+    fingerprint, status, response = row
+    return fingerprint, status, json.loads(response) if response is not None else None
+
+def _cleanup_expired():
+    """Eliminar las claves caducadas, como mucho una vez cada _CLEANUP_INTERVAL_SECONDS por proceso"""
+    global _last_cleanup
+    now = time.monotonic()
+    if now - _last_cleanup < _CLEANUP_INTERVAL_SECONDS:
+        return
+    _last_cleanup = now
+    execute_query(
+        "DELETE FROM idempotency_keys WHERE created_at < NOW() - INTERVAL %s HOUR LIMIT 1000",
+        (IDEMPOTENCY_TTL_HOURS,)
+    )
+
+def run_idempotent(key, fingerprint, operation, recover=None):
+    """
+    Ejecutar operation() una sola vez por clave
+
+    Args:
+        key: Clave de idempotencia (incluye el tipo de operación, p. ej. "purchases:<clave>")
+        fingerprint: Huella del cuerpo de la petición (request_fingerprint)
+        operation: Función sin argumentos que devuelve un resultado serializable a JSON;
+                   se ejecuta dentro de una unidad de trabajo (transaction()) que se
+                   reintenta completa si MySQL la aborta por deadlock
+        recover: Función sin argumentos que, al recuperar una clave abandonada o
+                 caducada, devuelve el resultado si la operación ya quedó hecha (o None)
+
+    Returns:
+        Tupla (resultado, replayed); replayed es True si el resultado es el guardado
+        de una petición anterior con la misma clave
+
+    Raises:
+        IdempotencyConflict: si la clave se usó con otro cuerpo
+        IdempotencyInProgress: si la petición original no terminó a tiempo
+        Las excepciones de operation() se propagan y la clave se libera
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        # En el mismo proceso se espera al hilo que ejecuta la petición original
+        with _inflight_lock:
+            event = _inflight.get(key)
+            if event is None:
+                event = _inflight[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            _count('waited')
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                _count('timeouts')
+                raise IdempotencyInProgress(key)
+            continue
+
+        try:
+            claimed = _claim(key, fingerprint)
+            if claimed:
+                _cleanup_expired()
+                if claimed == _RECLAIMED and recover is not None:
+                    result = recover()
+                    if result is not None:
+                        with transaction():
+                            _complete(key, result)
+                        _count('replayed')
+                        return result, True
+                try:
+                    result = run_transaction_with_retry(lambda: _execute(key, operation))
+                except Exception:
+                    if execute_query("DELETE FROM idempotency_keys WHERE idem_key = %s", (key,)) is None:
+                        logger.error("No se pudo liberar la clave de idempotencia %s; se recuperará tras %s s",
+                                     key, IDEMPOTENCY_LOCK_SECONDS)
+                    raise
+                _count('executed')
+                return result, False
+        finally:
+            with _inflight_lock:
+                _inflight.pop(key, None)
+            event.set()
+
+        # Otro worker tiene la clave: comparar la huella y esperar su resultado
+        while True:
+            stored = _read(key)
+            if stored is None:
+                # La petición original falló y liberó la clave
+                break
+            stored_fingerprint, status, response = stored
+            if stored_fingerprint != fingerprint:
+                _count('conflicts')
+                raise IdempotencyConflict(key)
+            if status == 'completed':
+                _count('replayed')
+                return response, True
+            if time.monotonic() >= deadline:
+                _count('timeouts')
+                raise IdempotencyInProgress(key)
+            time.sleep(_POLL_SECONDS)
+
+def get_idempotency_stats():
+    """Operaciones ejecutadas, respuestas repetidas, esperas, conflictos y esperas agotadas"""
+    with _inflight_lock:
+        return dict(_stats)
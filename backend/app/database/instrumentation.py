@@ -0,0 +1,285 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+# Instrumentación de las consultas SQL: latencia por sentencia, filas devueltas,
+# contadores por petición HTTP y registro de consultas lentas.
+
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))  # umbral del registro de consultas lentas
+SLOW_QUERY_LOG_SIZE = int(os.getenv('DB_SLOW_QUERY_LOG_SIZE', 200))  # consultas lentas que se conservan
+QUERY_SAMPLES = int(os.getenv('DB_QUERY_SAMPLES', 1024))  # latencias recientes por huella para los percentiles
+
+slow_query_logger = logging.getLogger('database.slow_query')
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_RE = re.compile(r"%s|%\([A-Za-z_]+\)s")
+_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_RE = re.compile(r"(VALUES\s*\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+", re.IGNORECASE)
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_SPACE_RE = re.compile(r"\s+")
+
+def fingerprint(query):
+    """
+    Normalizar una sentencia SQL para agrupar las que solo cambian en sus valores.
+
+    Los literales y placeholders pasan a ser '?', las listas IN (...) y los
+    INSERT de varios VALUES se colapsan, y se unifican espacios y mayúsculas.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    text = _COMMENT_RE.sub(' ', query)
+    text = _STRING_RE.sub('?', text)
+    text = _PLACEHOLDER_RE.sub('?', text)
+    text = _NUMBER_RE.sub('?', text)
+    text = _SPACE_RE.sub(' ', text).strip()
+    text = _LIST_RE.sub('(...)', text)
+    text = _VALUES_RE.sub(r'\1', text)
+    return text.upper()
+
+class RequestStats:
+    """Contadores de base de datos de una petición HTTP"""
+
+    def __init__(self, request_id, endpoint):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed, rows):
+        with self._lock:
+            self.queries += 1
+            self.db_time += elapsed
+            self.rows += rows
+
+    @property
+    def db_time_ms(self):
+        return round(self.db_time * 1000, 3)
+
+_current_request = contextvars.ContextVar('db_current_request', default=None)
+
+def start_request(request_id, endpoint):
+    """
+    Empezar a contar las consultas de una petición (se llama desde el middleware)
+
+    Returns:
+        (stats, token) - token se pasa a end_request al terminar
+    """
+    stats = RequestStats(request_id, endpoint)
+    return stats, _current_request.set(stats)
+
+def end_request(token):
+    """
+    Dejar de asociar las consultas a la petición actual y acumular sus
+    contadores en las estadísticas del endpoint
+    """
+    stats = _current_request.get()
+    _current_request.reset(token)
+    if stats is None or not stats.endpoint:
+        return
+    with _lock:
+        endpoint = _endpoint_stats.get(stats.endpoint)
+        if endpoint is None:
+            endpoint = _endpoint_stats[stats.endpoint] = {
+                'requests': 0, 'queries': 0, 'db_time': 0.0, 'max_queries': 0
+            }
+        endpoint['requests'] += 1
+        endpoint['queries'] += stats.queries
+        endpoint['db_time'] += stats.db_time
+        if stats.queries > endpoint['max_queries']:
+            endpoint['max_queries'] = stats.queries
+
+def get_current_request():
+    """Contadores de la petición en curso, o None fuera de una petición"""
+    return _current_request.get()
+
+class _FingerprintStats:
+    """Estadísticas acumuladas de una huella de consulta"""
+    __slots__ = ('count', 'total_time', 'max_time', 'rows', 'samples', 'endpoints')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=QUERY_SAMPLES)
+        self.endpoints = {}
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+_stats = {}
+_endpoint_stats = {}
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_lock = threading.Lock()
+
+def record_query(query, elapsed, rows=0):
+    """
+    Registrar una sentencia ejecutada
+
+    Args:
+        query: Sentencia SQL tal como se envió (con placeholders)
+        elapsed: Duración en segundos
+        rows: Filas devueltas o afectadas
+    """
+    # Los cursores sin buffer no conocen el total de filas (rowcount = -1 o 2**64-1)
+    rows = rows if rows and 0 < rows < 2 ** 63 else 0
+    key = fingerprint(query)
+    request = _current_request.get()
+    endpoint = request.endpoint if request else None
+
+    if request is not None:
+        request.add(elapsed, rows)
+
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = _FingerprintStats()
+        stats.count += 1
+        stats.total_time += elapsed
+        stats.rows += rows
+        stats.samples.append(elapsed)
+        if elapsed > stats.max_time:
+            stats.max_time = elapsed
+        if endpoint:
+            stats.endpoints[endpoint] = stats.endpoints.get(endpoint, 0) + 1
+
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms >= SLOW_QUERY_MS:
+        entry = {
+            'fingerprint': key,
+            'duration_ms': round(elapsed_ms, 3),
+            'rows': rows,
+            'endpoint': endpoint,
+            'request_id': request.request_id if request else None,
+            'timestamp': time.time()
+        }
+        with _lock:
+            _slow_queries.append(entry)
+        slow_query_logger.warning(
+            f"Consulta lenta ({entry['duration_ms']} ms, {rows} filas) "
+            f"[{endpoint or '-'} {entry['request_id'] or '-'}]: {key}"
+        )
+
+class InstrumentedCursor:
+    """
+    Envoltura de un cursor de pymysql que mide cada execute/executemany.
+
+    El resto de métodos (fetchone, fetchall, lastrowid...) se delegan al
+    cursor original, por lo que el código existente no necesita cambios.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cursor.close()
+
+    def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            record_query(query, time.perf_counter() - started, self._cursor.rowcount)
+
+    def executemany(self, query, args):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, args)
+        finally:
+            record_query(query, time.perf_counter() - started, self._cursor.rowcount)
+
+def get_query_stats(limit=50, order_by='total_time'):
+    """
+    Estadísticas agregadas por huella de consulta
+
+    Args:
+        limit: Máximo de huellas a devolver
+        order_by: 'total_time', 'count', 'p95' o 'max'
+
+    Returns:
+        Lista de diccionarios con count, tiempos (ms) y percentiles p50/p95/p99
+    """
+    with _lock:
+        snapshot = [
+            (key, stats.count, stats.total_time, stats.max_time, stats.rows,
+             sorted(stats.samples), dict(stats.endpoints))
+            for key, stats in _stats.items()
+        ]
+
+    result = []
+    for key, count, total_time, max_time, rows, samples, endpoints in snapshot:
+        result.append({
+            'fingerprint': key,
+            'count': count,
+            'rows': rows,
+            'total_time_ms': round(total_time * 1000, 3),
+            'avg_ms': round(total_time / count * 1000, 3) if count else 0.0,
+            'p50_ms': round(_percentile(samples, 50) * 1000, 3),
+            'p95_ms': round(_percentile(samples, 95) * 1000, 3),
+            'p99_ms': round(_percentile(samples, 99) * 1000, 3),
+            'max_ms': round(max_time * 1000, 3),
+            'endpoints': endpoints
+        })
+
+    sort_keys = {
+        'total_time': 'total_time_ms',
+        'count': 'count',
+        'p95': 'p95_ms',
+        'max': 'max_ms'
+    }
+    result.sort(key=lambda item: item[sort_keys.get(order_by, 'total_time_ms')], reverse=True)
+    return result[:limit]
+
+def get_endpoint_stats():
+    """
+    Consultas y tiempo de base de datos por endpoint, ordenados por consultas
+    por petición (un valor alto suele indicar un patrón N+1)
+    """
+    with _lock:
+        snapshot = [(name, dict(stats)) for name, stats in _endpoint_stats.items()]
+
+    result = []
+    for name, stats in snapshot:
+        requests = stats['requests']
+        result.append({
+            'endpoint': name,
+            'requests': requests,
+            'queries': stats['queries'],
+            'avg_queries_per_request': round(stats['queries'] / requests, 2) if requests else 0.0,
+            'max_queries_per_request': stats['max_queries'],
+            'avg_db_time_ms': round(stats['db_time'] / requests * 1000, 3) if requests else 0.0
+        })
+    result.sort(key=lambda item: item['avg_queries_per_request'], reverse=True)
+    return result
+
+def get_slow_queries(limit=50):
+    """Consultas lentas más recientes (la más nueva primero)"""
+    with _lock:
+        entries = list(_slow_queries)
+    return entries[::-1][:limit]
+
+def reset_query_stats():
+    """Borrar las estadísticas acumuladas y el registro de consultas lentas"""
+    with _lock:
+        _stats.clear()
+        _endpoint_stats.clear()
+        _slow_queries.clear()
@@ -0,0 +1,299 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import pymysql
+from pymysql.constants import SERVER_STATUS
+
+from database.instrumentation import InstrumentedCursor
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    """Se lanza cuando no hay conexiones libres antes de agotar el tiempo de espera"""
+
+
+class _PoolEntry:
+    """Conexión física del pool junto con sus marcas de tiempo"""
+    __slots__ = ('connection', 'created_at', 'last_used')
+
+    def __init__(self, connection):
+        now = time.monotonic()
+        self.connection = connection
+        self.created_at = now
+        self.last_used = now
+
+
+class PooledConnection:
+    """
+    Envoltura de una conexión prestada por el pool.
+
+    Se comporta como una conexión de pymysql (cursor, commit, rollback, begin...),
+    pero close() la devuelve al pool en lugar de cerrar el socket, de modo que
+    el código existente que hace connection.close() en su bloque finally sigue
+    funcionando sin cambios.
+    """
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        entry = self.__dict__.get('_entry')
+        if entry is None:
+            raise pymysql.err.InterfaceError(0, "La conexión ya fue devuelta al pool")
+        return getattr(entry.connection, name)
+
+    def cursor(self, cursor=None):
+        """Crear un cursor que registra la duración de cada consulta"""
+        if self._entry is None:
+            raise pymysql.err.InterfaceError(0, "La conexión ya fue devuelta al pool")
+        return InstrumentedCursor(self._entry.connection.cursor(cursor))
+
+    @property
+    def raw_connection(self):
+        """Conexión pymysql subyacente"""
+        return self._entry.connection if self._entry else None
+
+    def close(self):
+        """Devolver la conexión al pool (idempotente)"""
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self._pool.release(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Si el llamador olvidó cerrarla, devolverla para no perder capacidad del pool
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones MySQL acotado y seguro entre hilos.
+
+    - min_size: conexiones que se abren al primer uso y se mantienen listas
+    - max_size: máximo de conexiones abiertas (en uso + libres)
+    - timeout: segundos que se espera por una conexión libre antes de fallar
+    - recycle: segundos de vida máxima de una conexión antes de reemplazarla
+    - ping_interval: segundos de inactividad tras los cuales se verifica la
+      conexión con un ping antes de prestarla (0 = verificar siempre)
+    """
+
+    def __init__(self, config, min_size=1, max_size=10, timeout=30.0,
+                 recycle=3600, ping_interval=30):
+        if max_size < 1:
+            raise ValueError("max_size debe ser al menos 1")
+        if min_size < 0 or min_size > max_size:
+            raise ValueError("min_size debe estar entre 0 y max_size")
+
+        self._config = dict(config)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        self._idle = deque()
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._warmed = False
+        self._cond = threading.Condition()
+
+        # Contadores para monitoreo
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._failed_health_checks = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _connect(self):
+        entry = _PoolEntry(pymysql.connect(**self._config))
+        with self._cond:
+            self._created += 1
+        return entry
+
+    def _discard(self, entry):
+        try:
+            entry.connection.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, entry):
+        """Verifica la edad y la salud de una conexión antes de prestarla"""
+        now = time.monotonic()
+        if self.recycle and now - entry.created_at > self.recycle:
+            with self._cond:
+                self._recycled += 1
+            return False
+        if not entry.connection.open:
+            return False
+        if now - entry.last_used >= self.ping_interval:
+            try:
+                entry.connection.ping(reconnect=False)
+            except Exception:
+                with self._cond:
+                    self._failed_health_checks += 1
+                return False
+        return True
+
+    def _warm_up(self):
+        """Abrir las conexiones mínimas la primera vez que se usa el pool"""
+        with self._cond:
+            if self._warmed:
+                return
+            self._warmed = True
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+
+        entries = []
+        try:
+            for _ in range(missing):
+                entries.append(self._connect())
+        except Exception as e:
+            logger.error("Error precalentando el pool de conexiones: %s", e)
+        finally:
+            with self._cond:
+                self._size -= missing - len(entries)
+                self._idle.extend(entries)
+                self._cond.notify_all()
+
+    def acquire(self, timeout=None):
+        """
+        Obtener una conexión del pool
+
+        Args:
+            timeout: segundos máximos de espera (por defecto el del pool)
+
+        Returns:
+            PooledConnection lista para usarse
+        """
+        if not self._warmed:
+            self._warm_up()
+
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        entry = None
+        create = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise pymysql.err.InterfaceError(0, "El pool de conexiones está cerrado")
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    create = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        f"No hay conexiones disponibles tras esperar {timeout} segundos "
+                        f"(max_size={self.max_size})"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        if not create and not self._is_usable(entry):
+            # Reemplazar la conexión vencida o caída por una nueva
+            self._discard(entry)
+            create = True
+
+        if create:
+            try:
+                entry = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._checkouts += 1
+            self._total_wait += waited
+            if waited > self._max_wait:
+                self._max_wait = waited
+        return PooledConnection(self, entry)
+
+    def release(self, entry):
+        """Devolver una conexión al pool dejándola en estado limpio"""
+        connection = entry.connection
+        reusable = not self._closed and connection.open
+
+        if reusable:
+            try:
+                # Deshacer cualquier transacción que el llamador haya dejado abierta
+                if connection.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    connection.rollback()
+                if connection.get_autocommit() != self._config.get('autocommit', False):
+                    connection.autocommit(self._config.get('autocommit', False))
+            except Exception:
+                reusable = False
+
+        if reusable and self.recycle and time.monotonic() - entry.created_at > self.recycle:
+            reusable = False
+            with self._cond:
+                self._recycled += 1
+
+        if not reusable:
+            self._discard(entry)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def close(self):
+        """Cerrar todas las conexiones libres y rechazar nuevos préstamos"""
+        with self._cond:
+            self._closed = True
+            entries = list(self._idle)
+            self._idle.clear()
+            self._size -= len(entries)
+            self._cond.notify_all()
+        for entry in entries:
+            self._discard(entry)
+
+    def stats(self):
+        """Estadísticas del pool para monitoreo"""
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._size - idle,
+                'idle': idle,
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'connections_created': self._created,
+                'connections_recycled': self._recycled,
+                'failed_health_checks': self._failed_health_checks,
+                'avg_wait_ms': round(self._total_wait / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
@@ -0,0 +1,63 @@
+from collections import namedtuple
+from functools import lru_cache
+
+# Modo compacto de filas: en lugar de un diccionario por fila (DictCursor, que
+# repite las claves en cada fila) se guardan las filas como tuplas tal como las
+# entrega pymysql y un único índice de columnas compartido por todo el resultado.
+
+@lru_cache(maxsize=256)
+def _record_type(columns):
+    # Un tipo namedtuple por conjunto de columnas; rename evita fallar con
+    # alias que no son identificadores válidos (p. ej. COUNT(*))
+    return namedtuple('Record', columns, rename=True)
+
+def columns_from_description(description):
+    """Nombres de columna a partir de cursor.description"""
+    return tuple(column[0] for column in description or ())
+
+class RowSet:
+    """
+    Resultado compacto de una consulta: filas como tuplas más un índice de
+    columnas compartido.
+
+    - rows: lista de tuplas (las mismas que devuelve el cursor, sin copiar)
+    - columns: nombres de columna en el orden de la consulta
+    - index: {columna: posición}, para leer un valor con row[rowset.index['col']]
+    """
+    __slots__ = ('columns', 'index', 'rows')
+
+    def __init__(self, columns, rows, index=None):
+        self.columns = tuple(columns)
+        self.index = index if index is not None else {name: position for position, name in enumerate(self.columns)}
+        self.rows = rows if isinstance(rows, list) else list(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def column(self, name):
+        """Valores de una columna"""
+        position = self.index[name]
+        return [row[position] for row in self.rows]
+
+    def records(self):
+        """Filas como namedtuple (acceso por atributo, sin diccionario por fila)"""
+        record = _record_type(self.columns)
+        return [record._make(row) for row in self.rows]
+
+    def to_dicts(self):
+        """Filas como diccionarios (mismo formato que DictCursor)"""
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in self.rows]
+
+    def to_compact(self):
+        """
+        Formato compacto para la respuesta JSON: {"columns": [...], "rows": [[...], ...]}.
+        Las tuplas se serializan directamente como arreglos, sin construir diccionarios.
+        """
+        return {'columns': list(self.columns), 'rows': self.rows}
@@ -0,0 +1,437 @@
+import hashlib
+import logging
+import re
+import time
+from datetime import date, timedelta
+
+import pymysql
+from database.db import (
+    get_db_connection, get_schema_statements, create_database_if_not_exists,
+    create_default_roles, create_superuser
+)
+from database.cache import CACHE_VERSIONS_TABLE
+from database.idempotency import IDEMPOTENCY_TABLE
+from models.purchase_backfill import BACKFILL_PROGRESS_TABLE
+from models.consumption_queue import PENDING_CONSUMPTION_TABLE
+from models.product_availability import PRODUCT_AVAILABILITY_TABLE, rebuild_product_availability
+from models.insumo_ledger import (
+    INSUMO_CHECKPOINTS_TABLE, INSUMO_DAILY_SNAPSHOTS_TABLE, INSUMO_MOVEMENTS_TABLE, reconcile_ledger
+)
+
+# Registro de versiones del esquema.
+#
+# Cada cambio de esquema es una migración numerada. La tabla schema_migrations
+# guarda la versión y el checksum de las migraciones aplicadas, de modo que al
+# arrancar basta con una consulta para saber si hay algo que ejecutar; el DDL
+# (y la creación de roles y superusuario) solo se ejecuta cuando hace falta.
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    checksum CHAR(64) NOT NULL,
+    execution_ms INT NOT NULL DEFAULT 0,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+
+# Nombre del bloqueo de MySQL que evita que varios workers migren a la vez
+MIGRATION_LOCK = 'inventory_schema_migrations'
+MIGRATION_LOCK_TIMEOUT = 60
+
+class AddIndex:
+    """
+    Paso de migración que crea un índice secundario en línea.
+
+    MySQL no admite ADD INDEX IF NOT EXISTS, así que antes de ejecutarlo se
+    consulta information_schema y se omite si el índice ya existe.
+    ALGORITHM=INPLACE, LOCK=NONE permite seguir leyendo y escribiendo en la
+    tabla mientras se construye el índice.
+    """
+
+    def __init__(self, table, name, columns):
+        self.table = table
+        self.name = name
+        self.columns = list(columns)
+
+    def __str__(self):
+        return (
+            f"ALTER TABLE {self.table} ADD INDEX {self.name} ({', '.join(self.columns)}), "
+            f"ALGORITHM=INPLACE, LOCK=NONE"
+        )
+
+    def exists(self, cursor):
+        cursor.execute(
+            """
+            SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            LIMIT 1
+            """,
+            (self.table, self.name)
+        )
+        return cursor.fetchone() is not None
+
+class AddColumn:
+    """
+    Paso de migración que añade una columna en línea.
+
+    Igual que AddIndex, se consulta information_schema antes de ejecutarlo
+    (MySQL no admite ADD COLUMN IF NOT EXISTS) y se omite si ya existe.
+    """
+
+    def __init__(self, table, name, definition):
+        self.table = table
+        self.name = name
+        self.definition = definition
+
+    def __str__(self):
+        return (
+            f"ALTER TABLE {self.table} ADD COLUMN {self.name} {self.definition}, "
+            f"ALGORITHM=INPLACE, LOCK=NONE"
+        )
+
+    def exists(self, cursor):
+        cursor.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+            LIMIT 1
+            """,
+            (self.table, self.name)
+        )
+        return cursor.fetchone() is not None
+
+class Migration:
+    """
+    Migración de esquema
+
+    - version: número de orden (único y creciente)
+    - name: descripción corta
+    - statements: sentencias SQL o pasos AddIndex/AddColumn; deben ser idempotentes
+      porque una migración se vuelve a ejecutar si su checksum cambia
+    - after: función opcional que se ejecuta tras las sentencias (datos iniciales)
+    - explain: consultas de ejemplo (query, params) cuyo plan se muestra antes
+      y después de aplicar la migración
+    """
+
+    def __init__(self, version, name, statements, after=None, explain=None):
+        self.version = version
+        self.name = name
+        self.statements = list(statements)
+        self.after = after
+        self.explain = list(explain or [])
+
+    @property
+    def checksum(self):
+        normalized = "\n".join(re.sub(r"\s+", " ", str(statement)).strip() for statement in self.statements)
+        return hashlib.sha256(f"{self.version}:{self.name}\n{normalized}".encode('utf-8')).hexdigest()
+
+def _seed_initial_data():
+    # Roles predeterminados y superusuario
+    create_default_roles()
+    create_superuser()
+
+def _build_product_availability():
+    # Primera carga de la disponibilidad materializada
+    rebuild_product_availability()
+
+def _open_insumo_ledger():
+    # Saldo inicial de los insumos existentes en el libro de movimientos
+    reconcile_ledger()
+
+def _recent_range():
+    # Rango de fechas usado en las consultas de ejemplo de EXPLAIN
+    return (date.today() - timedelta(days=30), date.today())
+
+# Los cambios de esquema nuevos se añaden al final de esta lista (en lugar de
+# scripts sueltos como fix_products_table.py o update_insumos_table.py) y se
+# aplican con `python migrate.py` o automáticamente al arrancar.
+MIGRATIONS = [
+    Migration(1, 'esquema_inicial', get_schema_statements(), after=_seed_initial_data),
+    Migration(
+        2, 'indices_compras',
+        [
+            AddIndex('purchases', 'idx_purchases_invoice_date', ['invoice_date']),
+            AddIndex('purchases', 'idx_purchases_cancelled_date', ['is_cancelled', 'invoice_date']),
+            AddIndex('purchases', 'idx_purchases_seller_date', ['seller_username', 'invoice_date']),
+        ],
+        explain=[
+            ("SELECT COUNT(*), SUM(total_amount) FROM purchases "
+             "WHERE invoice_date BETWEEN %s AND %s AND is_cancelled = FALSE", _recent_range()),
+            ("SELECT id FROM purchases WHERE seller_username = %s AND invoice_date BETWEEN %s AND %s",
+             ('admin',) + _recent_range()),
+        ]
+    ),
+    Migration(
+        3, 'indices_detalles_compras',
+        [AddIndex('purchase_details', 'idx_purchase_details_product', ['product_name', 'product_variant'])],
+        explain=[
+            ("SELECT SUM(quantity) FROM purchase_details WHERE product_name = %s AND product_variant = %s",
+             ('Helado', 'Fresa')),
+        ]
+    ),
+    Migration(
+        4, 'indices_productos',
+        [AddIndex('products', 'idx_products_name_variant_active', ['nombre_producto', 'variante', 'is_active'])],
+        explain=[
+            ("SELECT id FROM products WHERE nombre_producto = %s AND variante = %s AND is_active = TRUE",
+             ('Helado', 'Fresa')),
+        ]
+    ),
+    Migration(
+        5, 'indices_ventas',
+        [AddIndex('sales', 'idx_sales_sale_date', ['sale_date'])],
+        explain=[
+            ("SELECT id FROM sales WHERE sale_date >= %s AND sale_date < %s + INTERVAL 1 DAY",
+             _recent_range()),
+        ]
+    ),
+    Migration(
+        6, 'indices_recetas',
+        [AddIndex('product_recipes', 'idx_product_recipes_product', ['product_id', 'insumo_id', 'cantidad'])],
+        explain=[
+            ("SELECT insumo_id, cantidad FROM product_recipes WHERE product_id = %s", (1,)),
+        ]
+    ),
+    Migration(7, 'versiones_cache', [CACHE_VERSIONS_TABLE]),
+    # Las filas anteriores se completan con `python backfill.py` (ver models/purchase_backfill.py)
+    Migration(
+        8, 'producto_en_detalles_compras',
+        [
+            AddColumn('purchase_details', 'product_id', 'INT NULL AFTER purchase_id'),
+            AddColumn('purchase_details', 'category_id', 'INT NULL AFTER product_id'),
+            AddIndex('purchase_details', 'idx_purchase_details_product_id', ['product_id', 'purchase_id', 'quantity']),
+            BACKFILL_PROGRESS_TABLE,
+        ],
+        explain=[
+            ("SELECT SUM(quantity) FROM purchase_details WHERE product_id = %s", (1,)),
+        ]
+    ),
+    Migration(9, 'claves_idempotencia', [IDEMPOTENCY_TABLE]),
+    Migration(10, 'consumo_insumos_pendiente', [PENDING_CONSUMPTION_TABLE]),
+    Migration(11, 'disponibilidad_productos', [PRODUCT_AVAILABILITY_TABLE], after=_build_product_availability),
+    Migration(
+        12, 'libro_movimientos_insumos',
+        [INSUMO_MOVEMENTS_TABLE, INSUMO_CHECKPOINTS_TABLE],
+        after=_open_insumo_ledger
+    ),
+    Migration(13, 'instantaneas_diarias_insumos', [INSUMO_DAILY_SNAPSHOTS_TABLE]),
+    # El stream de cambios de stock lee las filas cambiadas desde la última lectura
+    Migration(14, 'indice_disponibilidad_actualizada', [
+        AddIndex('product_availability', 'idx_product_availability_updated', ['updated_at'])
+    ]),
+]
+
+def get_applied_migrations(cursor):
+    """
+    Leer las migraciones aplicadas
+
+    Returns:
+        Dict {version: checksum}, o None si la tabla de registro no existe
+    """
+    try:
+        cursor.execute("SELECT version, checksum FROM schema_migrations")
+    except pymysql.err.ProgrammingError as e:
+        if e.args[0] == 1146:  # Table doesn't exist
+            return None
+        raise
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+def get_pending_migrations(applied):
+    """Migraciones que no están aplicadas o cuyo checksum cambió"""
+    applied = applied or {}
+    return [
+        migration for migration in MIGRATIONS
+        if applied.get(migration.version) != migration.checksum
+    ]
+
+def explain_migration(cursor, migration):
+    """
+    Plan de ejecución (EXPLAIN) de las consultas de ejemplo de una migración
+
+    Returns:
+        Lista de (query, filas de EXPLAIN como diccionarios)
+    """
+    plans = []
+    for query, params in migration.explain:
+        cursor.execute("EXPLAIN " + query, params)
+        columns = [column[0] for column in cursor.description]
+        plans.append((query, [dict(zip(columns, row)) for row in cursor.fetchall()]))
+    return plans
+
+def format_explain(plans):
+    """Texto legible con la tabla, el índice elegido y las filas estimadas de cada plan"""
+    lines = []
+    for query, rows in plans:
+        lines.append(f"    {query}")
+        for row in rows:
+            lines.append(
+                f"      tabla={row.get('table')} tipo={row.get('type')} "
+                f"indice={row.get('key')} filas={row.get('rows')} extra={row.get('Extra')}"
+            )
+    return "\n".join(lines)
+
+def apply_migration(cursor, migration):
+    """Ejecutar una migración y registrarla en schema_migrations"""
+    started = time.perf_counter()
+    for statement in migration.statements:
+        if isinstance(statement, (AddIndex, AddColumn)) and statement.exists(cursor):
+            logger.info("%s ya existe en %s, se omite", statement.name, statement.table)
+            continue
+        cursor.execute(str(statement))
+    if migration.after:
+        migration.after()
+    execution_ms = int((time.perf_counter() - started) * 1000)
+
+    cursor.execute(
+        """
+        INSERT INTO schema_migrations (version, name, checksum, execution_ms)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE name = VALUES(name), checksum = VALUES(checksum),
+                                execution_ms = VALUES(execution_ms)
+        """,
+        (migration.version, migration.name, migration.checksum, execution_ms)
+    )
+    logger.info("Migración %s (%s) aplicada en %s ms", migration.version, migration.name, execution_ms)
+
+def migrate(dry_run=False, explain=False, target=None):
+    """
+    Aplicar las migraciones pendientes en orden
+
+    Args:
+        dry_run: Solo mostrar lo que se ejecutaría (y el EXPLAIN actual) sin cambiar nada
+        explain: Mostrar el EXPLAIN de las consultas de ejemplo antes y después de cada migración
+        target: Versión máxima a aplicar (por defecto todas)
+
+    Returns:
+        Lista de versiones aplicadas (o que se aplicarían en dry_run), o None si ocurrió un error
+    """
+    connection = get_db_connection()
+    if not connection:
+        # Puede que la base de datos todavía no exista
+        if dry_run:
+            return None
+        create_database_if_not_exists()
+        connection = get_db_connection()
+        if not connection:
+            return None
+
+    cursor = None
+    locked = False
+    try:
+        cursor = connection.cursor()
+
+        if not dry_run:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+            locked = cursor.fetchone()[0] == 1
+            if not locked:
+                logger.warning("No se pudo obtener el bloqueo de migraciones; otro proceso está migrando el esquema")
+                return None
+            cursor.execute(MIGRATIONS_TABLE)
+
+        # Se vuelve a leer con el bloqueo tomado: otro worker pudo haber migrado antes
+        pending = [
+            migration for migration in get_pending_migrations(get_applied_migrations(cursor))
+            if target is None or migration.version <= target
+        ]
+
+        for migration in pending:
+            if dry_run:
+                print(f"[dry-run] Migración {migration.version} ({migration.name}):")
+                for statement in migration.statements:
+                    skip = isinstance(statement, (AddIndex, AddColumn)) and statement.exists(cursor)
+                    sql = re.sub(r"\s+", " ", str(statement)).strip()
+                    print(f"  {'(ya existe) ' if skip else ''}{sql[:200]}")
+                if migration.explain:
+                    print("  EXPLAIN actual:")
+                    print(format_explain(explain_migration(cursor, migration)))
+                continue
+
+            if explain and migration.explain:
+                before = explain_migration(cursor, migration)
+            apply_migration(cursor, migration)
+            if explain and migration.explain:
+                print("  EXPLAIN antes:")
+                print(format_explain(before))
+                print("  EXPLAIN después:")
+                print(format_explain(explain_migration(cursor, migration)))
+
+        return [migration.version for migration in pending]
+
+    except Exception as e:
+        logger.error("Error aplicando migraciones: %s", e)
+        return None
+    finally:
+        if cursor:
+            if locked:
+                try:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+                    cursor.fetchall()
+                except Exception:
+                    pass
+            cursor.close()
+        connection.close()
+
+def get_migration_status():
+    """
+    Estado de cada migración: aplicada, pendiente o modificada (checksum distinto)
+
+    Returns:
+        Lista de diccionarios, o None si no hay conexión
+    """
+    connection = get_db_connection()
+    if not connection:
+        return None
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        applied = get_applied_migrations(cursor) or {}
+        status = []
+        for migration in MIGRATIONS:
+            if migration.version not in applied:
+                state = 'pendiente'
+            elif applied[migration.version] != migration.checksum:
+                state = 'modificada'
+            else:
+                state = 'aplicada'
+            status.append({'version': migration.version, 'name': migration.name, 'status': state})
+        return status
+    finally:
+        if cursor:
+            cursor.close()
+        connection.close()
+
+def ensure_schema():
+    """
+    Dejar el esquema al día al arrancar la aplicación.
+
+    Si todas las migraciones están registradas con su checksum actual solo se
+    ejecuta una consulta. Si falta alguna, se aplican las pendientes en orden
+    bajo un bloqueo de MySQL (GET_LOCK) para que varios workers que arrancan
+    a la vez no ejecuten el mismo DDL.
+
+    Returns:
+        True si el esquema quedó al día, False si ocurrió un error
+    """
+    connection = get_db_connection()
+    if connection:
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            # Camino rápido: una sola consulta cuando no hay nada pendiente
+            if not get_pending_migrations(get_applied_migrations(cursor)):
+                return True
+        except Exception as e:
+            logger.error("Error leyendo el registro de migraciones: %s", e)
+            return False
+        finally:
+            if cursor:
+                cursor.close()
+            connection.close()
+
+    if migrate() is None:
+        return False
+    logger.info("Esquema de la base de datos al día")
+    return True
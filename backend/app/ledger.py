@@ -0,0 +1,74 @@
+"""
+Revisar el libro de movimientos de insumos (insumo_movements) y sus puntos de control
+
+Uso (desde backend/app, con las migraciones aplicadas):
+    python ledger.py check                        Comparar el saldo del libro con la tabla de insumos
+    python ledger.py reconcile                    Anotar los ajustes que faltan para que cuadren
+    python ledger.py checkpoint                   Guardar el punto de control del intervalo actual si falta
+    python ledger.py checkpoint --at 2025-01-31   Guardar un punto de control en una fecha concreta
+    python ledger.py snapshot                     Guardar la instantánea diaria de hoy si falta
+    python ledger.py snapshot --day 2025-01-31    Guardar la instantánea comprimida de un día
+"""
+import argparse
+import sys
+from datetime import date, datetime
+
+from logging_config import setup_logging
+from database.db import close_pool
+from models.insumo_ledger import check_ledger, reconcile_ledger, write_checkpoint, write_daily_snapshot
+
+def main():
+    parser = argparse.ArgumentParser(description="Libro de movimientos de insumos")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('check', help="Comparar el libro con la tabla de insumos")
+    subparsers.add_parser('reconcile', help="Anotar los ajustes que faltan")
+    checkpoint = subparsers.add_parser('checkpoint', help="Guardar un punto de control")
+    checkpoint.add_argument('--at', type=datetime.fromisoformat, default=None,
+                            help="Fecha y hora del punto (ISO, p. ej. 2025-01-31 o 2025-01-31T12:00)")
+    snapshot = subparsers.add_parser('snapshot', help="Guardar una instantánea diaria comprimida")
+    snapshot.add_argument('--day', type=date.fromisoformat, default=None,
+                          help="Día de la instantánea (a las 00:00), p. ej. 2025-01-31")
+
+    args = parser.parse_args()
+    setup_logging()
+
+    try:
+        if args.command == 'check':
+            differences = check_ledger()
+            if differences is None:
+                print("No se pudo revisar el libro (¿migraciones aplicadas?)")
+                return 1
+            for difference in differences:
+                print(f"Insumo {difference['insumo_id']}: tabla {difference['table']:.4f}  "
+                      f"libro {difference['ledger']:.4f}"
+                      f"{'' if difference['has_movements'] else '  (sin movimientos)'}")
+            print(f"Insumos con diferencias: {len(differences)}")
+            return 1 if differences else 0
+
+        if args.command == 'reconcile':
+            recorded = reconcile_ledger()
+            if recorded is None:
+                print("No se pudo conciliar el libro (¿migraciones aplicadas?)")
+                return 1
+            print(f"Movimientos de ajuste anotados: {recorded}")
+            return 0
+
+        if args.command == 'snapshot':
+            saved = write_daily_snapshot(args.day)
+            if saved is None:
+                print("No se pudo guardar la instantánea (¿migraciones aplicadas?)")
+                return 1
+            print("Instantánea guardada" if saved else "La instantánea ya existía")
+            return 0
+
+        inserted = write_checkpoint(args.at)
+        if inserted is None:
+            print("No se pudo guardar el punto de control (¿migraciones aplicadas?)")
+            return 1
+        print(f"Insumos en el punto de control: {inserted}")
+        return 0
+    finally:
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+from database.instrumentation import get_current_request
+
+# Configuración del logging de la aplicación.
+#
+# Los módulos escriben con logger = logging.getLogger(__name__); aquí se decide
+# el nivel y el destino. Los registros se encolan (QueueHandler) y un hilo en
+# segundo plano (QueueListener) los escribe en stderr, de modo que un worker
+# nunca queda bloqueado esperando a stdout ni al recolector de logs.
+#
+# Variables de entorno:
+#   LOG_LEVEL        Nivel general (por defecto INFO)
+#   LOG_LEVELS       Niveles por módulo: "database.db=DEBUG,api.v1.services.purchase_service=WARNING"
+#   LOG_FORMAT       'text' o 'json' (una línea JSON por registro)
+#   LOG_QUEUE_SIZE   Registros en espera; si la cola se llena se descartan en lugar de bloquear
+
+_TEXT_FORMAT = "%(asctime)s %(levelname)-7s [%(request_id)s] %(name)s: %(message)s"
+
+_listener = None
+_queue_handler = None
+
+class RequestContextFilter(logging.Filter):
+    """Añade a cada registro el X-Request-ID de la petición en curso ('-' fuera de una petición)"""
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            request = get_current_request()
+            record.request_id = request.request_id if request else '-'
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro, para el recolector de logs"""
+
+    def format(self, record):
+        entry = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-')
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca bloquea: si la cola está llena el registro se
+    descarta y se cuenta en dropped
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _parse_levels(value):
+    """'database=DEBUG,models.sales_service=WARNING' -> {'database': 'DEBUG', ...}"""
+    levels = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        name, level = name.strip(), level.strip().upper()
+        if name and level:
+            levels[name] = level
+    return levels
+
+def setup_logging():
+    """
+    Configurar el logging de la aplicación a partir de las variables de entorno.
+
+    Se puede llamar más de una vez: solo la primera instala el handler.
+    """
+    global _listener, _queue_handler
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for name, level in _parse_levels(os.getenv('LOG_LEVELS')).items():
+        logging.getLogger(name).setLevel(level)
+
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(_TEXT_FORMAT))
+
+    log_queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    _queue_handler = DroppingQueueHandler(log_queue)
+    # El filtro se ejecuta en el hilo que registra, donde está el contexto de la petición
+    _queue_handler.addFilter(RequestContextFilter())
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """Escribir los registros pendientes y detener el hilo del logging"""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener = None
+    _queue_handler = None
+
+def get_logging_stats():
+    """Registros en cola y descartados por tener la cola llena"""
+    if _queue_handler is None:
+        return {'enabled': False, 'queued': 0, 'dropped': 0}
+    return {
+        'enabled': True,
+        'queued': _queue_handler.queue.qsize(),
+        'dropped': _queue_handler.dropped
+    }
@@ -1,6 +1,18 @@
-from fastapi import FastAPI
+import logging
+import uuid
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from database.db import create_tables
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+from database.db import close_pool
+from database.schema import ensure_schema
+from database.async_db import close_async_pool
+from database.instrumentation import start_request, end_request
+from models.consumption_queue import INSUMO_WRITE_BEHIND, consumption_worker
+from models.insumo_ledger import ledger_checkpointer
+from models.stock_stream import stock_broadcaster
+from starlette.concurrency import run_in_threadpool
+from logging_config import setup_logging, shutdown_logging
 from dotenv import load_dotenv
 # Incluir el router de estadísticas
 # Incluir rutas de gestión de usuarios y roles
@@ -15,10 +27,15 @@ from api.v1.services.products import router_products
 from api.v1.services.insumos import router_insumos
 from api.v1.services.recipes import router_recipes
 from api.v1.services.sales import router_sales
+from api.v1.services.purchase_service import PurchaseService
 
 # Cargar variables de entorno
 load_dotenv('.env.dev')
 
+# Logging con cola y niveles por módulo (LOG_LEVEL, LOG_LEVELS, LOG_FORMAT)
+setup_logging()
+logger = logging.getLogger(__name__)
+
 
 # Crear la aplicación FastAPI
 app = FastAPI(
@@ -34,16 +51,82 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-DB-Queries", "X-DB-Time-Ms"],
 )
 
 
+# Contar las consultas SQL de cada petición (ver /api/v1/services/monitoring/db/queries).
+# Es un middleware ASGI y no @app.middleware("http"): este lee los mensajes de la
+# petición mientras se envía la respuesta y se quedaría con el cuerpo que un
+# endpoint todavía está leyendo (POST /services/purchases/bulk con NDJSON).
+class TrackDBQueries:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request = Request(scope)
+        request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        
+        # Agrupar por la ruta declarada (/products/{product_id}) y no por la URL concreta
+        endpoint = request.url.path
+        for route in request.app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                endpoint = route.path
+                break
+        
+        stats, token = start_request(request_id, f"{request.method} {endpoint}")
+        
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-Request-ID"] = request_id
+                headers["X-DB-Queries"] = str(stats.queries)
+                headers["X-DB-Time-Ms"] = str(stats.db_time_ms)
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            end_request(token)
+
+app.add_middleware(TrackDBQueries)
+
 
 # Inicializar la base de datos al iniciar la aplicación
 @app.on_event("startup")
 async def startup_db_client():
-    # Crear las tablas si no existen
-    create_tables()
-    print("Base de datos inicializada correctamente")
+    # Aplicar el esquema solo si no está al día (una consulta cuando no hay cambios)
+    if ensure_schema():
+        logger.info("Base de datos inicializada correctamente")
+    
+    # Consumos de insumos pendientes: el hilo los aplica en modo diferido; sin él,
+    # se aplican aquí los que quedaron de una ejecución anterior en ese modo
+    if INSUMO_WRITE_BEHIND:
+        consumption_worker.start(PurchaseService.apply_pending_consumption)
+    else:
+        await run_in_threadpool(consumption_worker.drain, PurchaseService.apply_pending_consumption)
+    
+    # Puntos de control periódicos del libro de movimientos de insumos
+    ledger_checkpointer.start()
+    
+    # Cambios de stock para las terminales conectadas a /services/stock/stream
+    stock_broadcaster.start()
+
+
+# Liberar las conexiones de la base de datos al apagar la aplicación
+@app.on_event("shutdown")
+async def shutdown_db_client():
+    await run_in_threadpool(consumption_worker.stop)
+    await run_in_threadpool(ledger_checkpointer.stop)
+    await run_in_threadpool(stock_broadcaster.stop)
+    await close_async_pool()
+    close_pool()
+    shutdown_logging()
 
 
 
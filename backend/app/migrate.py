@@ -0,0 +1,56 @@
+"""
+Migraciones del esquema de la base de datos
+
+Uso (desde backend/app):
+    python migrate.py status                 Ver el estado de cada migración
+    python migrate.py up                     Aplicar las migraciones pendientes
+    python migrate.py up --explain           Aplicar y mostrar EXPLAIN antes/después
+    python migrate.py up --dry-run           Mostrar qué se ejecutaría y el EXPLAIN actual
+    python migrate.py up --target 3          Aplicar hasta la versión 3
+"""
+import argparse
+import sys
+
+from logging_config import setup_logging
+from database.db import close_pool
+from database.schema import migrate, get_migration_status
+
+def main():
+    parser = argparse.ArgumentParser(description="Migraciones del esquema de la base de datos")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('status', help="Ver el estado de cada migración")
+
+    up_parser = subparsers.add_parser('up', help="Aplicar las migraciones pendientes")
+    up_parser.add_argument('--dry-run', action='store_true', help="No cambiar nada, solo mostrar el plan")
+    up_parser.add_argument('--explain', action='store_true', help="Mostrar EXPLAIN antes y después de cada migración")
+    up_parser.add_argument('--target', type=int, default=None, help="Versión máxima a aplicar")
+
+    args = parser.parse_args()
+    setup_logging()
+
+    try:
+        if args.command == 'status':
+            status = get_migration_status()
+            if status is None:
+                print("No se pudo establecer conexión con la base de datos")
+                return 1
+            for item in status:
+                print(f"{item['version']:>4}  {item['status']:<10}  {item['name']}")
+            return 0
+
+        applied = migrate(dry_run=args.dry_run, explain=args.explain, target=args.target)
+        if applied is None:
+            return 1
+        if not applied:
+            print("No hay migraciones pendientes")
+        elif args.dry_run:
+            print(f"Se aplicarían {len(applied)} migraciones: {applied}")
+        else:
+            print(f"Migraciones aplicadas: {applied}")
+        return 0
+    finally:
+        close_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())
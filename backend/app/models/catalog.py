@@ -0,0 +1,227 @@
+from array import array
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+from database.db import execute_query
+from database.cache import VersionedCache
+
+# Producto activo del catálogo en memoria
+CatalogProduct = namedtuple('CatalogProduct', ['id', 'nombre_producto', 'variante', 'price', 'category_id', 'nombre_categoria', 'min_stock'])
+
+def load_product_index(include_inactive: bool = False):
+    """
+    Cargar los productos con una consulta e indexarlos para resolve_product_name
+
+    Args:
+        include_inactive: Incluir los productos desactivados (para resolver ventas
+            antiguas); ante nombres repetidos gana el producto activo
+
+    Returns:
+        Tupla (por id, por (nombre, variante), por nombre compuesto), o None si hubo un error
+    """
+    query = f"""
+    SELECT p.id, p.nombre_producto, p.variante, p.price, p.category_id, c.nombre_categoria, p.min_stock
+    FROM products p
+    LEFT JOIN categories c ON p.category_id = c.id
+    {'' if include_inactive else 'WHERE p.is_active = TRUE'}
+    ORDER BY p.is_active DESC, p.id
+    """
+    rows = execute_query(query, fetch_all=True, compact=True)
+    if rows is None:
+        return None
+
+    by_id = {}
+    by_name_variant = {}
+    by_composed_name = {}
+    for row in rows:
+        product = CatalogProduct._make(row)
+        by_id[product.id] = product
+        # Las comparaciones no distinguen mayúsculas, igual que la colación de
+        # la columna; ante duplicados gana el primero del ORDER BY (activo, id menor)
+        nombre = product.nombre_producto.casefold()
+        variante = product.variante
+        by_name_variant.setdefault((nombre, (variante or '').casefold()), product.id)
+        composed = nombre + (f" - {variante.casefold()}" if variante is not None else '')
+        by_composed_name.setdefault(composed, product.id)
+    return by_id, by_name_variant, by_composed_name
+
+def resolve_product_name(index, product_name: str, variant: Optional[str] = None) -> Optional[int]:
+    """
+    Id del producto de un índice de load_product_index que corresponde a una
+    línea de venta, o None
+
+    Aplica las mismas reglas que las búsquedas por nombre, en orden:
+    1. Nombre y variante exactos (sin variante: variante NULL o vacía)
+    2. Nombre "base - variante" separado por el primer " - "
+    3. Nombre compuesto CONCAT(nombre_producto, ' - ', variante) igual al nombre recibido
+    """
+    _, by_name_variant, by_composed_name = index
+    name = product_name.casefold()
+
+    # Método 1: Búsqueda exacta
+    product_id = by_name_variant.get((name, (variant or '').casefold()))
+
+    # Método 2: Separar por " - "
+    if product_id is None and ' - ' in name:
+        nombre_base, variante_base = name.split(' - ', 1)
+        product_id = by_name_variant.get((nombre_base.strip(), variante_base.strip()))
+
+    # Método 3: Nombre compuesto
+    if product_id is None:
+        product_id = by_composed_name.get(name)
+    return product_id
+
+class ProductCatalog(VersionedCache):
+    """
+    Índice en memoria de los productos activos.
+
+    Se carga con una sola consulta en el primer uso y se indexa por id, por
+    (nombre_producto, variante) y por el nombre compuesto "nombre - variante".
+    ProductService lo invalida al crear, actualizar o eliminar productos, y las
+    categorías al renombrarlas o eliminarlas.
+    """
+
+    def __init__(self):
+        super().__init__('products')
+
+    def _load(self):
+        return load_product_index()
+
+    def _size(self, payload):
+        return len(payload[0])
+
+    def get(self, product_id: int) -> Optional[CatalogProduct]:
+        """Producto activo por id, o None"""
+        payload = self._data()
+        if payload is None:
+            return None
+        product = payload[0].get(product_id)
+        if product is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return product
+
+    def products(self) -> Optional[List[CatalogProduct]]:
+        """Todos los productos activos, o None si el catálogo no se pudo cargar"""
+        payload = self._data()
+        if payload is None:
+            return None
+        return list(payload[0].values())
+
+    def resolve(self, product_name: str, variant: Optional[str] = None) -> Optional[int]:
+        """Id del producto activo que corresponde a una línea de venta, o None (ver resolve_product_name)"""
+        payload = self._data()
+        if payload is None:
+            return None
+        product_id = resolve_product_name(payload, product_name, variant)
+
+        if product_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return product_id
+
+    def resolve_many(self, products: List[Dict]) -> Optional[Dict[tuple, Optional[int]]]:
+        """
+        Resolver varias líneas (product_name, product_variant)
+
+        Returns:
+            Dict {(product_name, product_variant o None): product_id o None},
+            o None si el catálogo no se pudo cargar
+        """
+        if self._data() is None:
+            return None
+        resolved = {}
+        for product in products:
+            key = (product['product_name'], product.get('product_variant') or None)
+            if key not in resolved:
+                resolved[key] = self.resolve(*key)
+        return resolved
+
+class Recipe:
+    """
+    Receta (lista de materiales) de un producto como arreglos paralelos:
+    insumo_ids[i] se consume en quantities[i] por unidad vendida, con el
+    cantidad_por_producto del insumo ya aplicado sobre la cantidad de la receta
+    (recipe_quantities[i]).
+    """
+    __slots__ = ('insumo_ids', 'quantities', 'recipe_quantities')
+
+    def __init__(self):
+        self.insumo_ids = array('i')
+        self.quantities = array('d')
+        self.recipe_quantities = array('d')
+
+    def __len__(self):
+        return len(self.insumo_ids)
+
+    def consumption(self, units: float) -> Dict[int, float]:
+        """Consumo total por insumo para vender `units` unidades del producto"""
+        totals = {}
+        for insumo_id, quantity in zip(self.insumo_ids, self.quantities):
+            totals[insumo_id] = totals.get(insumo_id, 0.0) + quantity * units
+        return totals
+
+class RecipeCache(VersionedCache):
+    """
+    Recetas de todos los productos, cargadas con una sola consulta.
+
+    Se invalida al cambiar una receta (ProductService.add_product_recipe, los
+    routers de productos y recetas) y al cambiar el cantidad_por_producto de un
+    insumo (InsumoService.update_insumo).
+    """
+
+    def __init__(self):
+        super().__init__('recipes')
+
+    def _load(self):
+        query = """
+        SELECT pr.product_id, pr.insumo_id,
+               CASE WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto ELSE pr.cantidad END,
+               pr.cantidad
+        FROM product_recipes pr
+        JOIN insumos i ON pr.insumo_id = i.id
+        ORDER BY pr.product_id, pr.id
+        """
+        rows = execute_query(query, fetch_all=True, compact=True)
+        if rows is None:
+            return None
+
+        recipes = {}
+        for product_id, insumo_id, quantity, recipe_quantity in rows:
+            recipe = recipes.get(product_id)
+            if recipe is None:
+                recipe = recipes[product_id] = Recipe()
+            recipe.insumo_ids.append(insumo_id)
+            recipe.quantities.append(float(quantity))
+            recipe.recipe_quantities.append(float(recipe_quantity))
+        return recipes
+
+    def all(self) -> Optional[Dict[int, Recipe]]:
+        """
+        Recetas de todos los productos {product_id: Recipe}, o None si no se
+        pudieron cargar. Es el mismo objeto mientras la caché no se recargue
+        """
+        return self._data()
+
+    def get(self, product_id: int) -> Optional[Recipe]:
+        """
+        Receta de un producto, o None si no tiene receta
+
+        Raises:
+            Exception: si las recetas no se pudieron cargar
+        """
+        recipes = self._data()
+        if recipes is None:
+            raise Exception("No se pudieron cargar las recetas de los productos")
+        recipe = recipes.get(product_id)
+        if recipe is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return recipe
+
+# Instancias únicas del proceso
+product_catalog = ProductCatalog()
+recipe_cache = RecipeCache()
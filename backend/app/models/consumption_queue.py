@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+
+from database.db import execute_query
+
+# Descuento diferido (write-behind) de insumos.
+#
+# Con INSUMO_WRITE_BEHIND=true la venta no actualiza los insumos: registra la
+# compra, sus detalles y una fila por insumo en pending_insumo_consumption, todo
+# en la misma transacción. Un hilo del proceso (ConsumptionWorker) aplica las
+# filas pendientes por lotes: suma las de cada insumo, ejecuta un solo UPDATE y
+# elimina las filas aplicadas en la misma transacción. Si el proceso se detiene,
+# las filas siguen en la tabla y se aplican al arrancar.
+#
+# La validación de las ventas, product_availability (/stock, /stock/low,
+# /stock/summary y el stream de cambios) y el motor de stock (/stock/{id},
+# escenarios) descuentan lo pendiente, así que el retraso del hilo no permite
+# vender más insumo del que hay y todas las consultas de unidades coinciden.
+# Solo las cantidades de los insumos (cantidad_utilizada en /insumos) van hasta
+# INSUMO_WRITE_BEHIND_INTERVAL_MS atrasadas.
+
+INSUMO_WRITE_BEHIND = os.getenv('INSUMO_WRITE_BEHIND', 'false').lower() == 'true'
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv('INSUMO_WRITE_BEHIND_INTERVAL_MS', 200))  # retraso máximo entre lotes
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('INSUMO_WRITE_BEHIND_BATCH_SIZE', 1000))  # filas pendientes por transacción
+
+PENDING_CONSUMPTION_TABLE = """
+CREATE TABLE IF NOT EXISTS pending_insumo_consumption (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    purchase_id INT NOT NULL,
+    insumo_id INT NOT NULL,
+    quantity DECIMAL(12, 4) NOT NULL,
+    created_at TIMESTAMP(3) DEFAULT CURRENT_TIMESTAMP(3),
+    INDEX idx_pending_consumption_insumo (insumo_id, quantity),
+    INDEX idx_pending_consumption_purchase (purchase_id)
+)
+"""
+
+logger = logging.getLogger(__name__)
+
+class ConsumptionWorker:
+    """
+    Hilo que aplica los consumos pendientes cada WRITE_BEHIND_INTERVAL_MS
+
+    apply_batch(batch_size) aplica como mucho batch_size filas en una
+    transacción y devuelve (filas aplicadas, insumos actualizados).
+    """
+
+    def __init__(self, interval_ms=None, batch_size=None):
+        self.interval = (interval_ms or WRITE_BEHIND_INTERVAL_MS) / 1000
+        self.batch_size = batch_size or WRITE_BEHIND_BATCH_SIZE
+        self._apply_batch = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.batches = 0
+        self.rows_applied = 0
+        self.insumo_updates = 0
+        self.errors = 0
+        self.last_run_at = None
+        self.last_batch_ms = 0.0
+
+    def start(self, apply_batch):
+        """Arrancar el hilo (no hace nada si ya está en marcha)"""
+        if self._thread is not None:
+            return
+        self._apply_batch = apply_batch
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='consumption-worker', daemon=True)
+        self._thread.start()
+        logger.info("Descuento diferido de insumos activo (cada %s ms, lotes de %s)",
+                    int(self.interval * 1000), self.batch_size)
+
+    def stop(self, timeout=10):
+        """Detener el hilo tras aplicar lo pendiente"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def wake(self):
+        """Aplicar lo pendiente sin esperar al siguiente intervalo"""
+        self._wake.set()
+
+    def drain(self, apply_batch=None):
+        """
+        Aplicar todas las filas pendientes en lotes
+
+        Returns:
+            Filas aplicadas, o None si ocurrió un error
+        """
+        apply_batch = apply_batch or self._apply_batch
+        total = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                applied, updated = apply_batch(self.batch_size)
+            except Exception as e:
+                self.errors += 1
+                logger.error("Error aplicando consumos pendientes de insumos: %s", e)
+                return None
+            self.last_run_at = time.time()
+            if not applied:
+                return total
+            self.batches += 1
+            self.rows_applied += applied
+            self.insumo_updates += updated
+            self.last_batch_ms = (time.perf_counter() - started) * 1000
+            total += applied
+            if applied < self.batch_size:
+                return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.drain()
+        # Último lote al apagar: lo que quede se aplica al volver a arrancar
+        self.drain()
+
+    def stats(self):
+        """Contadores del hilo"""
+        return {
+            'enabled': INSUMO_WRITE_BEHIND,
+            'running': self._thread is not None and self._thread.is_alive(),
+            'interval_ms': int(self.interval * 1000),
+            'batch_size': self.batch_size,
+            'batches': self.batches,
+            'rows_applied': self.rows_applied,
+            'insumo_updates': self.insumo_updates,
+            'errors': self.errors,
+            'last_batch_ms': round(self.last_batch_ms, 2),
+            'last_run_at': self.last_run_at
+        }
+
+def get_pending_consumption_stats():
+    """
+    Profundidad de la cola: filas e insumos pendientes y antigüedad de la fila más antigua
+
+    Returns:
+        Dict, o None si hubo un error
+    """
+    row = execute_query(
+        """
+        SELECT COUNT(*), COUNT(DISTINCT insumo_id),
+               TIMESTAMPDIFF(MICROSECOND, MIN(created_at), NOW(3)) / 1000
+        FROM pending_insumo_consumption
+        """,
+        fetch_one=True, compact=True
+    )
+    if row is None:
+        return None
+    pending_rows, pending_insumos, oldest_ms = row
+    return {
+        'pending_rows': pending_rows,
+        'pending_insumos': pending_insumos,
+        'oldest_pending_ms': float(oldest_ms) if oldest_ms is not None else 0.0
+    }
+
+# Instancia única del proceso
+consumption_worker = ConsumptionWorker()
@@ -0,0 +1,634 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import date, datetime, time as dt_time, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from database.db import bulk_insert, execute_many, execute_query
+
+# Libro de movimientos de insumos (solo inserciones).
+#
+# Cada cambio de la cantidad disponible de un insumo (cantidad_unitaria -
+# cantidad_utilizada) deja una fila en insumo_movements con el cambio con signo:
+# - sale:         consumo de una venta (negativo)
+# - cancellation: consumo devuelto al cancelar una venta (positivo)
+# - restock:      aumento de cantidad_unitaria (reposición)
+# - adjustment:   cualquier otro cambio manual (o una conciliación con `ledger.py reconcile`)
+# - opening:      saldo inicial (insumos existentes al crear el libro o insumos nuevos)
+#
+# Las ventas y cancelaciones escriben sus filas en la misma transacción, con un
+# INSERT de varios VALUES por lote. Con INSUMO_WRITE_BEHIND el consumo se anota
+# al vender (no cuando el hilo lo aplica), así que el libro no depende del
+# retraso de la cola.
+#
+# insumo_balance_checkpoints guarda cada INSUMO_CHECKPOINT_INTERVAL_MINUTES el
+# saldo y el consumo acumulado de cada insumo, calculados con el punto anterior
+# más los movimientos desde entonces. "Saldo a la fecha T" es el último punto
+# anterior a T más un rango de movimientos (como mucho un intervalo), y "consumo
+# entre A y B" es la diferencia de dos de esas lecturas. Los puntos se toman
+# INSUMO_CHECKPOINT_LAG_SECONDS atrás para que no queden fuera transacciones que
+# todavía no han hecho commit.
+#
+# Además se guarda cada día, a las 00:00, una instantánea comprimida (JSON con
+# zlib) de todos los insumos en insumo_daily_snapshots. Los puntos de control de
+# más de INSUMO_CHECKPOINT_RETENTION_DAYS días se borran; una lectura de esas
+# fechas parte de la instantánea del día y suma como mucho un día de movimientos.
+#
+# `python ledger.py check` compara el libro con la tabla de insumos (p. ej. si
+# una cancelación no pudo devolver todo porque cantidad_utilizada llegaría a
+# ser negativa) y `python ledger.py reconcile` anota los ajustes que falten.
+
+CHECKPOINT_INTERVAL_MINUTES = int(os.getenv('INSUMO_CHECKPOINT_INTERVAL_MINUTES', 60))  # entre puntos de control
+CHECKPOINT_LAG_SECONDS = int(os.getenv('INSUMO_CHECKPOINT_LAG_SECONDS', 300))  # margen para transacciones en curso
+CHECKPOINT_RETENTION_DAYS = int(os.getenv('INSUMO_CHECKPOINT_RETENTION_DAYS', 7))  # después solo quedan las instantáneas diarias
+PRUNE_BATCH_SIZE = 10000  # puntos de control borrados por pasada del hilo
+
+MOVEMENT_SALE = 'sale'
+MOVEMENT_CANCELLATION = 'cancellation'
+MOVEMENT_RESTOCK = 'restock'
+MOVEMENT_ADJUSTMENT = 'adjustment'
+MOVEMENT_OPENING = 'opening'
+
+# Puntos de partida de una lectura del libro
+BASE_CHECKPOINT = 'checkpoint'
+BASE_DAILY_SNAPSHOT = 'daily_snapshot'
+
+# Diferencia tolerada entre el libro y la tabla: los insumos guardan 2 decimales
+# y cada UPDATE redondea, el libro guarda 4
+LEDGER_TOLERANCE = 0.01
+
+INSUMO_MOVEMENTS_TABLE = """
+CREATE TABLE IF NOT EXISTS insumo_movements (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    insumo_id INT NOT NULL,
+    movement_type VARCHAR(20) NOT NULL,
+    quantity DECIMAL(14, 4) NOT NULL,
+    purchase_id INT NULL,
+    created_at TIMESTAMP(3) DEFAULT CURRENT_TIMESTAMP(3),
+    INDEX idx_insumo_movements_created (created_at, insumo_id),
+    INDEX idx_insumo_movements_insumo (insumo_id, created_at)
+)
+"""
+
+INSUMO_CHECKPOINTS_TABLE = """
+CREATE TABLE IF NOT EXISTS insumo_balance_checkpoints (
+    checkpoint_at TIMESTAMP(3) NOT NULL,
+    insumo_id INT NOT NULL,
+    balance DECIMAL(16, 4) NOT NULL,
+    consumed DECIMAL(16, 4) NOT NULL,
+    PRIMARY KEY (checkpoint_at, insumo_id)
+)
+"""
+
+INSUMO_DAILY_SNAPSHOTS_TABLE = """
+CREATE TABLE IF NOT EXISTS insumo_daily_snapshots (
+    snapshot_at TIMESTAMP(3) NOT NULL PRIMARY KEY,
+    insumos INT NOT NULL,
+    payload MEDIUMBLOB NOT NULL,
+    created_at TIMESTAMP(3) DEFAULT CURRENT_TIMESTAMP(3)
+)
+"""
+
+_MOVEMENT_COLUMNS = ['insumo_id', 'movement_type', 'quantity', 'purchase_id']
+
+logger = logging.getLogger(__name__)
+
+def record_movements(rows: Iterable[tuple], cursor=None) -> Optional[List[int]]:
+    """
+    Anotar movimientos en el libro con un INSERT de varios VALUES
+
+    Args:
+        rows: Tuplas (insumo_id, movement_type, cantidad con signo, purchase_id o None);
+              las de cantidad 0 se omiten
+        cursor: Cursor de la transacción que cambió los insumos
+
+    Returns:
+        IDs insertados, o None si hubo un error sin cursor
+    """
+    return bulk_insert(
+        'insumo_movements', _MOVEMENT_COLUMNS,
+        [row for row in rows if row[2]],
+        cursor=cursor
+    )
+
+def consumption_movements(movement_type: str, consumptions: List[tuple]) -> List[tuple]:
+    """
+    Filas del libro para el consumo de una o varias compras
+
+    Args:
+        movement_type: MOVEMENT_SALE (descuenta) o MOVEMENT_CANCELLATION (devuelve)
+        consumptions: Lista de (purchase_id, {insumo_id: cantidad})
+    """
+    sign = -1 if movement_type == MOVEMENT_SALE else 1
+    return [
+        (insumo_id, movement_type, sign * quantity, purchase_id)
+        for purchase_id, consumption in consumptions
+        for insumo_id, quantity in sorted(consumption.items())
+    ]
+
+def insumo_update_movements(insumo_id: int, before: Dict, update_data: Dict) -> List[tuple]:
+    """
+    Filas del libro para un cambio manual de cantidades de un insumo
+
+    Subir cantidad_unitaria es una reposición; bajarla o cambiar
+    cantidad_utilizada es un ajuste.
+
+    Args:
+        insumo_id: ID del insumo
+        before: Fila con cantidad_unitaria y cantidad_utilizada antes del cambio
+        update_data: Campos actualizados
+    """
+    rows = []
+    if update_data.get('cantidad_unitaria') is not None:
+        delta = float(update_data['cantidad_unitaria']) - float(before['cantidad_unitaria'])
+        rows.append((insumo_id, MOVEMENT_RESTOCK if delta > 0 else MOVEMENT_ADJUSTMENT, delta, None))
+    if update_data.get('cantidad_utilizada') is not None:
+        delta = float(update_data['cantidad_utilizada']) - float(before['cantidad_utilizada'])
+        rows.append((insumo_id, MOVEMENT_ADJUSTMENT, -delta, None))
+    return rows
+
+def _db_now() -> datetime:
+    """Hora actual del servidor MySQL (la de created_at de los movimientos)"""
+    row = execute_query("SELECT NOW(3)", fetch_one=True, compact=True)
+    if row is None:
+        raise Exception("No se pudo leer la hora de la base de datos")
+    return row[0]
+
+# True una vez que existe insumo_daily_snapshots (se crea en la migración 13)
+_daily_snapshots_ready = False
+
+def _has_daily_snapshots() -> bool:
+    """
+    Si existe la tabla de instantáneas diarias
+
+    El saldo inicial del libro se anota al aplicar la migración 12, antes de que
+    la 13 cree insumo_daily_snapshots; mientras no exista, la lectura parte solo
+    de los puntos de control.
+    """
+    global _daily_snapshots_ready
+    if not _daily_snapshots_ready:
+        row = execute_query(
+            """
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = 'insumo_daily_snapshots'
+            """,
+            fetch_one=True, compact=True
+        )
+        if row is None:
+            raise Exception("No se pudo comprobar la tabla de instantáneas diarias")
+        _daily_snapshots_ready = row[0] > 0
+    return _daily_snapshots_ready
+
+def _ledger_base(moment: Optional[datetime]) -> tuple:
+    """
+    Punto de partida más reciente anterior o igual a moment (el último si es None):
+    el último punto de control o la última instantánea diaria
+
+    Returns:
+        Tupla (BASE_CHECKPOINT | BASE_DAILY_SNAPSHOT | None, fecha o None)
+    """
+    checkpoint_where = snapshot_where = ""
+    if moment is not None:
+        checkpoint_where = "WHERE checkpoint_at <= %s"
+        snapshot_where = "WHERE snapshot_at <= %s"
+    snapshot_select = "NULL"
+    if _has_daily_snapshots():
+        snapshot_select = f"(SELECT MAX(snapshot_at) FROM insumo_daily_snapshots {snapshot_where})"
+    params = [moment] * (checkpoint_where + snapshot_select).count('%s')
+    row = execute_query(
+        f"""
+        SELECT (SELECT MAX(checkpoint_at) FROM insumo_balance_checkpoints {checkpoint_where}),
+               {snapshot_select}
+        """,
+        params, fetch_one=True, compact=True
+    )
+    if row is None:
+        raise Exception("No se pudieron leer los puntos de control de insumos")
+    checkpoint_at, snapshot_at = row
+    if snapshot_at is not None and (checkpoint_at is None or snapshot_at > checkpoint_at):
+        return BASE_DAILY_SNAPSHOT, snapshot_at
+    if checkpoint_at is not None:
+        return BASE_CHECKPOINT, checkpoint_at
+    return None, None
+
+def ledger_start() -> Optional[datetime]:
+    """
+    Fecha del primer movimiento del libro (los saldos iniciales anotados al
+    crearlo), o None si el libro está vacío
+
+    Antes de esa fecha el libro no tiene datos: una lectura daría 0 para todos
+    los insumos.
+    """
+    row = execute_query("SELECT MIN(created_at) FROM insumo_movements", fetch_one=True, compact=True)
+    if row is None:
+        raise Exception("No se pudo leer el primer movimiento de insumos")
+    return row[0]
+
+def _movements_select(since: Optional[datetime], until: Optional[datetime]):
+    """Consulta (insumo_id, saldo, consumo, movimientos) de los movimientos de [since, until)"""
+    conditions = []
+    params = []
+    if since is not None:
+        conditions.append("created_at >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("created_at < %s")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+    SELECT insumo_id, SUM(quantity),
+           -SUM(CASE WHEN movement_type IN ('{MOVEMENT_SALE}', '{MOVEMENT_CANCELLATION}')
+                     THEN quantity ELSE 0 END),
+           COUNT(*)
+    FROM insumo_movements
+    {where}
+    GROUP BY insumo_id
+    """
+    return query, params
+
+def _encode_totals(totals: Dict[int, tuple]) -> bytes:
+    """Instantánea comprimida: JSON [[insumo_id, saldo, consumo], ...] con zlib"""
+    rows = [[insumo_id, round(balance, 4), round(consumed, 4)] for insumo_id, (balance, consumed) in sorted(totals.items())]
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'))
+
+def _decode_totals(payload: bytes) -> List[list]:
+    """Filas [insumo_id, saldo, consumo] de una instantánea comprimida"""
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+def ledger_state(moment: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    Saldo y consumo acumulado de cada insumo según el libro
+
+    Parte del punto de control o de la instantánea diaria más reciente anterior
+    a moment y suma los movimientos desde entonces (un rango de created_at).
+
+    Args:
+        moment: Fecha y hora (movimientos anteriores a ella); None para el estado actual
+
+    Returns:
+        Dict con totals ({insumo_id: (saldo, consumo acumulado)}), base (tipo y
+        fecha del punto de partida) y replayed (movimientos sumados), o None si
+        hubo un error
+    """
+    try:
+        base_type, base_at = _ledger_base(moment)
+        if base_type == BASE_CHECKPOINT:
+            rows = execute_query(
+                "SELECT insumo_id, balance, consumed FROM insumo_balance_checkpoints WHERE checkpoint_at = %s",
+                (base_at,), fetch_all=True, compact=True
+            )
+        elif base_type == BASE_DAILY_SNAPSHOT:
+            row = execute_query(
+                "SELECT payload FROM insumo_daily_snapshots WHERE snapshot_at = %s",
+                (base_at,), fetch_one=True, compact=True
+            )
+            rows = _decode_totals(row[0]) if row is not None else None
+        else:
+            rows = []
+        if rows is None:
+            raise Exception(f"No se pudo leer el punto de partida {base_at}")
+        totals = {insumo_id: [float(balance), float(consumed)] for insumo_id, balance, consumed in rows}
+
+        query, params = _movements_select(base_at, moment)
+        movements = execute_query(query, params, fetch_all=True, compact=True)
+        if movements is None:
+            raise Exception("No se pudieron leer los movimientos de insumos")
+        replayed = 0
+        for insumo_id, balance, consumed, count in movements:
+            current = totals.setdefault(insumo_id, [0.0, 0.0])
+            current[0] += float(balance)
+            current[1] += float(consumed)
+            replayed += count
+    except Exception as e:
+        logger.error("Error reconstruyendo el libro de insumos: %s", e)
+        return None
+    return {
+        'totals': {insumo_id: tuple(values) for insumo_id, values in totals.items()},
+        'base': {'type': base_type, 'at': base_at},
+        'replayed': replayed
+    }
+
+def ledger_totals(moment: Optional[datetime] = None) -> Optional[Dict[int, tuple]]:
+    """
+    Saldo y consumo acumulado de cada insumo según el libro (ver ledger_state)
+
+    Returns:
+        Dict {insumo_id: (saldo, consumo acumulado)}, o None si hubo un error
+    """
+    state = ledger_state(moment)
+    return state['totals'] if state is not None else None
+
+def consumption_between(start: datetime, end: datetime) -> Optional[Dict[int, float]]:
+    """
+    Consumo neto de cada insumo (ventas menos cancelaciones) en [start, end)
+
+    Returns:
+        Dict {insumo_id: cantidad consumida} (solo insumos con consumo), o None si hubo un error
+    """
+    before = ledger_totals(start)
+    after = ledger_totals(end)
+    if before is None or after is None:
+        return None
+    consumption = {}
+    for insumo_id, (_, consumed) in after.items():
+        quantity = consumed - before.get(insumo_id, (0.0, 0.0))[1]
+        if abs(quantity) > 1e-9:
+            consumption[insumo_id] = quantity
+    return consumption
+
+def _checkpoint_cutoff(now: datetime, interval_minutes: int, lag_seconds: int) -> datetime:
+    """Último múltiplo del intervalo (contado desde medianoche) anterior a now - lag"""
+    cutoff = (now - timedelta(seconds=lag_seconds)).replace(second=0, microsecond=0)
+    minutes = cutoff.hour * 60 + cutoff.minute
+    return cutoff - timedelta(minutes=minutes % interval_minutes)
+
+def write_checkpoint(cutoff: Optional[datetime] = None) -> Optional[int]:
+    """
+    Guardar el punto de control de todos los insumos en cutoff
+
+    El punto se calcula con el anterior más los movimientos desde entonces. Es
+    idempotente (varios procesos pueden intentarlo a la vez: INSERT IGNORE sobre
+    la clave checkpoint_at + insumo_id).
+
+    Args:
+        cutoff: Fecha del punto; por defecto el último múltiplo del intervalo
+                anterior a NOW() - INSUMO_CHECKPOINT_LAG_SECONDS (hora del servidor MySQL)
+
+    Returns:
+        Filas insertadas (0 si el punto ya existía), o None si hubo un error
+    """
+    try:
+        if cutoff is None:
+            cutoff = _checkpoint_cutoff(_db_now(), CHECKPOINT_INTERVAL_MINUTES, CHECKPOINT_LAG_SECONDS)
+        row = execute_query(
+            "SELECT COUNT(*) FROM insumo_balance_checkpoints WHERE checkpoint_at = %s",
+            (cutoff,), fetch_one=True, compact=True
+        )
+        if row is None:
+            raise Exception("No se pudieron leer los puntos de control de insumos")
+        if row[0]:
+            return 0
+        state = ledger_state(cutoff)
+        if state is None:
+            raise Exception("No se pudo reconstruir el libro")
+        inserted = execute_many(
+            "INSERT IGNORE INTO insumo_balance_checkpoints (checkpoint_at, insumo_id, balance, consumed) "
+            "VALUES (%s, %s, %s, %s)",
+            [(cutoff, insumo_id, balance, consumed) for insumo_id, (balance, consumed) in sorted(state['totals'].items())]
+        )
+        if inserted is None:
+            raise Exception("No se pudieron guardar las filas del punto de control")
+    except Exception as e:
+        logger.error("Error guardando el punto de control de insumos: %s", e)
+        return None
+    if inserted:
+        logger.info("Punto de control de insumos %s: %s insumos", cutoff, inserted)
+    return inserted
+
+def write_daily_snapshot(day: Optional[date] = None) -> Optional[int]:
+    """
+    Guardar la instantánea comprimida de todos los insumos al comienzo de day
+
+    Args:
+        day: Día de la instantánea (a las 00:00); por defecto el de NOW() -
+             INSUMO_CHECKPOINT_LAG_SECONDS (hora del servidor MySQL)
+
+    Returns:
+        1 si se guardó, 0 si ya existía, o None si hubo un error
+    """
+    try:
+        if day is None:
+            day = (_db_now() - timedelta(seconds=CHECKPOINT_LAG_SECONDS)).date()
+        snapshot_at = datetime.combine(day, dt_time.min)
+        row = execute_query(
+            "SELECT COUNT(*) FROM insumo_daily_snapshots WHERE snapshot_at = %s",
+            (snapshot_at,), fetch_one=True, compact=True
+        )
+        if row is None:
+            raise Exception("No se pudieron leer las instantáneas diarias")
+        if row[0]:
+            return 0
+        state = ledger_state(snapshot_at)
+        if state is None:
+            raise Exception("No se pudo reconstruir el libro")
+        inserted = execute_query(
+            "INSERT IGNORE INTO insumo_daily_snapshots (snapshot_at, insumos, payload) VALUES (%s, %s, %s)",
+            (snapshot_at, len(state['totals']), _encode_totals(state['totals']))
+        )
+        if inserted is None:
+            raise Exception("No se pudo guardar la instantánea")
+    except Exception as e:
+        logger.error("Error guardando la instantánea diaria de insumos: %s", e)
+        return None
+    if inserted:
+        logger.info("Instantánea diaria de insumos %s: %s insumos", snapshot_at, len(state['totals']))
+    return inserted
+
+def prune_checkpoints() -> Optional[int]:
+    """
+    Borrar los puntos de control de más de INSUMO_CHECKPOINT_RETENTION_DAYS días
+    ya cubiertos por una instantánea diaria (en lotes de PRUNE_BATCH_SIZE filas)
+
+    Las lecturas de esas fechas parten de la instantánea del día y suman como
+    mucho un día de movimientos.
+
+    Returns:
+        Filas borradas, o None si hubo un error
+    """
+    try:
+        keep_after = _db_now() - timedelta(days=CHECKPOINT_RETENTION_DAYS)
+        deleted = execute_query(
+            """
+            DELETE FROM insumo_balance_checkpoints
+            WHERE checkpoint_at < %s
+            AND checkpoint_at < (SELECT MAX(snapshot_at) FROM insumo_daily_snapshots)
+            LIMIT %s
+            """,
+            (keep_after, PRUNE_BATCH_SIZE)
+        )
+        if deleted is None:
+            raise Exception("No se pudieron borrar los puntos de control antiguos")
+    except Exception as e:
+        logger.error("Error borrando puntos de control de insumos: %s", e)
+        return None
+    if deleted:
+        logger.info("Puntos de control de insumos borrados: %s filas", deleted)
+    return deleted
+
+_TABLE_BALANCES = """
+SELECT i.id, i.cantidad_unitaria - i.cantidad_utilizada - COALESCE(p.pendiente, 0)
+FROM insumos i
+LEFT JOIN (
+    SELECT insumo_id, SUM(quantity) AS pendiente
+    FROM pending_insumo_consumption
+    GROUP BY insumo_id
+) p ON p.insumo_id = i.id
+"""
+
+def check_ledger() -> Optional[List[Dict]]:
+    """
+    Comparar el saldo del libro con la tabla de insumos sin modificar nada
+
+    El consumo todavía pendiente (modo diferido) ya está en el libro, así que se
+    descuenta de la tabla antes de comparar.
+
+    Returns:
+        Lista de insumos cuyo saldo difiere más de LEDGER_TOLERANCE (con ambos
+        saldos y si tienen movimientos), o None si hubo un error
+    """
+    totals = ledger_totals()
+    rows = execute_query(_TABLE_BALANCES, fetch_all=True, compact=True)
+    if totals is None or rows is None:
+        return None
+
+    differences = []
+    for insumo_id, balance in rows:
+        balance = float(balance)
+        ledger = totals.get(insumo_id)
+        ledger_balance = ledger[0] if ledger else 0.0
+        if ledger is None or abs(balance - ledger_balance) > LEDGER_TOLERANCE:
+            differences.append({
+                'insumo_id': insumo_id,
+                'table': balance,
+                'ledger': ledger_balance,
+                'has_movements': ledger is not None
+            })
+    return differences
+
+def reconcile_ledger() -> Optional[int]:
+    """
+    Anotar los movimientos que faltan para que el libro cuadre con la tabla
+
+    Los insumos sin movimientos reciben su saldo inicial (opening) y el resto un
+    ajuste por la diferencia.
+
+    Returns:
+        Movimientos anotados, o None si hubo un error
+    """
+    differences = check_ledger()
+    if differences is None:
+        return None
+    rows = [
+        (
+            difference['insumo_id'],
+            MOVEMENT_ADJUSTMENT if difference['has_movements'] else MOVEMENT_OPENING,
+            difference['table'] - difference['ledger'],
+            None
+        )
+        for difference in differences
+    ]
+    inserted = record_movements(rows)
+    if inserted is None:
+        return None
+    logger.info("Libro de insumos conciliado: %s movimientos", len(inserted))
+    return len(inserted)
+
+def get_ledger_stats() -> Optional[Dict]:
+    """
+    Tamaño del libro: movimientos, el más reciente, el último punto de control,
+    los movimientos que se suman desde él y las instantáneas diarias
+
+    Returns:
+        Dict, o None si hubo un error
+    """
+    row = execute_query(
+        """
+        SELECT (SELECT COUNT(*) FROM insumo_movements),
+               (SELECT MAX(created_at) FROM insumo_movements),
+               c.checkpoint_at,
+               (SELECT COUNT(*) FROM insumo_movements
+                WHERE c.checkpoint_at IS NULL OR created_at >= c.checkpoint_at),
+               (SELECT COUNT(*) FROM insumo_daily_snapshots),
+               (SELECT MAX(snapshot_at) FROM insumo_daily_snapshots),
+               (SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM insumo_daily_snapshots)
+        FROM (SELECT MAX(checkpoint_at) AS checkpoint_at FROM insumo_balance_checkpoints) c
+        """,
+        fetch_one=True, compact=True
+    )
+    if row is None:
+        return None
+    movements, last_movement_at, checkpoint_at, since_checkpoint, snapshots, last_snapshot_at, snapshot_bytes = row
+    return {
+        'movements': movements,
+        'last_movement_at': last_movement_at,
+        'last_checkpoint_at': checkpoint_at,
+        'movements_since_checkpoint': since_checkpoint,
+        'daily_snapshots': snapshots,
+        'last_daily_snapshot_at': last_snapshot_at,
+        'daily_snapshot_bytes': int(snapshot_bytes)
+    }
+
+class LedgerCheckpointer:
+    """
+    Hilo que guarda el punto de control de insumos de cada intervalo y la
+    instantánea diaria, y borra los puntos de control antiguos
+
+    Revisa como mucho cada minuto si falta el punto del intervalo actual o la
+    instantánea del día; write_checkpoint y write_daily_snapshot no hacen nada
+    si ya existen.
+    """
+
+    def __init__(self, interval_minutes=None):
+        self.interval_minutes = interval_minutes or CHECKPOINT_INTERVAL_MINUTES
+        self._thread = None
+        self._stop = threading.Event()
+        self.checkpoints = 0
+        self.daily_snapshots = 0
+        self.pruned = 0
+        self.errors = 0
+        self.last_run_at = None
+
+    def start(self):
+        """Arrancar el hilo (no hace nada si ya está en marcha)"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ledger-checkpointer', daemon=True)
+        self._thread.start()
+        logger.info("Puntos de control de insumos cada %s minutos", self.interval_minutes)
+
+    def stop(self, timeout=10):
+        """Detener el hilo"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def run_once(self):
+        """Guardar el punto del intervalo actual y la instantánea del día si faltan"""
+        inserted = write_checkpoint()
+        snapshot = write_daily_snapshot()
+        deleted = prune_checkpoints()
+        self.last_run_at = time.time()
+        self.errors += sum(1 for result in (inserted, snapshot, deleted) if result is None)
+        if inserted:
+            self.checkpoints += 1
+        if snapshot:
+            self.daily_snapshots += 1
+        self.pruned += deleted or 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(min(60, self.interval_minutes * 60))
+
+    def stats(self):
+        """Contadores del hilo"""
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'interval_minutes': self.interval_minutes,
+            'lag_seconds': CHECKPOINT_LAG_SECONDS,
+            'retention_days': CHECKPOINT_RETENTION_DAYS,
+            'checkpoints': self.checkpoints,
+            'daily_snapshots': self.daily_snapshots,
+            'pruned': self.pruned,
+            'errors': self.errors,
+            'last_run_at': self.last_run_at
+        }
+
+# Instancia única del proceso
+ledger_checkpointer = LedgerCheckpointer()
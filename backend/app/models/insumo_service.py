@@ -1,4 +1,8 @@
-from database.db import execute_query
+from database.db import execute_query, execute_insert_and_get_id, transaction
+from database import async_db
+from models.catalog import recipe_cache
+from models.insumo_ledger import MOVEMENT_OPENING, MOVEMENT_SALE, insumo_update_movements, record_movements
+from models.product_availability import refresh_product_availability
 from typing import List, Optional, Dict, Any
 import logging
 
@@ -29,16 +33,17 @@ class InsumoService:
         
         try:
             print(f"Intentando crear insumo: {nombre_insumo}, {unidad}, {cantidad_unitaria}, {precio_presentacion}, {cantidad_utilizada}, {cantidad_por_producto}, {stock_minimo}, {sitio_referencia}")
-            result = execute_query(query, (nombre_insumo, unidad, cantidad_unitaria, precio_presentacion,
-                                         cantidad_utilizada, cantidad_por_producto, stock_minimo, sitio_referencia))
-            print(f"Resultado de execute_query: {result}")
+            # LAST_INSERT_ID() solo es válido en la misma conexión que hizo el INSERT
+            with transaction():
+                insumo_id = execute_insert_and_get_id(query, (nombre_insumo, unidad, cantidad_unitaria, precio_presentacion,
+                                                             cantidad_utilizada, cantidad_por_producto, stock_minimo, sitio_referencia))
+                # Saldo inicial en el libro de movimientos
+                if insumo_id is not None and record_movements(
+                    [(insumo_id, MOVEMENT_OPENING, float(cantidad_unitaria) - float(cantidad_utilizada), None)]
+                ) is None:
+                    raise Exception(f"No se pudo anotar el saldo inicial del insumo {insumo_id}")
             
-            if result is not None:
-                # Obtener el ID del insumo recién creado
-                id_query = "SELECT LAST_INSERT_ID() as id"
-                id_result = execute_query(id_query, fetch_one=True)
-                print(f"ID result: {id_result}")
-                insumo_id = id_result['id'] if id_result else None
+            if insumo_id is not None:
                 print(f"Insumo creado con ID: {insumo_id}")
                 return insumo_id
             
@@ -57,9 +62,28 @@ class InsumoService:
         
         return execute_query(query, (insumo_id,), fetch_one=True)
     
+    @staticmethod
+    async def get_insumo_by_id_async(insumo_id: int) -> Optional[dict]:
+        """Obtener un insumo por su ID sin bloquear el event loop"""
+        query = "SELECT * FROM insumos WHERE id = %s"
+        
+        return await async_db.fetch_one(query, (insumo_id,))
+    
     @staticmethod
     def get_insumos(search: Optional[str] = None, low_stock_only: bool = False) -> List[dict]:
         """Obtener lista de insumos con filtros"""
+        query, params = InsumoService._build_insumos_query(search, low_stock_only)
+        return execute_query(query, params, fetch_all=True) or []
+    
+    @staticmethod
+    async def get_insumos_async(search: Optional[str] = None, low_stock_only: bool = False) -> List[dict]:
+        """Obtener lista de insumos con filtros sin bloquear el event loop"""
+        query, params = InsumoService._build_insumos_query(search, low_stock_only)
+        return await async_db.fetch_all(query, params)
+    
+    @staticmethod
+    def _build_insumos_query(search: Optional[str], low_stock_only: bool):
+        """Construir la consulta de listado de insumos y sus parámetros"""
         conditions = ["1=1"]  # Siempre verdadero para simplificar la construcción de la consulta
         params = []
         
@@ -80,7 +104,7 @@ class InsumoService:
         ORDER BY nombre_insumo
         """
         
-        return execute_query(query, params, fetch_all=True) or []
+        return query, params
     
     @staticmethod
     def update_insumo(insumo_id: int, update_data: Dict[str, Any]) -> bool:
@@ -134,8 +158,31 @@ class InsumoService:
         params.append(insumo_id)
         
         try:
-            result = execute_query(query, params)
+            with transaction() as connection:
+                with connection.cursor() as cursor:
+                    # Cantidades anteriores (bloqueadas) para anotar la reposición o el ajuste
+                    cursor.execute(
+                        "SELECT cantidad_unitaria, cantidad_utilizada FROM insumos WHERE id = %s FOR UPDATE",
+                        (insumo_id,)
+                    )
+                    cantidad_unitaria, cantidad_utilizada = cursor.fetchone()
+                    cursor.execute(query, params)
+                    result = cursor.rowcount
+                    if result > 0:
+                        record_movements(
+                            insumo_update_movements(
+                                insumo_id,
+                                {'cantidad_unitaria': cantidad_unitaria, 'cantidad_utilizada': cantidad_utilizada},
+                                update_data
+                            ),
+                            cursor=cursor
+                        )
+                        if any(field in update_data for field in ('cantidad_unitaria', 'cantidad_utilizada', 'cantidad_por_producto')):
+                            refresh_product_availability(insumo_ids=[insumo_id])
             if result > 0:
+                # Las recetas en caché llevan aplicado el cantidad_por_producto del insumo
+                if "cantidad_por_producto" in update_data:
+                    recipe_cache.invalidate()
                 logger.info(f"Insumo con ID {insumo_id} actualizado exitosamente")
                 return True
             else:
@@ -200,7 +247,13 @@ class InsumoService:
         """
         
         try:
-            result = execute_query(query, (cantidad_a_incrementar, insumo_id))
+            with transaction() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(query, (cantidad_a_incrementar, insumo_id))
+                    result = cursor.rowcount
+                    if result > 0:
+                        record_movements([(insumo_id, MOVEMENT_SALE, -float(cantidad_a_incrementar), None)], cursor=cursor)
+                        refresh_product_availability(insumo_ids=[insumo_id])
             if result > 0:
                 logger.info(f"Insumo {insumo_id}: cantidad utilizada +{cantidad_a_incrementar}")
                 return True
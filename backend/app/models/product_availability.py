@@ -0,0 +1,272 @@
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from database.db import commit_state, execute_many, execute_query, on_commit, transaction
+from models.consumption_queue import INSUMO_WRITE_BEHIND
+
+# Disponibilidad materializada de los productos.
+#
+# product_availability guarda, por producto, las unidades que se pueden producir
+# con los insumos actuales (FLOOR(MIN(disponible / cantidad por unidad)) sobre su
+# receta) y el insumo que limita esa cifra. Los endpoints de stock la leen sin
+# joins; quien cambia los insumos o una receta pide recalcular solo los
+# productos afectados:
+# - ventas, cancelaciones y el hilo de consumo diferido (PurchaseService._apply_insumo_deltas)
+# - ventas y cancelaciones con INSUMO_WRITE_BEHIND (consumo pendiente añadido o quitado)
+# - cambios de cantidades de un insumo (InsumoService, SalesService)
+# - cambios de receta (routers de productos y recetas, ProductService.add_product_recipe)
+#
+# El recálculo no se hace dentro de la transacción que cambió los insumos: bajo
+# REPEATABLE READ, leer recetas e insumos en ella tomaría bloqueos compartidos
+# sobre los insumos de todos los productos relacionados, y dos ventas con
+# tickets distintos pero recetas que comparten insumos se bloquearían entre
+# sí. Se acumulan los productos afectados y, tras el commit, se recalculan en
+# una transacción corta READ COMMITTED que solo bloquea sus filas de
+# product_availability (en orden de clave), lee los insumos sin bloqueos y
+# escribe por clave. Los recálculos simultáneos de un mismo producto se
+# ordenan por ese bloqueo, así que el último escribe con la lectura más reciente.
+#
+# Con INSUMO_WRITE_BEHIND lo disponible descuenta el consumo pendiente de
+# aplicar, igual que la validación de las ventas y el motor de stock: la tabla
+# cambia al vender y no cuando el hilo aplica el consumo.
+#
+# Un producto sin fila (p. ej. sin receta) tiene 0 unidades, igual que en el
+# cálculo completo. `python availability.py rebuild` recalcula toda la tabla
+# (p. ej. si un recálculo falló después del commit).
+#
+# Tras cada recálculo se avisa a las funciones registradas con
+# add_availability_listener (p. ej. el stream de cambios de stock).
+
+PRODUCT_AVAILABILITY_TABLE = """
+CREATE TABLE IF NOT EXISTS product_availability (
+    product_id INT PRIMARY KEY,
+    stock_disponible BIGINT NOT NULL DEFAULT 0,
+    limiting_insumo_id INT NULL,
+    updated_at TIMESTAMP(3) DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3)
+)
+"""
+
+# Cantidad disponible de un insumo (alias i)
+_REMAINING = "i.cantidad_unitaria - i.cantidad_utilizada"
+if INSUMO_WRITE_BEHIND:
+    _REMAINING += (
+        " - COALESCE((SELECT SUM(pc.quantity) FROM pending_insumo_consumption pc"
+        " WHERE pc.insumo_id = i.id), 0)"
+    )
+
+# Unidades por producto y el insumo con menos unidades posibles (el primero por
+# id en caso de empate). Las divisiones por cero dan NULL y no limitan, igual
+# que en MIN(); un producto sin ningún insumo válido queda con 0 unidades.
+_AVAILABILITY_SELECT = f"""
+SELECT product_id, COALESCE(unidades, 0), IF(unidades IS NULL, NULL, insumo_id)
+FROM (
+    SELECT product_id, insumo_id, unidades,
+           ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY unidades IS NULL, unidades, insumo_id) AS posicion
+    FROM (
+        SELECT p.id AS product_id, i.id AS insumo_id,
+               FLOOR(
+                   ({_REMAINING}) /
+                   CASE
+                       WHEN i.cantidad_por_producto > 0 THEN i.cantidad_por_producto
+                       ELSE pr.cantidad
+                   END
+               ) AS unidades
+        FROM products p
+        LEFT JOIN product_recipes pr ON p.id = pr.product_id
+        LEFT JOIN insumos i ON pr.insumo_id = i.id
+        {{where}}
+    ) AS unidades_por_insumo
+) AS por_producto
+WHERE posicion = 1
+ORDER BY product_id
+"""
+
+_UPSERT = """
+INSERT INTO product_availability (product_id, stock_disponible, limiting_insumo_id)
+{select}
+ON DUPLICATE KEY UPDATE stock_disponible = VALUES(stock_disponible),
+                        limiting_insumo_id = VALUES(limiting_insumo_id)
+"""
+
+_UPSERT_ROWS = _UPSERT.format(select="VALUES (%s, %s, %s)")
+
+# Lectura y escritura de recetas e insumos sin bloqueos sobre ellos (lecturas consistentes)
+_ISOLATION = 'READ COMMITTED'
+
+logger = logging.getLogger(__name__)
+
+_listeners = []
+
+def add_availability_listener(callback):
+    """Registrar callback() para que se ejecute tras el commit de cada cambio de disponibilidad"""
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+def _notify_listeners():
+    for callback in _listeners:
+        callback()
+
+def _scope(product_ids: Optional[Iterable[int]], insumo_ids: Optional[Iterable[int]]):
+    """WHERE y parámetros para los productos indicados o los que usan alguno de los insumos"""
+    conditions = []
+    params = []
+    if product_ids:
+        product_ids = sorted(set(product_ids))
+        conditions.append(f"p.id IN ({', '.join(['%s'] * len(product_ids))})")
+        params.extend(product_ids)
+    if insumo_ids:
+        insumo_ids = sorted(set(insumo_ids))
+        conditions.append(
+            f"p.id IN (SELECT product_id FROM product_recipes "
+            f"WHERE insumo_id IN ({', '.join(['%s'] * len(insumo_ids))}))"
+        )
+        params.extend(insumo_ids)
+    return "WHERE " + " OR ".join(conditions), params
+
+def refresh_product_availability(product_ids: Optional[Iterable[int]] = None,
+                                 insumo_ids: Optional[Iterable[int]] = None) -> Optional[int]:
+    """
+    Recalcular la disponibilidad de los productos afectados por un cambio
+
+    Dentro de una unidad de trabajo (transaction()) el recálculo se hace tras
+    su commit, una sola vez para todos los cambios de la transacción (y no se
+    hace si hay rollback). Fuera de ella se hace en el momento, así que quien
+    gestiona su propia conexión debe llamarla después de su commit.
+
+    Args:
+        product_ids: Productos cuya receta cambió
+        insumo_ids: Insumos cuyas cantidades cambiaron (se recalculan los productos que los usan)
+
+    Returns:
+        Productos recalculados (0 si no hay nada que recalcular o queda
+        pendiente del commit), o None si hubo un error
+    """
+    if not product_ids and not insumo_ids:
+        return 0
+
+    state = commit_state()
+    if state is None:
+        return _refresh(product_ids, insumo_ids)
+
+    pending = state.get('product_availability')
+    if pending is None:
+        pending = state['product_availability'] = (set(), set())
+        on_commit(lambda: _refresh(*pending))
+    pending[0].update(product_ids or ())
+    pending[1].update(insumo_ids or ())
+    return 0
+
+def _refresh(product_ids: Optional[Iterable[int]], insumo_ids: Optional[Iterable[int]]) -> Optional[int]:
+    """Recalcular en una transacción propia (ver el comentario del módulo)"""
+    where, params = _scope(product_ids, insumo_ids)
+    try:
+        with transaction(isolation_level=_ISOLATION) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT p.id FROM products p {where}", params)
+                affected = sorted(row[0] for row in cursor.fetchall())
+                if not affected:
+                    return 0
+                placeholders = ", ".join(["%s"] * len(affected))
+                # Bloquear primero las filas a escribir: la lectura siguiente (un
+                # snapshot nuevo en READ COMMITTED) ve todo lo confirmado hasta aquí
+                cursor.execute(
+                    f"SELECT product_id FROM product_availability WHERE product_id IN ({placeholders}) "
+                    f"ORDER BY product_id FOR UPDATE",
+                    affected
+                )
+                cursor.execute(_AVAILABILITY_SELECT.format(where=f"WHERE p.id IN ({placeholders})"), affected)
+                rows = cursor.fetchall()
+                execute_many(_UPSERT_ROWS, rows, cursor=cursor)
+    except Exception as e:
+        logger.warning("No se pudo recalcular la disponibilidad (productos %s, insumos %s): %s; "
+                       "ejecutar `python availability.py rebuild`", product_ids, insumo_ids, e)
+        return None
+    _notify_listeners()
+    return len(rows)
+
+def load_product_availability() -> Optional[Dict[int, tuple]]:
+    """
+    Disponibilidad de todos los productos con una lectura de la tabla (sin joins)
+
+    Returns:
+        Dict {product_id: (stock_disponible, limiting_insumo_id)}, o None si hubo un error
+    """
+    rows = execute_query(
+        "SELECT product_id, stock_disponible, limiting_insumo_id FROM product_availability",
+        fetch_all=True, compact=True
+    )
+    if rows is None:
+        return None
+    return {product_id: (int(stock), limiting) for product_id, stock, limiting in rows}
+
+def compute_product_availability() -> Optional[Dict[int, tuple]]:
+    """
+    Disponibilidad de todos los productos calculada en SQL sobre recetas e insumos (sin la tabla)
+
+    Returns:
+        Dict {product_id: (stock_disponible, limiting_insumo_id)}, o None si hubo un error
+    """
+    rows = execute_query(_AVAILABILITY_SELECT.format(where=''), fetch_all=True, compact=True)
+    if rows is None:
+        return None
+    return {product_id: (int(stock), limiting) for product_id, stock, limiting in rows}
+
+def check_product_availability() -> Optional[List[Dict]]:
+    """
+    Comparar la tabla con el cálculo completo sin modificar nada
+
+    Returns:
+        Lista de productos cuya fila falta o no coincide (con los valores
+        guardados y los calculados), o None si hubo un error
+    """
+    computed = compute_product_availability()
+    stored = load_product_availability()
+    if computed is None or stored is None:
+        return None
+
+    differences = []
+    for product_id, (stock, limiting) in computed.items():
+        current = stored.get(product_id)
+        # Sin fila equivale a 0 unidades
+        if current is None and stock == 0 and limiting is None:
+            continue
+        if current != (stock, limiting):
+            differences.append({
+                'product_id': product_id,
+                'stored': None if current is None else {'stock_disponible': current[0], 'limiting_insumo_id': current[1]},
+                'computed': {'stock_disponible': stock, 'limiting_insumo_id': limiting}
+            })
+    return differences
+
+def rebuild_product_availability() -> Optional[Dict]:
+    """
+    Recalcular la disponibilidad de todos los productos en una transacción
+
+    Las filas se actualizan en su sitio (sin vaciar la tabla), así que las
+    lecturas simultáneas ven los valores anteriores o los nuevos; las filas de
+    productos eliminados se borran.
+
+    Returns:
+        Dict con los productos recalculados y las filas eliminadas, o None si hubo un error
+    """
+    try:
+        # En READ COMMITTED el INSERT ... SELECT lee recetas e insumos sin bloquearlos
+        with transaction(isolation_level=_ISOLATION) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(_UPSERT.format(select=_AVAILABILITY_SELECT.format(where='')))
+                cursor.execute(
+                    """
+                    DELETE pa FROM product_availability pa
+                    LEFT JOIN products p ON p.id = pa.product_id
+                    WHERE p.id IS NULL
+                    """
+                )
+                removed = cursor.rowcount
+                cursor.execute("SELECT COUNT(*) FROM product_availability")
+                products = cursor.fetchone()[0]
+    except Exception as e:
+        logger.error("Error recalculando la disponibilidad de los productos: %s", e)
+        return None
+    _notify_listeners()
+    logger.info("Disponibilidad recalculada: %s productos, %s filas eliminadas", products, removed)
+    return {'products': products, 'removed': removed}
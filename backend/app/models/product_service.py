@@ -1,6 +1,10 @@
-from database.db import execute_query
+from database.db import execute_query, execute_insert_and_get_id, bulk_insert, transaction
+from database import async_db
+from models.catalog import product_catalog, recipe_cache
+from models.product_availability import refresh_product_availability
 from typing import List, Optional, Dict, Any
 import logging
+import pymysql
 import pymysql.err
 
 logger = logging.getLogger(__name__)
@@ -54,18 +58,14 @@ class ProductService:
             print(f"Ejecutando consulta SQL: {query}")
             print(f"Parámetros: {(nombre_producto, price, category_id, user_id, variante, True)}")
             
-            result = execute_query(
+            # LAST_INSERT_ID() solo es válido en la misma conexión que hizo el INSERT
+            product_id = execute_insert_and_get_id(
                 query, 
                 (nombre_producto, price, category_id, user_id, variante, stock_quantity, min_stock, True)
             )
-            
-            if result:
-                # Obtener el ID del producto recién creado
-                id_query = "SELECT LAST_INSERT_ID() as id"
-                id_result = execute_query(id_query, fetch_one=True)
-                return id_result['id'] if id_result else None
-            
-            return None
+            if product_id is not None:
+                product_catalog.invalidate()
+            return product_id
             
         except pymysql.err.IntegrityError as e:
             error_code, error_message = e.args
@@ -95,10 +95,37 @@ class ProductService:
         
         return execute_query(query, (product_id,), fetch_one=True)
     
+    @staticmethod
+    async def get_product_by_id_async(product_id: int) -> Optional[dict]:
+        """Obtener un producto por su ID sin bloquear el event loop"""
+        query = """
+        SELECT p.*, c.nombre_categoria as categoria_nombre, u.username as creado_por
+        FROM products p 
+        LEFT JOIN categories c ON p.category_id = c.id 
+        LEFT JOIN users u ON p.user_id = u.id
+        WHERE p.id = %s AND p.is_active = TRUE
+        """
+        
+        return await async_db.fetch_one(query, (product_id,))
+    
     @staticmethod
     def get_products(category_id: Optional[int] = None, search: Optional[str] = None, 
                     low_stock_only: bool = False, limit: int = 100, offset: int = 0) -> List[dict]:
         """Obtener lista de productos con filtros"""
+        query, params = ProductService._build_products_query(category_id, search, low_stock_only, limit, offset)
+        return execute_query(query, params, fetch_all=True) or []
+    
+    @staticmethod
+    async def get_products_async(category_id: Optional[int] = None, search: Optional[str] = None, 
+                                 low_stock_only: bool = False, limit: int = 100, offset: int = 0) -> List[dict]:
+        """Obtener lista de productos con filtros sin bloquear el event loop"""
+        query, params = ProductService._build_products_query(category_id, search, low_stock_only, limit, offset)
+        return await async_db.fetch_all(query, params)
+    
+    @staticmethod
+    def _build_products_query(category_id: Optional[int], search: Optional[str],
+                              low_stock_only: bool, limit: int, offset: int):
+        """Construir la consulta de listado de productos y sus parámetros"""
         conditions = ["p.is_active = TRUE"]
         params = []
         
@@ -127,7 +154,7 @@ class ProductService:
         """
         
         params.extend([limit, offset])
-        return execute_query(query, params, fetch_all=True) or []
+        return query, params
     
     @staticmethod
     def update_product(product_id: int, update_data: Dict[str, Any]) -> bool:
@@ -176,6 +203,8 @@ class ProductService:
         
         try:
             result = execute_query(query, params)
+            if result:
+                product_catalog.invalidate()
             return result > 0
         except pymysql.err.IntegrityError as e:
             error_code, error_message = e.args
@@ -220,6 +249,7 @@ class ProductService:
         try:
             result = execute_query(query, (product_id,))
             if result > 0:
+                product_catalog.invalidate()
                 logger.info(f"Producto con ID {product_id} desactivado exitosamente")
                 return True
             else:
@@ -294,13 +324,7 @@ class ProductService:
             print(f"ProductService.add_product_recipe: Iniciando para producto {product_id}")
             print(f"Ingredientes recibidos: {ingredients}")
             
-            # Primero eliminamos cualquier ingrediente existente
-            delete_query = "DELETE FROM product_recipes WHERE product_id = %s"
-            delete_result = execute_query(delete_query, (product_id,))
-            print(f"Ingredientes anteriores eliminados: {delete_result} filas afectadas")
-            
-            # Ahora insertamos los nuevos ingredientes
-            inserted_count = 0
+            rows = []
             for ingredient in ingredients:
                 insumo_id = ingredient.get('insumo_id')
                 cantidad = ingredient.get('cantidad')
@@ -309,24 +333,24 @@ class ProductService:
                     print(f"Ingrediente inválido: {ingredient}")
                     continue
                 
-                insert_query = """
-                INSERT INTO product_recipes (product_id, insumo_id, cantidad)
-                VALUES (%s, %s, %s)
-                """
-                
-                print(f"Insertando ingrediente: product_id={product_id}, insumo_id={insumo_id}, cantidad={cantidad}")
-                
-                result = execute_query(
-                    insert_query, 
-                    (product_id, insumo_id, cantidad)
-                )
+                rows.append((product_id, insumo_id, cantidad))
+            
+            # Reemplazar la receta anterior y escribir todos los ingredientes en un solo INSERT.
+            # Si se llama dentro de otra transacción (p. ej. al crear el producto) se une a ella.
+            with transaction() as connection:
+                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                    cursor.execute("DELETE FROM product_recipes WHERE product_id = %s", (product_id,))
+                    print(f"Ingredientes anteriores eliminados: {cursor.rowcount} filas afectadas")
+                    
+                    inserted_ids = bulk_insert(
+                        'product_recipes', ['product_id', 'insumo_id', 'cantidad'], rows, cursor=cursor
+                    )
+                    refresh_product_availability(product_ids=[product_id])
                 
-                if result and result > 0:
-                    inserted_count += 1
-                    print(f"Ingrediente insertado exitosamente")
-                else:
-                    print(f"Error al insertar ingrediente: resultado={result}")
+                # Dentro de la misma transacción: el cambio de versión se confirma con la receta
+                recipe_cache.invalidate()
             
+            inserted_count = len(inserted_ids)
             print(f"ProductService.add_product_recipe: {inserted_count} de {len(ingredients)} ingredientes insertados")
             return inserted_count == len(ingredients)
             
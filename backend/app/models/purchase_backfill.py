@@ -0,0 +1,154 @@
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from database.db import execute_query, transaction
+from models.catalog import load_product_index, resolve_product_name
+
+# Completar product_id y category_id en las filas de purchase_details
+# anteriores a la migración 8, que solo guardaban el nombre del producto.
+#
+# Las filas se recorren por id en bloques de BACKFILL_CHUNK_SIZE. Cada bloque
+# se actualiza con una sola sentencia y en la misma transacción se guarda el
+# último id procesado en backfill_progress, así que el proceso se puede
+# interrumpir en cualquier momento y continúa donde quedó.
+
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', 1000))
+
+BACKFILL_PROGRESS_TABLE = """
+CREATE TABLE IF NOT EXISTS backfill_progress (
+    name VARCHAR(50) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    processed BIGINT NOT NULL DEFAULT 0,
+    resolved BIGINT NOT NULL DEFAULT 0,
+    finished_at TIMESTAMP NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+
+PURCHASE_PRODUCTS_BACKFILL = 'purchase_details.product_id'
+
+logger = logging.getLogger(__name__)
+
+def get_backfill_progress(name: str = PURCHASE_PRODUCTS_BACKFILL) -> Optional[Dict]:
+    """Progreso guardado de un backfill (last_id 0 si nunca se ejecutó), o None si hubo un error"""
+    rows = execute_query(
+        "SELECT last_id, processed, resolved, finished_at FROM backfill_progress WHERE name = %s",
+        (name,), fetch_all=True
+    )
+    if rows is None:
+        return None
+    if not rows:
+        return {'last_id': 0, 'processed': 0, 'resolved': 0, 'finished_at': None}
+    return rows[0]
+
+def reset_backfill_progress(name: str = PURCHASE_PRODUCTS_BACKFILL):
+    """Volver a empezar un backfill desde el primer id"""
+    return execute_query("DELETE FROM backfill_progress WHERE name = %s", (name,))
+
+def backfill_purchase_products(chunk_size: int = None, max_chunks: Optional[int] = None,
+                               pause: float = 0.0) -> Optional[Dict]:
+    """
+    Completar product_id y category_id de las líneas de venta que no los tienen
+
+    Los nombres se resuelven con las mismas reglas que al vender, incluyendo los
+    productos desactivados. Las líneas que no corresponden a ningún producto
+    quedan en NULL y se cuentan como no resueltas.
+
+    Args:
+        chunk_size: Filas por bloque (por defecto BACKFILL_CHUNK_SIZE)
+        max_chunks: Máximo de bloques en esta ejecución (por defecto hasta terminar)
+        pause: Segundos de espera entre bloques para no cargar el servidor
+
+    Returns:
+        Dict con el progreso (last_id, processed, resolved, finished, chunks),
+        o None si no se pudo leer el progreso o cargar los productos
+    """
+    chunk_size = chunk_size or BACKFILL_CHUNK_SIZE
+    progress = get_backfill_progress()
+    index = load_product_index(include_inactive=True)
+    if progress is None or index is None:
+        return None
+    products = index[0]
+
+    last_id = progress['last_id']
+    processed = progress['processed']
+    resolved = progress['resolved']
+    chunks = 0
+    finished = False
+
+    while max_chunks is None or chunks < max_chunks:
+        with transaction() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(
+                    """
+                    SELECT id, product_name, product_variant
+                    FROM purchase_details
+                    WHERE id > %s AND product_id IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (last_id, chunk_size)
+                )
+                rows = cursor.fetchall()
+
+                updates = []
+                for detail_id, product_name, product_variant in rows:
+                    product_id = resolve_product_name(index, product_name, product_variant)
+                    if product_id is not None:
+                        updates.append((detail_id, product_id, products[product_id].category_id))
+
+                if updates:
+                    # Un solo UPDATE por bloque: CASE id WHEN ... THEN ... END
+                    product_cases = " ".join(["WHEN %s THEN %s"] * len(updates))
+                    placeholders = ", ".join(["%s"] * len(updates))
+                    params = []
+                    for detail_id, product_id, _ in updates:
+                        params.extend((detail_id, product_id))
+                    for detail_id, _, category_id in updates:
+                        params.extend((detail_id, category_id))
+                    params.extend(detail_id for detail_id, _, _ in updates)
+                    cursor.execute(
+                        f"""
+                        UPDATE purchase_details
+                        SET product_id = CASE id {product_cases} END,
+                            category_id = CASE id {product_cases} END
+                        WHERE id IN ({placeholders})
+                        """,
+                        params
+                    )
+
+                finished = len(rows) < chunk_size
+                if rows:
+                    last_id = rows[-1][0]
+                processed += len(rows)
+                resolved += len(updates)
+                cursor.execute(
+                    """
+                    INSERT INTO backfill_progress (name, last_id, processed, resolved, finished_at)
+                    VALUES (%s, %s, %s, %s, IF(%s, NOW(), NULL))
+                    ON DUPLICATE KEY UPDATE last_id = VALUES(last_id), processed = VALUES(processed),
+                                            resolved = VALUES(resolved), finished_at = VALUES(finished_at)
+                    """,
+                    (PURCHASE_PRODUCTS_BACKFILL, last_id, processed, resolved, finished)
+                )
+            finally:
+                cursor.close()
+
+        chunks += 1
+        logger.info("Backfill de productos: hasta id %s, %s filas procesadas, %s resueltas", last_id, processed, resolved)
+        if finished:
+            break
+        if pause:
+            time.sleep(pause)
+
+    return {
+        'last_id': last_id,
+        'processed': processed,
+        'resolved': resolved,
+        'unresolved': processed - resolved,
+        'finished': finished,
+        'chunks': chunks
+    }
@@ -1,7 +1,9 @@
-from database.db import execute_query
+from database.db import execute_query, execute_insert_and_get_id, execute_many, bulk_insert, transaction
 from typing import List, Optional, Dict, Any
 import logging
 from models.insumo_service import InsumoService
+from models.insumo_ledger import MOVEMENT_SALE, consumption_movements, record_movements
+from models.product_availability import refresh_product_availability
 
 logger = logging.getLogger(__name__)
 
@@ -43,15 +45,8 @@ class SalesService:
         """
         
         try:
-            result = execute_query(query, (user_id, total_amount, payment_method, notes))
-            
-            if result:
-                # Obtener el ID de la venta recién creada
-                id_query = "SELECT LAST_INSERT_ID() as id"
-                id_result = execute_query(id_query, fetch_one=True)
-                return id_result['id'] if id_result else None
-            
-            return None
+            # LAST_INSERT_ID() solo es válido en la misma conexión que hizo el INSERT
+            return execute_insert_and_get_id(query, (user_id, total_amount, payment_method, notes))
         except Exception as e:
             logger.error(f"Error creando venta: {e}")
             return None
@@ -104,6 +99,52 @@ class SalesService:
             
             logger.info(f"Insumo {item['insumo_id']} actualizado: +{total_quantity_to_add} unidades utilizadas")
     
+    @staticmethod
+    def _update_insumos_stock_for_items(items: List[Dict[str, Any]]) -> None:
+        """
+        Actualizar la cantidad utilizada de insumos para todos los productos de una venta
+        
+        Lee las recetas de todos los productos con una sola consulta, acumula el
+        consumo por insumo y aplica las actualizaciones en un solo lote.
+        
+        Args:
+            items: Lista de diccionarios con {product_id, quantity}
+        """
+        quantities = {}
+        for item in items:
+            quantities[item['product_id']] = quantities.get(item['product_id'], 0) + item['quantity']
+        
+        if not quantities:
+            return
+        
+        placeholders = ", ".join(["%s"] * len(quantities))
+        recipe_query = f"""
+        SELECT pr.product_id, pr.insumo_id, pr.cantidad
+        FROM product_recipes pr
+        WHERE pr.product_id IN ({placeholders})
+        """
+        recipe_items = execute_query(recipe_query, list(quantities), fetch_all=True) or []
+        
+        consumption = {}
+        for item in recipe_items:
+            total_quantity_to_add = item['cantidad'] * quantities[item['product_id']]
+            consumption[item['insumo_id']] = consumption.get(item['insumo_id'], 0) + total_quantity_to_add
+        
+        update_query = """
+        UPDATE insumos
+        SET cantidad_utilizada = cantidad_utilizada + %s
+        WHERE id = %s
+        """
+        result = execute_many(update_query, [(cantidad, insumo_id) for insumo_id, cantidad in consumption.items()])
+        
+        # La venta no se confirma sin descontar los insumos ni anotarlos en el libro
+        if result is None:
+            raise Exception(f"Error actualizando insumos de la venta: {consumption}")
+        if record_movements(consumption_movements(MOVEMENT_SALE, [(None, consumption)])) is None:
+            raise Exception(f"Error anotando el consumo de la venta en el libro de insumos: {consumption}")
+        refresh_product_availability(insumo_ids=consumption)
+        logger.info(f"Insumos actualizados en lote: {consumption}")
+    
     @staticmethod
     def get_sale_by_id(sale_id: int) -> Optional[Dict[str, Any]]:
         """Obtener una venta por su ID"""
@@ -158,7 +199,7 @@ class SalesService:
         SELECT s.*, u.username as vendedor
         FROM sales s
         JOIN users u ON s.user_id = u.id
-        WHERE DATE(s.sale_date) BETWEEN %s AND %s
+        WHERE s.sale_date >= %s AND s.sale_date < %s + INTERVAL 1 DAY
         ORDER BY s.sale_date DESC
         """
         
@@ -181,20 +222,28 @@ class SalesService:
         total_amount = sum(item['quantity'] * item['unit_price'] for item in items)
         
         try:
-            # Crear la venta
-            sale_id = SalesService.create_sale(user_id, total_amount, payment_method, notes)
-            
-            if not sale_id:
-                return None
-            
-            # Añadir los detalles
-            for item in items:
-                SalesService.add_sale_detail(
-                    sale_id, 
-                    item['product_id'], 
-                    item['quantity'], 
-                    item['unit_price']
+            # Venta, detalles e insumos se confirman juntos o no se confirma nada
+            with transaction():
+                # Crear la venta
+                sale_id = SalesService.create_sale(user_id, total_amount, payment_method, notes)
+                
+                if not sale_id:
+                    raise Exception("No se pudo registrar la venta")
+                
+                # Añadir todos los detalles en un solo INSERT
+                detail_rows = [
+                    (sale_id, item['product_id'], item['quantity'], item['unit_price'])
+                    for item in items
+                ]
+                detail_ids = bulk_insert(
+                    'sale_details', ['sale_id', 'product_id', 'quantity', 'unit_price'], detail_rows
                 )
+                
+                if detail_ids is None:
+                    raise Exception(f"Error añadiendo detalles a la venta {sale_id}")
+                
+                # Actualizar los insumos de todos los productos vendidos en un solo lote
+                SalesService._update_insumos_stock_for_items(items)
             
             return sale_id
         except Exception as e:
@@ -208,7 +257,8 @@ class SalesService:
         params = []
         
         if start_date and end_date:
-            conditions.append("DATE(s.sale_date) BETWEEN %s AND %s")
+            # Comparar la columna directamente para poder usar idx_sales_sale_date
+            conditions.append("s.sale_date >= %s AND s.sale_date < %s + INTERVAL 1 DAY")
             params.extend([start_date, end_date])
         
         where_clause = " AND ".join(conditions)
@@ -0,0 +1,405 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from database.db import execute_query
+from models.catalog import recipe_cache
+from models.consumption_queue import INSUMO_WRITE_BEHIND
+
+# Motor de stock en memoria.
+#
+# Las recetas forman una matriz dispersa productos x insumos (CSR): la fila de
+# un producto guarda los insumos de su receta y la cantidad de cada uno por
+# unidad vendida (con el cantidad_por_producto del insumo ya aplicado). Se
+# construye a partir de recipe_cache y se reconstruye solo cuando la caché
+# recarga las recetas.
+#
+# Cada consulta lee el vector de insumos restantes con una sola consulta
+# (StockSnapshot) y calcula con operaciones vectorizadas:
+# - disponibilidad de todos los productos: FLOOR(MIN(restante / cantidad)) por fila
+# - consumo de un carrito: A^T x
+# - escenarios hipotéticos por lotes (carritos y reposiciones): una matriz de
+#   vectores restantes, escenarios x insumos, evaluada en una sola pasada
+
+# Tolerancia del FLOOR: con DECIMAL, 0.3 / 0.1 da exactamente 3 en MySQL; en
+# coma flotante da 2.999..., así que se suma un margen antes de truncar
+_FLOOR_EPSILON = 1e-9
+
+logger = logging.getLogger(__name__)
+
+class RecipeMatrix:
+    """
+    Recetas en formato CSR
+
+    - product_ids[r]: producto de la fila r (con receta)
+    - insumo_ids[c]: insumo de la columna c (usado en alguna receta), ordenados
+    - indptr, indices, data: la fila r ocupa indices/data[indptr[r]:indptr[r + 1]],
+      ordenada por insumo; las cantidades 0 no limitan (igual que la división
+      por cero en SQL) y no se guardan
+    - recipe_quantities: cantidad de la receta sin cantidad_por_producto (para el detalle)
+    - column_order, column_starts: los mismos elementos ordenados por columna
+      (CSC), para sumar el consumo por insumo con reduceat
+    """
+    __slots__ = ('product_ids', 'product_index', 'insumo_ids', 'insumo_index', 'indptr', 'indices',
+                 'data', 'recipe_quantities', 'rows', 'starts', 'nonempty', 'column_order', 'column_starts')
+
+    def __init__(self, recipes):
+        product_ids = sorted(recipes)
+        insumo_ids = sorted({
+            insumo_id for recipe in recipes.values()
+            for insumo_id, quantity in zip(recipe.insumo_ids, recipe.quantities) if quantity
+        })
+        self.product_ids = np.array(product_ids, dtype=np.int64)
+        self.product_index = {product_id: row for row, product_id in enumerate(product_ids)}
+        self.insumo_ids = np.array(insumo_ids, dtype=np.int64)
+        self.insumo_index = {insumo_id: column for column, insumo_id in enumerate(insumo_ids)}
+
+        indptr = [0]
+        indices = []
+        data = []
+        recipe_quantities = []
+        for product_id in product_ids:
+            recipe = recipes[product_id]
+            entries = sorted(
+                (self.insumo_index[insumo_id], quantity, recipe_quantity)
+                for insumo_id, quantity, recipe_quantity
+                in zip(recipe.insumo_ids, recipe.quantities, recipe.recipe_quantities)
+                if quantity
+            )
+            for column, quantity, recipe_quantity in entries:
+                indices.append(column)
+                data.append(quantity)
+                recipe_quantities.append(recipe_quantity)
+            indptr.append(len(indices))
+
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.data = np.array(data, dtype=np.float64)
+        self.recipe_quantities = np.array(recipe_quantities, dtype=np.float64)
+        # Fila de cada elemento y filas con algún insumo (para reduceat)
+        lengths = np.diff(self.indptr)
+        self.rows = np.repeat(np.arange(len(product_ids)), lengths)
+        self.nonempty = lengths > 0
+        self.starts = self.indptr[:-1][self.nonempty]
+        # Cada columna tiene al menos un elemento: solo se crean para insumos con cantidad
+        self.column_order = np.argsort(self.indices, kind='stable')
+        self.column_starts = np.searchsorted(self.indices[self.column_order], np.arange(len(insumo_ids)))
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def cart_vector(self, cart: Dict[int, float]) -> np.ndarray:
+        """Unidades por fila de un carrito {product_id: unidades}; los productos sin receta no consumen"""
+        vector = np.zeros(len(self.product_ids))
+        for product_id, units in cart.items():
+            row = self.product_index.get(product_id)
+            if row is not None:
+                vector[row] += units
+        return vector
+
+    def consumption(self, carts: np.ndarray) -> np.ndarray:
+        """
+        Consumo por insumo de uno o varios carritos (A^T x)
+
+        Args:
+            carts: Unidades por fila, vector (productos) o matriz (escenarios x productos)
+
+        Returns:
+            Vector (insumos) o matriz (escenarios x insumos)
+        """
+        single = carts.ndim == 1
+        carts = np.atleast_2d(carts)
+        if not len(self.indices):
+            consumed = np.zeros((carts.shape[0], 0))
+        else:
+            # cantidad * unidades de cada elemento, sumado por columna en orden CSC
+            order = self.column_order
+            consumed = np.add.reduceat(carts[:, self.rows[order]] * self.data[order], self.column_starts, axis=1)
+        return consumed[0] if single else consumed
+
+    def availability(self, remaining: np.ndarray, with_limiting: bool = True):
+        """
+        Unidades que se pueden producir de cada producto e insumo que las limita
+
+        Args:
+            remaining: Insumo restante por columna, vector (insumos) o matriz
+                (escenarios x insumos); NaN si el insumo ya no existe (no limita)
+            with_limiting: Calcular también el insumo limitante (si no, columna -1)
+
+        Returns:
+            Tupla (unidades, columna limitante): arreglos (productos) o
+            (escenarios x productos); 0 unidades y columna -1 en los productos
+            sin ningún insumo que limite
+        """
+        single = remaining.ndim == 1
+        remaining = np.atleast_2d(remaining)
+        scenarios = remaining.shape[0]
+        units = np.zeros((scenarios, len(self.product_ids)))
+        limiting = np.full((scenarios, len(self.product_ids)), -1, dtype=np.int64)
+
+        if len(self.indices):
+            ratios = np.floor(remaining[:, self.indices] / self.data + _FLOOR_EPSILON)
+            # fmin ignora los NaN, como MIN() ignora los NULL
+            minimum = np.fmin.reduceat(ratios, self.starts, axis=1)
+            valid = ~np.isnan(minimum)
+            units[:, self.nonempty] = np.where(valid, minimum, 0)
+
+        if len(self.indices) and with_limiting:
+            # Limitante: primer elemento de la fila (menor id de insumo) que alcanza el mínimo
+            rows_minimum = np.full((scenarios, len(self.product_ids)), np.nan)
+            rows_minimum[:, self.nonempty] = minimum
+            scenario_index, element = np.nonzero(ratios == rows_minimum[:, self.rows])
+            row = self.rows[element]
+            first = np.unique(scenario_index * len(self.product_ids) + row, return_index=True)[1]
+            limiting[scenario_index[first], row[first]] = self.indices[element[first]]
+
+        units = units.astype(np.int64)
+        return (units[0], limiting[0]) if single else (units, limiting)
+
+class StockSnapshot:
+    """
+    Matriz de recetas y vector de insumos restantes leídos en un momento dado
+
+    remaining está alineado con las columnas de la matriz; insumos guarda
+    (nombre, unidad, restante, cantidad_por_producto) de todos los insumos.
+    """
+
+    def __init__(self, matrix: RecipeMatrix, insumos: Dict[int, tuple]):
+        self.matrix = matrix
+        self.insumos = insumos
+        self.remaining = np.array(
+            [insumos[insumo_id][2] if insumo_id in insumos else np.nan for insumo_id in matrix.insumo_ids.tolist()],
+            dtype=np.float64
+        )
+        self._availability = None
+
+    def availability(self):
+        """Unidades y columna limitante de todos los productos con el vector actual (se calcula una vez)"""
+        if self._availability is None:
+            self._availability = self.matrix.availability(self.remaining)
+        return self._availability
+
+    def units_by_product(self) -> Dict[int, int]:
+        """Dict {product_id: unidades}; los productos sin receta no aparecen (0 unidades)"""
+        units, _ = self.availability()
+        return dict(zip(self.matrix.product_ids.tolist(), units.tolist()))
+
+    def availability_by_product(self) -> Dict[int, tuple]:
+        """
+        Dict {product_id: (unidades, insumo limitante o None)}, como las filas de
+        product_availability; los productos sin receta no aparecen (0 unidades)
+        """
+        units, limiting = self.availability()
+        insumo_ids = self.matrix.insumo_ids.tolist()
+        return {
+            product_id: (product_units, insumo_ids[column] if column >= 0 else None)
+            for product_id, product_units, column in zip(
+                self.matrix.product_ids.tolist(), units.tolist(), limiting.tolist()
+            )
+        }
+
+    def shortages(self, cart: Dict[int, float]) -> Dict[int, tuple]:
+        """
+        Insumos que no alcanzan para un carrito
+
+        Returns:
+            Dict {insumo_id: (necesario, disponible)}; un insumo eliminado cuenta
+            como 0 disponible
+        """
+        needed = self.matrix.consumption(self.matrix.cart_vector(cart))
+        available = np.nan_to_num(self.remaining, nan=0.0)
+        columns = np.flatnonzero((needed > 0) & (needed > available))
+        return {
+            int(self.matrix.insumo_ids[column]): (float(needed[column]), float(available[column]))
+            for column in columns
+        }
+
+    def scenario_remaining(self, scenarios: List[Dict]) -> np.ndarray:
+        """
+        Vectores restantes de varios escenarios (escenarios x insumos)
+
+        Cada escenario es {'cart': {product_id: unidades}, 'restock': {insumo_id: cantidad}}:
+        el carrito se descuenta y la reposición se suma al vector actual. Los
+        insumos repuestos que no están en ninguna receta no cambian nada.
+        """
+        matrix = self.matrix
+        carts = np.zeros((len(scenarios), len(matrix)))
+        restock = np.zeros((len(scenarios), len(matrix.insumo_ids)))
+        for index, scenario in enumerate(scenarios):
+            carts[index] = matrix.cart_vector(scenario.get('cart') or {})
+            for insumo_id, quantity in (scenario.get('restock') or {}).items():
+                column = matrix.insumo_index.get(insumo_id)
+                if column is not None:
+                    restock[index, column] += quantity
+        consumed = np.atleast_2d(matrix.consumption(carts))
+        # Reponer un insumo eliminado no lo hace existir: sigue sin limitar
+        return self.remaining - consumed + np.where(np.isnan(self.remaining), 0.0, restock)
+
+    def what_if(self, scenarios: List[Dict]) -> List[Dict[int, tuple]]:
+        """
+        Productos cuyas unidades cambian en cada escenario
+
+        Returns:
+            Por escenario, Dict {product_id: (unidades actuales, unidades en el escenario)}
+        """
+        if not scenarios:
+            return []
+        current, _ = self.availability()
+        units, _ = self.matrix.availability(self.scenario_remaining(scenarios), with_limiting=False)
+        scenario_index, rows = np.nonzero(units != current)
+        results = [{} for _ in scenarios]
+        for scenario, product_id, before, after in zip(
+            scenario_index.tolist(), self.matrix.product_ids[rows].tolist(),
+            current[rows].tolist(), units[scenario_index, rows].tolist()
+        ):
+            results[scenario][product_id] = (before, after)
+        return results
+
+    def product_detail(self, product_id: int) -> Optional[List[tuple]]:
+        """
+        Insumos de la receta de un producto con las unidades que permite cada uno
+
+        Returns:
+            Lista de (insumo_id, disponible, cantidad_receta, cantidad_requerida,
+            unidades_posibles) ordenada por unidades; lista vacía si no tiene
+            receta, None si el producto no está en la matriz
+        """
+        matrix = self.matrix
+        row = matrix.product_index.get(product_id)
+        if row is None:
+            return None
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        columns = matrix.indices[start:end]
+        remaining = self.remaining[columns]
+        required = matrix.data[start:end]
+        units = np.floor(remaining / required + _FLOOR_EPSILON)
+        detail = [
+            (int(matrix.insumo_ids[column]), float(available), float(recipe_quantity), float(quantity), int(unit))
+            for column, available, recipe_quantity, quantity, unit
+            in zip(columns, remaining, matrix.recipe_quantities[start:end], required, units)
+            if not np.isnan(available)
+        ]
+        detail.sort(key=lambda item: item[4])
+        return detail
+
+class StockEngine:
+    """
+    Matriz de recetas del proceso, reconstruida cuando recipe_cache recarga
+    las recetas (cambio de receta o de cantidad_por_producto en cualquier worker)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recipes = None
+        self._matrix = None
+        self.builds = 0
+        self.snapshots = 0
+        self.last_build_ms = 0.0
+
+    def matrix(self) -> RecipeMatrix:
+        """
+        Matriz al día con las recetas de recipe_cache
+
+        Raises:
+            Exception: si las recetas no se pudieron cargar
+        """
+        recipes = recipe_cache.all()
+        if recipes is None:
+            raise Exception("No se pudieron cargar las recetas de los productos")
+        if recipes is self._recipes:
+            return self._matrix
+        with self._lock:
+            if recipes is not self._recipes:
+                started = time.perf_counter()
+                self._matrix = RecipeMatrix(recipes)
+                self._recipes = recipes
+                self.builds += 1
+                self.last_build_ms = (time.perf_counter() - started) * 1000
+                logger.info("Matriz de recetas construida: %s productos, %s insumos, %s elementos en %.1f ms",
+                            len(self._matrix), len(self._matrix.insumo_ids), len(self._matrix.indices),
+                            self.last_build_ms)
+            return self._matrix
+
+    def snapshot(self) -> StockSnapshot:
+        """
+        Matriz y vector de insumos restantes actual (una consulta)
+
+        Con INSUMO_WRITE_BEHIND el consumo pendiente de aplicar se descuenta,
+        igual que en la validación de las ventas.
+
+        Raises:
+            Exception: si no se pudieron cargar las recetas o los insumos
+        """
+        matrix = self.matrix()
+        if INSUMO_WRITE_BEHIND:
+            query = """
+            SELECT i.id, i.nombre_insumo, i.unidad,
+                   i.cantidad_unitaria - i.cantidad_utilizada - COALESCE(pc.pendiente, 0),
+                   i.cantidad_por_producto
+            FROM insumos i
+            LEFT JOIN (
+                SELECT insumo_id, SUM(quantity) AS pendiente
+                FROM pending_insumo_consumption
+                GROUP BY insumo_id
+            ) pc ON pc.insumo_id = i.id
+            """
+        else:
+            query = """
+            SELECT id, nombre_insumo, unidad, cantidad_unitaria - cantidad_utilizada, cantidad_por_producto
+            FROM insumos
+            """
+        rows = execute_query(query, fetch_all=True, compact=True)
+        if rows is None:
+            raise Exception("No se pudieron cargar los insumos")
+        insumos = {
+            insumo_id: (nombre, unidad, float(remaining), float(per_product or 0))
+            for insumo_id, nombre, unidad, remaining, per_product in rows
+        }
+        self.snapshots += 1
+        return StockSnapshot(matrix, insumos)
+
+    def snapshot_at(self, balances: Dict[int, float]) -> StockSnapshot:
+        """
+        Matriz con un vector de insumos restantes dado (p. ej. reconstruido del
+        libro de movimientos a una fecha); nombres, unidades y
+        cantidad_por_producto son los actuales
+
+        Args:
+            balances: Dict {insumo_id: restante}; los insumos que no aparecen tienen 0
+
+        Raises:
+            Exception: si no se pudieron cargar las recetas o los insumos
+        """
+        matrix = self.matrix()
+        rows = execute_query(
+            "SELECT id, nombre_insumo, unidad, cantidad_por_producto FROM insumos",
+            fetch_all=True, compact=True
+        )
+        if rows is None:
+            raise Exception("No se pudieron cargar los insumos")
+        insumos = {
+            insumo_id: (nombre, unidad, float(balances.get(insumo_id, 0.0)), float(per_product or 0))
+            for insumo_id, nombre, unidad, per_product in rows
+        }
+        self.snapshots += 1
+        return StockSnapshot(matrix, insumos)
+
+    def stats(self):
+        """Tamaño de la matriz y contadores"""
+        matrix = self._matrix
+        return {
+            'name': 'stock_engine',
+            'loaded': matrix is not None,
+            'products': len(matrix) if matrix is not None else 0,
+            'insumos': len(matrix.insumo_ids) if matrix is not None else 0,
+            'entries': len(matrix.indices) if matrix is not None else 0,
+            'builds': self.builds,
+            'snapshots': self.snapshots,
+            'last_build_ms': round(self.last_build_ms, 2)
+        }
+
+# Instancia única del proceso
+stock_engine = StockEngine()
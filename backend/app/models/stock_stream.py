@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import List, Optional
+
+from database.db import execute_query
+from models.catalog import product_catalog
+from models.product_availability import add_availability_listener
+
+# Stream de cambios de stock (Server-Sent Events).
+#
+# Un solo hilo por proceso (StockBroadcaster) lee de product_availability las
+# filas cambiadas desde la última lectura (updated_at solo cambia cuando cambian
+# las unidades), las compara con el último estado conocido y reparte un evento
+# `delta` con los productos que cambiaron a todas las terminales conectadas. El
+# costo por cambio es una consulta indexada, sin importar cuántas terminales
+# escuchen.
+#
+# Cada recálculo de disponibilidad despierta al hilo tras su commit; además lee
+# cada STOCK_STREAM_INTERVAL_MS y relee la tabla completa cada
+# STOCK_STREAM_RESYNC_SECONDS (cambios de otros procesos, transacciones que
+# hicieron commit después de la lectura). Sin terminales conectadas no consulta
+# nada; al volver a tener una, relee la tabla y emite lo que cambió mientras tanto.
+#
+# Reanudación: los eventos llevan el id "<época>-<secuencia>". Una terminal que
+# se reconecta envía el último id (cabecera Last-Event-ID) y recibe solo los
+# eventos que perdió, si siguen en el búfer de STOCK_STREAM_BUFFER eventos y es
+# el mismo proceso (misma época); si no, recibe un evento `snapshot` con el
+# stock completo y continúa desde ahí.
+
+STREAM_INTERVAL_MS = int(os.getenv('STOCK_STREAM_INTERVAL_MS', 250))  # lectura periódica de cambios
+STREAM_RESYNC_SECONDS = int(os.getenv('STOCK_STREAM_RESYNC_SECONDS', 60))  # relectura completa de la tabla
+STREAM_BUFFER = int(os.getenv('STOCK_STREAM_BUFFER', 1000))  # eventos guardados para reanudar
+STREAM_CLIENT_QUEUE = int(os.getenv('STOCK_STREAM_CLIENT_QUEUE', 100))  # eventos pendientes por terminal
+STREAM_LOW_THRESHOLD = int(os.getenv('STOCK_STREAM_LOW_THRESHOLD', 5))  # igual que /stock/low por defecto
+STREAM_HEARTBEAT_SECONDS = int(os.getenv('STOCK_STREAM_HEARTBEAT_SECONDS', 15))  # comentario para mantener la conexión
+STREAM_RETRY_MS = 3000  # espera sugerida al navegador antes de reconectar
+
+# Las filas se releen desde un poco antes de la última vista: una transacción
+# que hizo commit tarde puede tener un updated_at anterior
+_OVERLAP_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+class StockSubscription:
+    """
+    Cola de eventos de una terminal (en el event loop de su petición)
+
+    Si la terminal no lee y la cola se llena, se marca `lagged`: se descartan
+    los eventos siguientes y la terminal debe recibir un snapshot nuevo.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_pending: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.lagged = False
+
+    def offer(self, event: tuple):
+        """Encolar un evento (se ejecuta en el event loop)"""
+        if self.lagged:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+    def drain(self):
+        """Vaciar la cola tras un retraso (se ejecuta en el event loop)"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.lagged = False
+
+class StockBroadcaster:
+    """
+    Hilo que detecta los cambios de disponibilidad y los reparte a las terminales
+
+    Los eventos son tuplas (tipo, secuencia, datos) con tipo 'delta' o 'snapshot'.
+    """
+
+    def __init__(self, interval_ms=None, buffer_size=None, low_threshold=None):
+        self.interval = (interval_ms or STREAM_INTERVAL_MS) / 1000
+        self.low_threshold = STREAM_LOW_THRESHOLD if low_threshold is None else low_threshold
+        self.epoch = uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self._events = deque(maxlen=buffer_size or STREAM_BUFFER)
+        self._subscribers = set()
+        self._state = None
+        self._watermark = None
+        self._stale = True
+        self._last_resync = 0.0
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.polls = 0
+        self.deltas = 0
+        self.errors = 0
+        self.last_poll_ms = 0.0
+        add_availability_listener(self.wake)
+
+    def start(self):
+        """Arrancar el hilo (no hace nada si ya está en marcha)"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stock-broadcaster', daemon=True)
+        self._thread.start()
+        logger.info("Stream de cambios de stock activo (cada %s ms)", int(self.interval * 1000))
+
+    def stop(self, timeout=10):
+        """Detener el hilo"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def wake(self):
+        """Leer los cambios sin esperar al siguiente intervalo"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._subscribers:
+                # Sin terminales no se consulta; al volver se relee la tabla completa
+                self._stale = True
+                continue
+            full = self._stale or time.monotonic() - self._last_resync >= STREAM_RESYNC_SECONDS
+            try:
+                self.poll(full=full)
+            except Exception as e:
+                self.errors += 1
+                logger.error("Error leyendo los cambios de stock: %s", e)
+
+    def _read(self, full: bool) -> List[tuple]:
+        """Filas (product_id, stock_disponible, updated_at) de toda la tabla o las cambiadas"""
+        if full or self._watermark is None:
+            rows = execute_query(
+                "SELECT product_id, stock_disponible, updated_at FROM product_availability",
+                fetch_all=True, compact=True
+            )
+        else:
+            rows = execute_query(
+                "SELECT product_id, stock_disponible, updated_at FROM product_availability "
+                "WHERE updated_at >= %s - INTERVAL %s SECOND",
+                (self._watermark, _OVERLAP_SECONDS), fetch_all=True, compact=True
+            )
+        if rows is None:
+            raise Exception("No se pudo leer product_availability")
+        return list(rows)
+
+    def poll(self, full: bool = False) -> Optional[tuple]:
+        """
+        Leer los cambios y repartir un evento delta si alguno cambió de unidades
+
+        Args:
+            full: Releer toda la tabla (los productos sin fila pasan a 0 unidades)
+
+        Returns:
+            El evento emitido, o None si no hubo cambios (o era la primera lectura)
+        """
+        started = time.perf_counter()
+        rows = self._read(full)
+        with self._lock:
+            self.polls += 1
+            current = {product_id: int(stock) for product_id, stock, _ in rows}
+            for _, _, updated_at in rows:
+                if updated_at is not None and (self._watermark is None or updated_at > self._watermark):
+                    self._watermark = updated_at
+            if full:
+                self._stale = False
+                self._last_resync = time.monotonic()
+
+            if self._state is None:
+                # Primera lectura: estado de partida, sin evento
+                self._state = current
+                self.last_poll_ms = (time.perf_counter() - started) * 1000
+                return None
+
+            changes = [
+                (product_id, self._state.get(product_id, 0), stock)
+                for product_id, stock in current.items()
+                if self._state.get(product_id, 0) != stock
+            ]
+            if full:
+                changes.extend(
+                    (product_id, stock, 0) for product_id, stock in self._state.items()
+                    if product_id not in current and stock != 0
+                )
+                self._state = current
+            else:
+                self._state.update(current)
+            self.last_poll_ms = (time.perf_counter() - started) * 1000
+            if not changes:
+                return None
+            return self._publish(changes)
+
+    def _publish(self, changes: List[tuple]) -> Optional[tuple]:
+        """Evento delta de los productos activos que cambiaron (con el lock tomado)"""
+        productos = []
+        for product_id, antes, despues in changes:
+            product = product_catalog.get(product_id)
+            if product is None:
+                continue
+            productos.append({
+                'producto_id': product_id,
+                'nombre_producto': product.nombre_producto,
+                'variante': product.variante or '',
+                'stock_anterior': antes,
+                'stock_disponible': despues
+            })
+        if not productos:
+            return None
+        productos.sort(key=lambda item: (item['nombre_producto'].casefold(), item['producto_id']))
+
+        low = self.low_threshold
+        self.sequence += 1
+        event = ('delta', self.sequence, {
+            'seq': self.sequence,
+            'productos': productos,
+            'se_agotan': [item['producto_id'] for item in productos if item['stock_anterior'] > 0 >= item['stock_disponible']],
+            'se_habilitan': [item['producto_id'] for item in productos if item['stock_anterior'] <= 0 < item['stock_disponible']],
+            'entran_stock_bajo': [item['producto_id'] for item in productos if item['stock_anterior'] > low >= item['stock_disponible']],
+            'salen_stock_bajo': [item['producto_id'] for item in productos if item['stock_anterior'] <= low < item['stock_disponible']]
+        })
+        self._events.append(event)
+        self.deltas += 1
+        for subscription in self._subscribers:
+            subscription.loop.call_soon_threadsafe(subscription.offer, event)
+        return event
+
+    def event_id(self, sequence: int) -> str:
+        """Id del evento para la cabecera Last-Event-ID"""
+        return f"{self.epoch}-{sequence}"
+
+    def snapshot_event(self) -> tuple:
+        """
+        Evento snapshot con las unidades de todos los productos activos y la secuencia actual
+
+        Raises:
+            Exception: si no se pudo leer la disponibilidad o el catálogo
+        """
+        if self._state is None:
+            self.poll(full=True)
+        products = product_catalog.products()
+        if products is None:
+            raise Exception("No se pudo cargar el catálogo de productos")
+        products.sort(key=lambda product: (product.nombre_producto.casefold(), product.id))
+        with self._lock:
+            productos = [
+                {
+                    'producto_id': product.id,
+                    'nombre_producto': product.nombre_producto,
+                    'variante': product.variante or '',
+                    # Sin fila: el producto no tiene receta (0 unidades)
+                    'stock_disponible': self._state.get(product.id, 0)
+                }
+                for product in products
+            ]
+            return ('snapshot', self.sequence, {
+                'seq': self.sequence,
+                'umbral_stock_bajo': self.low_threshold,
+                'productos': productos
+            })
+
+    def _backlog(self, last_event_id: Optional[str]) -> Optional[List[tuple]]:
+        """Eventos posteriores a last_event_id, o None si no se puede reanudar (con el lock tomado)"""
+        if not last_event_id:
+            return None
+        epoch, _, sequence = last_event_id.partition('-')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence > self.sequence:
+            return None
+        if sequence < self.sequence and (not self._events or self._events[0][1] > sequence + 1):
+            # Los eventos perdidos ya salieron del búfer
+            return None
+        return [event for event in self._events if event[1] > sequence]
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop, last_event_id: Optional[str] = None):
+        """
+        Registrar una terminal
+
+        Args:
+            loop: Event loop de la petición (los eventos se encolan en él)
+            last_event_id: Último id recibido por la terminal, para reanudar
+
+        Returns:
+            Tupla (StockSubscription, eventos iniciales): los eventos perdidos si
+            se puede reanudar, o un snapshot
+
+        Raises:
+            Exception: si no se pudo leer la disponibilidad o el catálogo
+        """
+        if self._state is None:
+            self.poll(full=True)
+        subscription = StockSubscription(loop, STREAM_CLIENT_QUEUE)
+        with self._lock:
+            backlog = self._backlog(last_event_id)
+            if backlog is None:
+                backlog = [self.snapshot_event()]
+            # Registrada con el lock tomado: los eventos siguientes llegan por la cola
+            self._subscribers.add(subscription)
+        self.wake()
+        return subscription, backlog
+
+    def unsubscribe(self, subscription: StockSubscription):
+        """Quitar una terminal"""
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        """Contadores del hilo"""
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'epoch': self.epoch,
+            'sequence': self.sequence,
+            'subscribers': len(self._subscribers),
+            'buffered_events': len(self._events),
+            'interval_ms': int(self.interval * 1000),
+            'low_threshold': self.low_threshold,
+            'polls': self.polls,
+            'deltas': self.deltas,
+            'errors': self.errors,
+            'last_poll_ms': round(self.last_poll_ms, 2)
+        }
+
+# Instancia única del proceso
+stock_broadcaster = StockBroadcaster()